@@ -5,15 +5,38 @@
 # Large: base_size = 1280, image_size = 1280, crop_mode = False
 # Gundam: base_size = 1024, image_size = 640, crop_mode = True
 
+MODES = {
+    'tiny': dict(base_size=512, image_size=512, crop_mode=False),
+    'small': dict(base_size=640, image_size=640, crop_mode=False),
+    'base': dict(base_size=1024, image_size=1024, crop_mode=False),
+    'large': dict(base_size=1280, image_size=1280, crop_mode=False),
+    'gundam': dict(base_size=1024, image_size=640, crop_mode=True),
+}
+
+# default mode; a request can pick another one with DeepseekOCRProcessor(**MODES[name])
+# and pass processor.mm_processor_kwargs along with it
 BASE_SIZE = 1024
 IMAGE_SIZE = 640
 CROP_MODE = True
 MIN_CROPS= 2
 MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
+PDF_WINDOW = MAX_CONCURRENCY # run_dpsk_ocr_pdf.py / run_dpsk_ocr_batch.py: pages rendered / preprocessed per window, so memory stays flat in document length (the PDF script keeps MAX_CONCURRENCY pages generating across windows, the batch script generates per window); 0 = whole document at once
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
+PREPROCESS_BACKEND = 'thread' # 'thread': thread pool, 'process': process pool (not GIL-bound); benchmarks/bench_preprocess_pool.py prints the faster backend / NUM_WORKERS for your host
+PREPROCESS_CACHE_MB = 2048 # content-hash cache of processed pages (repeated pages / re-submitted documents); 0 disables
+PREPROCESS_STREAM_CACHE_MB = 256 # smaller cache of the same kind for run_dpsk_ocr_pdf.py / run_dpsk_ocr_batch.py (repeated pages within a run); byte-bounded, so memory stays flat in document length; 0 disables
 PRINT_NUM_VIS_TOKENS = False
+UINT8_TILES = False # keep tiles as uint8 until the vision encoder (normalized on the GPU): ~4x less preprocessing memory/IPC
+VISION_CACHE_MB = 0 # GPU cache of vision features for repeated queries on the same image (opt-in: not profiled by vLLM, lower gpu_memory_utilization by its size); 0 disables
+VISION_BATCH_SIZE = 32 # views per SAM/CLIP forward when prefill images are encoded together
 SKIP_REPEAT = True
+LAYOUT_JSONL = True # also write per-block layout (label, bbox, text, reading order) as JSON Lines
+RENDER_LAYOUTS = False # draw annotated box images (_layouts.pdf / result_with_boxes.jpg); box data is in the layout JSON Lines either way
+REPEAT_STOP = True # end a page early once its output falls into a token cycle
+REPEAT_MAX_PERIOD = 256 # longest cycle (in tokens) that is checked
+REPEAT_MIN_TOKENS = 1024 # periodic tail this long counts as a loop; raise it for documents with huge empty tables
+REPEAT_MIN_CYCLES = 4
 MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
 
 # TODO: change INPUT_PATH
@@ -37,6 +60,18 @@ PROMPT = '<image>\n<|grounding|>Convert the document to markdown.'
 # .......
 
 
-from transformers import AutoTokenizer
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    # loaded on first use: importing config or the pre/post-processing helpers must not touch the model files
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+
 
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+def __getattr__(name):
+    # config.TOKENIZER still works, but only loads the tokenizer when accessed
+    if name == 'TOKENIZER':
+        return get_tokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
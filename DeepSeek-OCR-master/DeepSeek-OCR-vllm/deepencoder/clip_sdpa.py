@@ -128,6 +128,25 @@ class CLIPVisionEmbeddings(nn.Module):
             "position_ids", torch.arange(self.num_positions).expand((1, -1))
         )
 
+        # (tgt_size, dtype, device) -> (weight version, resized position embedding)
+        self._pos_embed_cache = {}
+
+    def clear_pos_embed_cache(self):
+        self._pos_embed_cache.clear()
+
+    def _abs_pos(self, tgt_size):
+        weight = self.position_embedding.weight
+        if torch.is_grad_enabled() or tgt_size == self.num_positions:
+            return get_abs_pos(self.position_embedding(self.position_ids), tgt_size)
+        # the bicubic resize only depends on the weights and the grid size
+        key = (tgt_size, weight.dtype, weight.device)
+        version = (weight._version, weight.data_ptr())
+        cached = self._pos_embed_cache.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, get_abs_pos(self.position_embedding(self.position_ids), tgt_size))
+            self._pos_embed_cache[key] = cached
+        return cached[1]
+
     def forward(self, pixel_values, patch_embeds):
         batch_size = pixel_values.shape[0]
         # patch_embeds = self.patch_embedding(
@@ -151,7 +170,7 @@ class CLIPVisionEmbeddings(nn.Module):
         embeddings = torch.cat([class_embeds, patch_embeds], dim=1)
 
         # x = torch.cat([cls_token, x], dim=1)
-        embeddings = embeddings + get_abs_pos(self.position_embedding(self.position_ids), embeddings.size(1))
+        embeddings = embeddings + self._abs_pos(embeddings.size(1))
         # embeddings = embeddings + self.position_embedding(self.position_ids)
         return embeddings
 
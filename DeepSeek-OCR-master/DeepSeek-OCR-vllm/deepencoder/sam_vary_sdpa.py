@@ -166,11 +166,30 @@ class ImageEncoderViT(nn.Module):
         self.net_2 = nn.Conv2d(256, 512, kernel_size=3, stride=2, padding=1, bias=False)
         self.net_3 = nn.Conv2d(512, 1024, kernel_size=3, stride=2, padding=1, bias=False)
 
+        # (tgt_size, dtype, device) -> (weight version, resized pos_embed)
+        self._pos_embed_cache = {}
+
+    def clear_pos_embed_cache(self):
+        self._pos_embed_cache.clear()
+
+    def _abs_pos(self, tgt_size: int) -> torch.Tensor:
+        pos_embed = self.pos_embed
+        if torch.is_grad_enabled() or pos_embed.size(1) == tgt_size:
+            return get_abs_pos(pos_embed, tgt_size)
+        # the bicubic resize only depends on the weights and the grid size
+        key = (tgt_size, pos_embed.dtype, pos_embed.device)
+        version = (pos_embed._version, pos_embed.data_ptr())
+        cached = self._pos_embed_cache.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, get_abs_pos(pos_embed, tgt_size))
+            self._pos_embed_cache[key] = cached
+        return cached[1]
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.patch_embed(x)
         if self.pos_embed is not None:
             # x = x + self.pos_embed
-            x = x + get_abs_pos(self.pos_embed, x.size(1))
+            x = x + self._abs_pos(x.size(1))
 
         for blk in self.blocks:
             x = blk(x)
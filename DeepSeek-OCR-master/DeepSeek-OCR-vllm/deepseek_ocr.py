@@ -42,7 +42,8 @@ from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PRINT_NUM_VIS_TOKENS, VISION_BATCH_SIZE, VISION_CACHE_MB
+from process.vision_cache import VisionEmbeddingCache
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
@@ -62,27 +63,26 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              *,
                              image_width: int,
                              image_height: int,
-                             cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
+                             cropping: bool = CROP_MODE,
+                             image_size: int = IMAGE_SIZE,
+                             base_size: int = BASE_SIZE) -> int:
 
         # image_size = hf_processor.image_size
         # patch_size = hf_processor.patch_size
         # downsample_ratio = hf_processor.downsample_ratio
 
-        image_size = IMAGE_SIZE
-        base_size = BASE_SIZE
         patch_size = 16
         downsample_ratio = 4
 
-        if CROP_MODE:
+        if cropping:
             if image_width <= 640 and image_height <= 640:
                 crop_ratio = [1, 1]
             else:
                 # images_crop_raw, crop_ratio = hf_processor.dynamic_preprocess(image)
 
                 # find the closest aspect ratio to the target
-                crop_ratio = count_tiles(image_width, image_height, image_size=IMAGE_SIZE)
+                # same call signature as dynamic_preprocess, so both hit the same memoized plan
+                crop_ratio = count_tiles(image_width, image_height, MIN_CROPS, MAX_CROPS, image_size)
 
                 # print('===========')
                 # print('crop_ratio ', crop_ratio)
@@ -132,12 +132,13 @@ class DeepseekOCRDummyInputsBuilder(
 
         max_image_size = self.info.get_image_size_with_most_features()
 
-        if '<image>' in PROMPT:
+        if num_images > 0:
             return {
                 "image":
                 DeepseekOCRProcessor().tokenize_with_images(images = self._get_dummy_images(width=max_image_size.width,
                                     height=max_image_size.height,
-                                    num_images=num_images), bos=True, eos=True, cropping=CROP_MODE)
+                                    num_images=num_images), bos=True, eos=True, cropping=CROP_MODE,
+                                    prompt=self.get_dummy_text(mm_counts))
             }
         else:
             return {
@@ -185,6 +186,7 @@ class DeepseekOCRMultiModalProcessor(
             images_spatial_crop=MultiModalFieldConfig.batched("image"),
             # image_embeds=MultiModalFieldConfig.batched("image2"),
             images_crop=MultiModalFieldConfig.batched("image"),
+            image_hashes=MultiModalFieldConfig.batched("image"),
         )
 
     def _get_prompt_updates(
@@ -209,14 +211,17 @@ class DeepseekOCRMultiModalProcessor(
             else:
 
                 
-                width = images[0][-1][0][0]
-                height = images[0][-1][0][1]
+                width = images[0][6][0][0]
+                height = images[0][6][0][1]
 
+                # mode of this request (mm_processor_kwargs), defaults to config.py
                 num_image_tokens = self.info.get_num_image_tokens(
                     image_width=width,
                     image_height=height,
                     # flag = True,
-                    cropping=CROP_MODE,
+                    cropping=hf_processor.crop_mode,
+                    image_size=hf_processor.image_size,
+                    base_size=hf_processor.base_size,
                 )
             return [image_token_id] * num_image_tokens
 
@@ -328,6 +333,9 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         self.make_empty_intermediate_tensors = (
             self.language_model.make_empty_intermediate_tensors)
 
+        # per-image vision features, reused when the same image is queried again
+        self.vision_cache = VisionEmbeddingCache() if VISION_CACHE_MB > 0 else None
+
 
 
     def _parse_and_validate_image_input(
@@ -336,11 +344,22 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         pixel_values = kwargs.pop("pixel_values", None)
         images_spatial_crop = kwargs.pop("images_spatial_crop", None)
         images_crop = kwargs.pop("images_crop", None)
+        image_hashes = kwargs.pop("image_hashes", None)
 
 
-        if pixel_values is None or torch.sum(pixel_values).item() == 0:
+        if pixel_values is None or images_spatial_crop is None:
             return None
 
+        # "has image" / "has crops" come from the tile grid written by tokenize_with_images
+        # ([0, 0] for the no-image placeholder), the cache keys from image_hashes;
+        # one small transfer instead of reducing pixel tensors
+        metadata = self._image_metadata(images_spatial_crop, image_hashes)
+        crop_shapes = [row[:2] for row in metadata]
+        if all(sum(shape) == 0 for shape in crop_shapes):
+            return None
+        # all-zero hash: no cache key
+        cache_keys = [tuple(row[2:]) if any(row[2:]) else None for row in metadata]
+
         if pixel_values is not None:
             if not isinstance(pixel_values, (torch.Tensor, list)):
                 raise ValueError("Incorrect type of pixel values. "
@@ -354,18 +373,57 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 raise ValueError("Incorrect type of image crop. "
                                  f"Got type: {type(images_crop)}")
 
-            return [pixel_values, images_crop, images_spatial_crop]
+            return [pixel_values, images_crop, images_spatial_crop, crop_shapes, cache_keys]
 
 
         raise AssertionError("This line should be unreachable.")
     
 
 
+    @staticmethod
+    def _rows(field, width) -> torch.Tensor:
+        if isinstance(field, list):
+            return torch.stack([item.reshape(-1)[:width] for item in field])
+        return field.reshape(field.size(0), -1)[:, :width]
+
+    @classmethod
+    def _crop_shapes(cls, images_spatial_crop) -> List[List[int]]:
+        # [num_tiles_w, num_tiles_h] per image, with a single device -> host copy
+        return cls._rows(images_spatial_crop, 2).tolist()
+
+    @classmethod
+    def _image_metadata(cls, images_spatial_crop, image_hashes) -> List[List[int]]:
+        # [num_tiles_w, num_tiles_h, hash_hi, hash_lo] per image, with a single device -> host copy
+        crop_rows = cls._rows(images_spatial_crop, 2)
+        if image_hashes is None:
+            hash_rows = torch.zeros((crop_rows.size(0), 2), dtype=crop_rows.dtype, device=crop_rows.device)
+        else:
+            hash_rows = cls._rows(image_hashes, 2).to(crop_rows.device, crop_rows.dtype)
+        return torch.cat([crop_rows, hash_rows], dim=1).tolist()
+
+    @staticmethod
+    def _to_model_input(pixels: torch.Tensor) -> torch.Tensor:
+        if pixels.dtype == torch.uint8:
+            # UINT8_TILES: same as ToTensor + Normalize(0.5, 0.5), done on the device
+            return pixels.to(torch.float32).div_(127.5).sub_(1.0).to(torch.bfloat16)
+        return pixels.to(torch.bfloat16)
+
+    def _encode_views(self, views: torch.Tensor) -> torch.Tensor:
+        # SAM -> CLIP -> projector on a batch of equally sized views, VISION_BATCH_SIZE at a time
+        features = []
+        for chunk in torch.split(views, VISION_BATCH_SIZE):
+            features_1 = self.sam_model(chunk)
+            features_2 = self.vision_model(chunk, features_1)
+            chunk_features = torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1)
+            features.append(self.projector(chunk_features))
+        return torch.cat(features, dim=0)
+
     def _pixel_values_to_embedding(
         self,
         pixel_values: torch.Tensor,
         images_crop: torch.Tensor,
         images_spatial_crop: torch.Tensor,
+        crop_shapes: Optional[List[List[int]]] = None,
     ) -> NestedTensors:
 
         # Pixel_values (global view): [n_image, batch_size, 3, height, width]
@@ -373,61 +431,59 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         # images_crop (local view): [n_image, batch_size, num_pathes, 3, h, w]
         # split the pixel and image_crop, all batch_size = 1
 
-        images_in_this_batch = []
-
-
-        # print(type(images_crop))
-
-        # print(pixel_values.shape)
-
+        # encode all global views of the same size in one pass, and all crops of all images in
+        # another, then scatter the features back to per-image sequences
+        if crop_shapes is None:
+            crop_shapes = self._crop_shapes(images_spatial_crop)
+        num_images = len(crop_shapes)
+        has_crops = [width_crop_num > 1 or height_crop_num > 1 for width_crop_num, height_crop_num in crop_shapes]
 
         with torch.no_grad():
-            for jdx in range(images_spatial_crop.size(0)):
-                # with torch.set_grad_enabled(False):
-                patches = images_crop[jdx][0].to(torch.bfloat16) # batch_size = 1
-                image_ori = pixel_values[jdx]
-                crop_shape = images_spatial_crop[jdx][0]
-
-                if torch.sum(patches).item() != 0:  # if all values = 0, no crop
-                    # P, C, H, W = patches.shape
-                    # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
-                    #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
-
-
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
+            views_by_size = {}
+            for jdx in range(num_images):
+                views_by_size.setdefault(tuple(pixel_values[jdx].shape[-2:]), []).append(jdx)
+
+            global_features_list = [None] * num_images
+            for indices in views_by_size.values():
+                features = self._encode_views(torch.cat([pixel_values[jdx] for jdx in indices], dim=0))
+                for jdx, image_features in zip(indices, features):
+                    global_features_list[jdx] = image_features
+
+            cropped = [jdx for jdx in range(num_images) if has_crops[jdx]]
+            local_features_list = [None] * num_images
+            if cropped:
+                patches = [self._to_model_input(images_crop[jdx][0]) for jdx in cropped] # batch_size = 1
+                local_features_all = self._encode_views(torch.cat(patches, dim=0))
+                for jdx, local_features in zip(cropped, torch.split(local_features_all, [p.size(0) for p in patches])):
+                    local_features_list[jdx] = local_features
+
+            images_in_this_batch = []
+            for jdx in range(num_images):
+                global_features = global_features_list[jdx]
+                hw, n_dim = global_features.shape
+                h = w = int(hw ** 0.5)
+
+                global_features = global_features.view(h, w, n_dim)
+
+                global_features = torch.cat(
+                    [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
+                )
 
+                global_features = global_features.view(-1, n_dim)
 
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                if has_crops[jdx]:
+                    local_features = local_features_list[jdx]
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
-                        print('BASE: ', global_features.shape)
+                        print('BASE: ', global_features_list[jdx].shape)
                         print('PATCHES: ', local_features.shape)
                         print('=====================')
 
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
                     _2, hw2, n_dim2 = local_features.shape
                     h2 = w2 = int(hw2 ** 0.5)
 
-                    width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
+                    width_crop_num, height_crop_num = crop_shapes[jdx]
 
                     local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
                     local_features = torch.cat(
@@ -436,30 +492,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                     local_features = local_features.view(-1, n_dim2)
 
                     global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
-                
-                else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
 
+                else:
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
-                        print('BASE: ', global_features.shape)
+                        print('BASE: ', global_features_list[jdx].shape)
                         print('NO PATCHES')
                         print('=====================')
 
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
                     global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
                 images_in_this_batch.append(global_local_features)
@@ -470,9 +510,33 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
             self, image_input) -> torch.Tensor:
         
 
-        # image_input: [pixel_values, images_crop, images_spatial_crop]
+        # image_input: [pixel_values, images_crop, images_spatial_crop, crop_shapes, cache_keys]
+
+        crop_shapes, cache_keys = image_input[3], image_input[4]
+        if self.vision_cache is not None:
+            cached = [self.vision_cache.get(key) if key is not None else None for key in cache_keys]
+            missing = [jdx for jdx, features in enumerate(cached) if features is None]
+            if not missing:
+                # every image was encoded before: straight to prefill
+                return cached
+            if len(missing) < len(cached):
+                vision_features = self._process_image_input([
+                    [image_input[0][jdx] for jdx in missing],
+                    [image_input[1][jdx] for jdx in missing],
+                    None,
+                    [crop_shapes[jdx] for jdx in missing],
+                    [None] * len(missing),
+                ])
+                for jdx, features in zip(missing, vision_features):
+                    cached[jdx] = features
+                    if cache_keys[jdx] is not None:
+                        self.vision_cache.put(cache_keys[jdx], features)
+                return cached
     
-        pixel_values = image_input[0].to(torch.bfloat16)
+        if isinstance(image_input[0], list):
+            pixel_values = [self._to_model_input(p) for p in image_input[0]]
+        else:
+            pixel_values = self._to_model_input(image_input[0])
         # print(image_input[1][0].shape)
         # print(type(image_input[1]))
         # exit()
@@ -480,11 +544,17 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         # images_crop = image_input[1].to(torch.bfloat16)
         images_crop = image_input[1]
         # images_crop = image_input[1]
-        images_spatial_crop = image_input[2].to(dtype=torch.long)
+        images_spatial_crop = image_input[2]
 
         # local_start = time.time()
         vision_features = self._pixel_values_to_embedding(
-            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop)
+            pixel_values=pixel_values, images_crop = images_crop,  images_spatial_crop=images_spatial_crop,
+            crop_shapes=crop_shapes)
+
+        if self.vision_cache is not None:
+            for key, features in zip(cache_keys, vision_features):
+                if key is not None:
+                    self.vision_cache.put(key, features)
 
         # local_total_time = time.time() - local_start
 
@@ -575,6 +645,13 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         loader = AutoWeightsLoader(self)
         autoloaded_weights = loader.load_weights(processed_weights, mapper=self.hf_to_vllm_mapper)
 
+        # weights are copied through .data, which does not bump the version the caches check
+        for module in self.modules():
+            if hasattr(module, 'clear_pos_embed_cache'):
+                module.clear_pos_embed_cache()
+        if self.vision_cache is not None:
+            self.vision_cache.clear()
+
 
 
 
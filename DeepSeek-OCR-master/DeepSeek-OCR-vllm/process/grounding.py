@@ -0,0 +1,194 @@
+import json
+import re
+from collections import namedtuple
+
+
+REF_OPEN, REF_CLOSE = '<|ref|>', '<|/ref|>'
+DET_OPEN, DET_CLOSE = '<|det|>', '<|/det|>'
+
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+# blank-line runs left behind by removed spans
+MULTI_NEWLINE = re.compile(r'\n{3,}')
+
+# label: text between <|ref|> tags; boxes: [[x1, y1, x2, y2], ...] in 0..999 coordinates,
+# None if the <|det|> payload is malformed; raw: the full span as emitted by the model;
+# start / end: what replaced the span in the clean text (empty unless it became an image link)
+GroundingRef = namedtuple('GroundingRef', ['label', 'boxes', 'raw', 'start', 'end'])
+
+
+def parse_boxes(det_text):
+    """'[[x1, y1, x2, y2], ...]' -> list of 4-int boxes, without eval (None if malformed)"""
+    if det_text.count('[') != det_text.count(']'):
+        return None
+    values = [int(float(number)) for number in _NUMBER.findall(det_text)]
+    if not values or len(values) % 4:
+        return None
+    return [values[i:i + 4] for i in range(0, len(values), 4)]
+
+
+def _partial_prefix(text, start, token):
+    # length of the longest suffix of text[start:] that is a proper prefix of token
+    for size in range(min(len(token) - 1, len(text) - start), 0, -1):
+        if text.endswith(token[:size]):
+            return size
+    return 0
+
+
+class GroundingParser:
+    """
+    Incremental parser for <|ref|>label<|/ref|><|det|>[[...]]<|/det|> spans.
+
+    feed() takes the output as it streams in and returns the newly completed clean text:
+    spans are dropped, or, for 'image' refs when image_link is set, replaced by a markdown
+    image link ('![](images/{idx}.jpg)\\n' style, idx counting image refs). Parsed spans are
+    collected in .refs. Each character is scanned a bounded number of times, so dense pages
+    stay linear in the output length.
+    """
+
+    _TEXT, _REF, _AFTER_REF, _DET = range(4)
+
+    def __init__(self, image_link=None):
+        self.image_link = image_link
+        self.refs = []
+        self._chunks = []
+        self._buffer = ''
+        self._state = self._TEXT
+        self._label = ''
+        self._num_images = 0
+        self._length = 0
+
+    @property
+    def text(self):
+        return ''.join(self._chunks)
+
+    @property
+    def num_images(self):
+        return self._num_images
+
+    def _emit_ref(self, label, det_text, start):
+        raw = f'{REF_OPEN}{label}{REF_CLOSE}{DET_OPEN}{det_text}{DET_CLOSE}'
+        replacement = ''
+        if label == 'image':
+            idx = self._num_images
+            self._num_images += 1
+            if self.image_link is not None:
+                replacement = f'![]({self.image_link.format(idx=idx)})\n'
+        self.refs.append(GroundingRef(label, parse_boxes(det_text), raw, start, start + len(replacement)))
+        return replacement
+
+    def feed(self, chunk):
+        buffer = self._buffer + chunk
+        pos = 0
+        out = []
+        length = self._length
+        while True:
+            if self._state == self._TEXT:
+                start = buffer.find(REF_OPEN, pos)
+                if start < 0:
+                    # hold back a possible partial '<|ref|>' until the next chunk
+                    end = len(buffer) - _partial_prefix(buffer, pos, REF_OPEN)
+                    out.append(buffer[pos:end])
+                    length += end - pos
+                    pos = end
+                    break
+                out.append(buffer[pos:start])
+                length += start - pos
+                pos = start + len(REF_OPEN)
+                self._state = self._REF
+            elif self._state == self._REF:
+                end = buffer.find(REF_CLOSE, pos)
+                if end < 0:
+                    break
+                self._label = buffer[pos:end]
+                pos = end + len(REF_CLOSE)
+                self._state = self._AFTER_REF
+            elif self._state == self._AFTER_REF:
+                if buffer.startswith(DET_OPEN, pos):
+                    pos += len(DET_OPEN)
+                    self._state = self._DET
+                elif len(buffer) - pos < len(DET_OPEN) and DET_OPEN.startswith(buffer[pos:]):
+                    break
+                else:
+                    # a ref without a box is plain text
+                    out.append(f'{REF_OPEN}{self._label}{REF_CLOSE}')
+                    length += len(out[-1])
+                    self._state = self._TEXT
+            else:
+                end = buffer.find(DET_CLOSE, pos)
+                if end < 0:
+                    break
+                out.append(self._emit_ref(self._label, buffer[pos:end], length))
+                length += len(out[-1])
+                pos = end + len(DET_CLOSE)
+                self._state = self._TEXT
+        self._buffer = buffer[pos:]
+        self._length = length
+        text = ''.join(out)
+        self._chunks.append(text)
+        return text
+
+    def close(self):
+        """flush the tail; an unterminated span is kept as text"""
+        tail = self._buffer
+        if self._state == self._REF:
+            tail = REF_OPEN + tail
+        elif self._state == self._AFTER_REF:
+            tail = f'{REF_OPEN}{self._label}{REF_CLOSE}' + tail
+        elif self._state == self._DET:
+            tail = f'{REF_OPEN}{self._label}{REF_CLOSE}{DET_OPEN}' + tail
+        self._buffer = ''
+        self._state = self._TEXT
+        self._length += len(tail)
+        self._chunks.append(tail)
+        return tail
+
+
+def parse_grounding(text, image_link=None):
+    """one-shot helper: (clean text, refs)"""
+    parser = GroundingParser(image_link=image_link)
+    parser.feed(text)
+    parser.close()
+    return parser.text, parser.refs
+
+
+def _clean_text(text):
+    return text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+
+
+def _scale_box(box, image_width, image_height):
+    x1, y1, x2, y2 = box
+    return ([round(x1 / 999, 4), round(y1 / 999, 4), round(x2 / 999, 4), round(y2 / 999, 4)],
+            [int(x1 / 999 * image_width), int(y1 / 999 * image_height),
+             int(x2 / 999 * image_width), int(y2 / 999 * image_height)])
+
+
+def layout_blocks(text, refs, image_width, image_height):
+    """
+    Reading-order layout blocks from a parsed page: one block per grounding span, holding the
+    clean text up to the next span. bbox is the union of the span's boxes, normalized to 0..1,
+    bbox_px the same in page pixels (None when the payload was malformed); text before the
+    first span becomes a block with label None. Block text gets the same \\coloneqq / \\eqqcolon
+    cleanup as the markdown, matching the backend's layout JSON Lines.
+    """
+    blocks = []
+    lead = _clean_text(text[:refs[0].start if refs else len(text)]).strip()
+    if lead:
+        blocks.append({'order': 0, 'label': None, 'bbox': None, 'bbox_px': None, 'text': lead})
+    for idx, ref in enumerate(refs):
+        block_end = refs[idx + 1].start if idx + 1 < len(refs) else len(text)
+        block = {'order': len(blocks), 'label': ref.label, 'bbox': None, 'bbox_px': None,
+                 'text': _clean_text(text[ref.end:block_end]).strip()}
+        if ref.boxes:
+            union = [min(box[0] for box in ref.boxes), min(box[1] for box in ref.boxes),
+                     max(box[2] for box in ref.boxes), max(box[3] for box in ref.boxes)]
+            block['bbox'], block['bbox_px'] = _scale_box(union, image_width, image_height)
+            if len(ref.boxes) > 1:
+                block['boxes'] = [_scale_box(box, image_width, image_height)[0] for box in ref.boxes]
+        blocks.append(block)
+    return blocks
+
+
+def layout_jsonl(blocks, **fields):
+    """compact JSON Lines, one block per line; fields (e.g. page=3) are prepended to every line"""
+    return ''.join(json.dumps({**fields, **block}, ensure_ascii=False, separators=(',', ':')) + '\n'
+                   for block in blocks)
@@ -1,4 +1,5 @@
 import math
+from functools import lru_cache
 from typing import List, Tuple
 
 import torch
@@ -6,7 +7,9 @@ import torchvision.transforms as T
 from PIL import Image, ImageOps
 from transformers import AutoProcessor, BatchFeature, LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, UINT8_TILES, VISION_CACHE_MB, get_tokenizer
+from process.input_cache import content_hash
+from process.vision_cache import image_hash_tensor
 
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
     best_ratio_diff = float('inf')
@@ -25,37 +28,35 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
-def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
+@lru_cache(maxsize=None)
+def get_target_ratios(min_num=MIN_CROPS, max_num=MAX_CROPS):
+    """candidate (w_tiles, h_tiles) grids for the crop limits, sorted by tile count"""
     target_ratios = set(
         (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
         i * j <= max_num and i * j >= min_num)
     # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    return tuple(sorted(target_ratios, key=lambda x: x[0] * x[1]))
+
+
+@lru_cache(maxsize=4096)
+def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
+    """
+    tiling plan for an image size; memoized so that token counting and cropping of the
+    same image (and every page of the same size) share one lookup
+    """
+    aspect_ratio = orig_width / orig_height
 
     # find the closest aspect ratio to the target
     target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+        aspect_ratio, get_target_ratios(min_num, max_num), orig_width, orig_height, image_size)
 
     return target_aspect_ratio
 
 
 def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
     orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
 
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
-
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+    target_aspect_ratio = count_tiles(orig_width, orig_height, min_num, max_num, image_size)
 
     # print(target_aspect_ratio)
     # calculate the target width and height
@@ -86,19 +87,44 @@ def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=6
 
 
 
+@lru_cache(maxsize=256)
+def image_token_block(image_token_id, num_width_tiles, num_height_tiles, base_size, image_size,
+                      patch_size=16, downsample_ratio=4):
+    """
+    image-token ids and seq mask for one image: global view rows (+ newline), view separator,
+    then the local tile rows (+ newline) when the image is cropped. Shared between calls, never modify in place.
+    """
+    num_queries = math.ceil((image_size // patch_size) / downsample_ratio)
+    num_queries_base = math.ceil((base_size // patch_size) / downsample_ratio)
+
+    num_tokens = (num_queries_base + 1) * num_queries_base + 1
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        num_tokens += (num_queries * num_width_tiles + 1) * (num_queries * num_height_tiles)
+    return (torch.full((num_tokens,), image_token_id, dtype=torch.long),
+            torch.ones(num_tokens, dtype=torch.bool))
+
+
 class ImageTransform:
 
     def __init__(self,
                  mean: Tuple[float, float, float] = (0.5, 0.5, 0.5),
                  std: Tuple[float, float, float] = (0.5, 0.5, 0.5),
-                 normalize: bool = True):
+                 normalize: bool = True,
+                 as_uint8: bool = False):
         self.mean = mean
         self.std = std
         self.normalize = normalize
+        self.as_uint8 = as_uint8
+        self.dtype = torch.uint8 if as_uint8 else torch.float32
 
-        transform_pipelines = [T.ToTensor()]
+        if as_uint8:
+            # raw 0..255 CHW; DeepseekOCRForCausalLM normalizes on the device (x / 127.5 - 1)
+            assert tuple(mean) == tuple(std) == (0.5, 0.5, 0.5), "uint8 tiles assume mean = std = 0.5"
+            transform_pipelines = [T.PILToTensor()]
+        else:
+            transform_pipelines = [T.ToTensor()]
 
-        if normalize:
+        if normalize and not as_uint8:
             transform_pipelines.append(T.Normalize(mean, std))
 
         self.transform = T.Compose(transform_pipelines)
@@ -114,7 +140,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
     def __init__(
         self,
-        tokenizer: LlamaTokenizerFast = TOKENIZER,
+        tokenizer: LlamaTokenizerFast = None,
         candidate_resolutions: Tuple[Tuple[int, int]] = [[1024, 1024]],
         patch_size: int = 16,
         downsample_ratio: int = 4,
@@ -127,12 +153,20 @@ class DeepseekOCRProcessor(ProcessorMixin):
         sft_format: str = "deepseek",
         mask_prompt: bool = True,
         ignore_id: int = -100,
+        image_size: int = IMAGE_SIZE,
+        base_size: int = BASE_SIZE,
+        crop_mode: bool = CROP_MODE,
+        prompt: str = PROMPT,
+        uint8_tiles: bool = UINT8_TILES,
         **kwargs,
     ):
 
         # self.candidate_resolutions = candidate_resolutions # placeholder no use
-        self.image_size = IMAGE_SIZE
-        self.base_size = BASE_SIZE
+        # mode and prompt default to config.py and can be overridden per request (mm_processor_kwargs)
+        self.image_size = image_size
+        self.base_size = base_size
+        self.crop_mode = crop_mode
+        self.prompt = prompt
         # self.patch_size = patch_size
         self.patch_size = 16 
         self.image_mean = image_mean
@@ -141,9 +175,11 @@ class DeepseekOCRProcessor(ProcessorMixin):
         # self.downsample_ratio = downsample_ratio
         self.downsample_ratio = 4
 
-        self.image_transform = ImageTransform(mean=image_mean, std=image_std, normalize=normalize)
+        self.image_transform = ImageTransform(mean=image_mean, std=image_std, normalize=normalize, as_uint8=uint8_tiles)
 
 
+        if tokenizer is None:
+            tokenizer = get_tokenizer()
         self.tokenizer = tokenizer
         # self.tokenizer = add_special_token(tokenizer)
         self.tokenizer.padding_side = 'left'  # must set this，padding side with make a difference in batch inference
@@ -213,6 +249,11 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
     #     return best_fit
 
+    @property
+    def mm_processor_kwargs(self):
+        """pass with the request so vLLM counts image tokens for this processor's mode"""
+        return dict(image_size=self.image_size, base_size=self.base_size, crop_mode=self.crop_mode)
+
     @property
     def bos_id(self):
         return self.tokenizer.bos_token_id
@@ -269,7 +310,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         sft_format = prompt
 
-        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, _ = images[0]
+        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, _, image_hashes = images[0]
 
 
         return {
@@ -279,6 +320,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
             "images_seq_mask": images_seq_mask,
             "images_spatial_crop": images_spatial_crop,
             "num_image_tokens": num_image_tokens,
+            "image_hashes": image_hashes,
         }
 
 
@@ -327,30 +369,37 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         return prepare
 
+    def _append_text(self, text: str, tokenized_chunks: List[torch.Tensor], mask_chunks: List[torch.Tensor]):
+        tokenized_sep = self.encode(text, bos=False, eos=False)
+        tokenized_chunks.append(torch.tensor(tokenized_sep, dtype=torch.long))
+        mask_chunks.append(torch.zeros(len(tokenized_sep), dtype=torch.bool))
+
     def tokenize_with_images(
         self,
         # conversation: str,
         images: List[Image.Image],
         bos: bool = True,
         eos: bool = True,
-        cropping: bool = True,
+        cropping: bool = None,
+        prompt: str = None,
     ):
         """Tokenize text with <image> tags."""
 
         # print(conversation)
-        conversation = PROMPT
+        conversation = self.prompt if prompt is None else prompt
+        if cropping is None:
+            cropping = self.crop_mode
         assert conversation.count(self.image_token) == len(images)
         text_splits = conversation.split(self.image_token)
-        images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
+        images_list, images_crop_list, images_spatial_crop, image_hashes = [], [], [], []
         image_shapes = []
         num_image_tokens = []
-        tokenized_str = []
+        # token / mask chunks, joined with a single torch.cat at the end
+        tokenized_chunks, mask_chunks = [], []
         # print('image: ', len(images))
         for text_sep, image in zip(text_splits, images):
             """encode text_sep"""
-            tokenized_sep = self.encode(text_sep, bos=False, eos=False)
-            tokenized_str += tokenized_sep
-            images_seq_mask += [False] * len(tokenized_sep)
+            self._append_text(text_sep, tokenized_chunks, mask_chunks)
 
             """select best resolution for anyres"""
             # if cropping:
@@ -360,6 +409,11 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
             image_shapes.append(image.size)
 
+            # content + mode hash, lets the model reuse vision features of an image it has already encoded
+            mode_key = dict(base_size=self.base_size, image_size=self.image_size, cropping=cropping,
+                            uint8=self.image_transform.as_uint8)
+            image_hashes.append(image_hash_tensor(content_hash(image, '', mode_key) if VISION_CACHE_MB > 0 else None))
+
             if image.size[0] <= 640 and image.size[1] <= 640:
                 crop_ratio = [1, 1]
             else:
@@ -368,7 +422,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
                     # best_width, best_height = select_best_resolution(image.size, self.candidate_resolutions)
                     # print('image ', image.size)
                     # print('open_size:', image.size)
-                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=IMAGE_SIZE)
+                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=self.image_size)
                     # print('crop_ratio: ', crop_ratio)
                 else:
                     # best_width, best_height = self.image_size, self.image_size
@@ -421,51 +475,31 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
             # """add image tokens"""
             """add image tokens"""
-            num_queries = math.ceil((self.image_size // self.patch_size) / self.downsample_ratio)
-            num_queries_base = math.ceil((self.base_size // self.patch_size) / self.downsample_ratio)
-
-
-            tokenized_image = ([self.image_token_id] * num_queries_base + [self.image_token_id]) * num_queries_base
-            tokenized_image += [self.image_token_id]
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                tokenized_image += ([self.image_token_id] * (num_queries * num_width_tiles) + [self.image_token_id]) * (
-                            num_queries * num_height_tiles)
-            tokenized_str += tokenized_image
-            images_seq_mask += [True] * len(tokenized_image)
+            tokenized_image, image_mask = image_token_block(self.image_token_id, num_width_tiles, num_height_tiles,
+                                                            self.base_size, self.image_size,
+                                                            self.patch_size, self.downsample_ratio)
+            tokenized_chunks.append(tokenized_image)
+            mask_chunks.append(image_mask)
             num_image_tokens.append(len(tokenized_image))
 
         """process the last text split"""
-        tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
-        tokenized_str += tokenized_sep
-        images_seq_mask += [False] * len(tokenized_sep)
+        self._append_text(text_splits[-1], tokenized_chunks, mask_chunks)
 
         """add the bos and eos tokens"""
         if bos:
-            tokenized_str = [self.bos_id] + tokenized_str
-            images_seq_mask = [False] + images_seq_mask
+            tokenized_chunks.insert(0, torch.tensor([self.bos_id], dtype=torch.long))
+            mask_chunks.insert(0, torch.zeros(1, dtype=torch.bool))
         if eos:
-            tokenized_str = tokenized_str + [self.eos_id]
-            images_seq_mask = images_seq_mask + [False]
+            tokenized_chunks.append(torch.tensor([self.eos_id], dtype=torch.long))
+            mask_chunks.append(torch.zeros(1, dtype=torch.bool))
 
-        assert len(tokenized_str) == len(
-            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(tokenized_str)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
-        
-
-
-        masked_tokenized_str = []
-        for token_index in tokenized_str:
-            if token_index != self.image_token_id:
-                masked_tokenized_str.append(token_index)
-            else:
-                masked_tokenized_str.append(self.ignore_id)
+        input_ids = torch.cat(tokenized_chunks)
+        images_seq_mask = torch.cat(mask_chunks)
 
-        assert len(tokenized_str) == len(images_seq_mask) == len(masked_tokenized_str), \
-            (f"tokenized_str's length {len(tokenized_str)}, input_ids' length {len(masked_tokenized_str)}, "
-             f"imags_seq_mask's length {len(images_seq_mask)}, are not equal")
+        assert len(input_ids) == len(
+            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(input_ids)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
 
-        input_ids = torch.LongTensor(tokenized_str)
-        target_ids = torch.LongTensor(masked_tokenized_str)
-        images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
+        target_ids = input_ids.clone()
 
         # set input_ids < 0 | input_ids == self.image_token_id as ignore_id
         target_ids[(input_ids < 0) |
@@ -482,21 +516,24 @@ class DeepseekOCRProcessor(ProcessorMixin):
             images_seq_mask = images_seq_mask[:-1]
 
         if len(images_list) == 0:
-            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
-            images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
-            images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size), dtype=self.image_transform.dtype)
+            # [0, 0] tile grid marks "no image" for the model
+            images_spatial_crop = torch.zeros((1, 2), dtype=torch.long)
+            image_hashes = image_hash_tensor(None)
+            images_crop = torch.zeros((1, 3, self.image_size, self.image_size), dtype=self.image_transform.dtype).unsqueeze(0)
         else:
             pixel_values = torch.stack(images_list, dim=0)
             images_spatial_crop = torch.tensor(images_spatial_crop, dtype=torch.long)
+            image_hashes = torch.cat(image_hashes, dim=0)
             if images_crop_list:
                 images_crop = torch.stack(images_crop_list, dim=0).unsqueeze(0)
             else:
-                images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+                images_crop = torch.zeros((1, 3, self.image_size, self.image_size), dtype=self.image_transform.dtype).unsqueeze(0)
 
         input_ids = input_ids.unsqueeze(0)
 
         
-        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
+        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes, image_hashes]]
 
 
 AutoProcessor.register("DeepseekVLV2Processor", DeepseekOCRProcessor)
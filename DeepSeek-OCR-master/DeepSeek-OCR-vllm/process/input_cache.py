@@ -0,0 +1,95 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import torch
+
+from config import PREPROCESS_CACHE_MB
+
+
+def content_hash(image, prompt='', processor_kwargs=None):
+    """hash of the pixels plus everything else that changes the processed input"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{image.mode}:{image.size}:{prompt}:{sorted((processor_kwargs or {}).items())}'.encode('utf-8'))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+def copy_request(value):
+    """copy of the dict / list structure of a request; tensors and other leaves are shared"""
+    if isinstance(value, dict):
+        return {k: copy_request(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_request(v) for v in value]
+    return value
+
+
+class ProcessedInputCache:
+    """
+    Bounded LRU cache of processed vLLM requests (token ids, tiles, spatial crop) keyed by content_hash.
+
+    vLLM's own multimodal preprocessor cache does not cover our pre-tokenized processor output, so
+    repeated pages and re-submitted documents are looked up here before preprocessing.
+    Thread-safe; get() returns a fresh copy of the dicts and lists, the tensors in it are shared
+    and must not be modified in place.
+    """
+
+    def __init__(self, max_mb=PREPROCESS_CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy_request(entry[0])
+
+    def put(self, key, request):
+        size = _nbytes(request)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = (request, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'mb': round(self._bytes / 1024 / 1024, 1),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+@lru_cache(maxsize=None)
+def get_input_cache():
+    """process-wide cache shared by every PreprocessEngine"""
+    return ProcessedInputCache()
@@ -0,0 +1,110 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+
+MANIFEST_PREFIX = 'manifest'
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """hash of the file bytes, read in chunks"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def settings_hash(**settings):
+    """hash of everything besides the input that changes the output (prompt, mode, ...)"""
+    return hashlib.blake2b(json.dumps(settings, sort_keys=True).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def parse_shard(text):
+    """'i/n' -> (i, n), 0 <= i < n"""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"shard must look like i/n, got {text!r}")
+    if count < 1:
+        raise ValueError(f"shard count must be at least 1, got {text!r}")
+    if not 0 <= index < count:
+        raise ValueError(f"shard index must be in [0, {count}), got {text!r}")
+    return index, count
+
+
+def in_shard(rel_path, shard):
+    # keyed on the relative path, so adding files does not move the others to another shard
+    index, count = shard
+    return zlib.crc32(rel_path.encode('utf-8')) % count == index
+
+
+class BatchManifest:
+    """
+    Append-only JSON Lines record of finished inputs, one line per input with its content hash.
+
+    Every shard appends to its own file (manifest.jsonl, or manifest.{i}-of-{n}.jsonl), so machines
+    sharing an output directory never write to the same file; all of them are read on start, so a
+    restart skips what any earlier run finished, whatever its sharding. An input counts as done only
+    while its file hash and the run settings match one of its recorded entries, whichever file they
+    are in. Lines are flushed and fsync'ed once the outputs are in place, so a crash loses at most the
+    inputs in flight. record() is thread-safe.
+    """
+
+    def __init__(self, output_dir, shard=(0, 1)):
+        index, count = shard
+        name = f'{MANIFEST_PREFIX}.jsonl' if count == 1 else f'{MANIFEST_PREFIX}.{index}-of-{count}.jsonl'
+        self.path = os.path.join(output_dir, name)
+        # rel path -> every (hash, settings) recorded for it
+        self._done = {}
+        self._lock = threading.Lock()
+        for manifest_path in sorted(glob.glob(os.path.join(output_dir, f'{MANIFEST_PREFIX}*.jsonl'))):
+            self._load(manifest_path)
+        self._file = None
+
+    def __len__(self):
+        return len(self._done)
+
+    def _load(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # line torn by a crash mid-write
+                    continue
+                self._done.setdefault(entry['path'], set()).add((entry['hash'], entry.get('settings')))
+
+    def is_done(self, rel_path, content_hash, settings=None):
+        return (content_hash, settings) in self._done.get(rel_path, ())
+
+    def record(self, rel_path, content_hash, settings=None, **fields):
+        entry = {'path': rel_path, 'hash': content_hash, 'settings': settings, **fields}
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+                if self._file.tell() > 0:
+                    with open(self.path, 'rb') as f:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':
+                            # finish a torn last line so the next record starts on its own
+                            self._file.write('\n')
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._done.setdefault(rel_path, set()).add((content_hash, settings))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,10 +1,18 @@
 import torch
 from transformers import LogitsProcessor
-from transformers.generation.logits_process import _calc_banned_ngram_tokens
-from typing import List, Set
+from typing import Dict, List, Set, Tuple
 
 
 class NoRepeatNGramLogitsProcessor(LogitsProcessor):
+    """
+    Bans any token that would complete an n-gram already seen in the last `window_size` tokens.
+
+    The processor keeps a rolling prefix -> {next_token: count} index for the current
+    sequence, so each decode step only adds the n-gram that entered the window and
+    drops the one that left it instead of rescanning the whole window. vLLM clones
+    logits processors per request (see `clone`); if the same instance is still fed a
+    different sequence, the index is rebuilt from scratch.
+    """
 
     def __init__(self, ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None):
         if not isinstance(ngram_size, int) or ngram_size <= 0:
@@ -14,27 +22,69 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
         self.ngram_size = ngram_size
         self.window_size = window_size
         self.whitelist_token_ids = whitelist_token_ids or set()
-    
+        self._reset()
+
+    def clone(self) -> "NoRepeatNGramLogitsProcessor":
+        return NoRepeatNGramLogitsProcessor(self.ngram_size, self.window_size, set(self.whitelist_token_ids))
+
+    def _reset(self):
+        self._tokens: List[int] = []
+        # n-grams starting at [self._window_start, self._window_end) are indexed
+        self._window_start = 0
+        self._window_end = 0
+        self._index: Dict[Tuple[int, ...], Dict[int, int]] = {}
+
+    def _add_ngram(self, start: int):
+        prefix = tuple(self._tokens[start:start + self.ngram_size - 1])
+        token = self._tokens[start + self.ngram_size - 1]
+        followers = self._index.setdefault(prefix, {})
+        followers[token] = followers.get(token, 0) + 1
+
+    def _remove_ngram(self, start: int):
+        prefix = tuple(self._tokens[start:start + self.ngram_size - 1])
+        token = self._tokens[start + self.ngram_size - 1]
+        followers = self._index[prefix]
+        if followers[token] == 1:
+            del followers[token]
+            if not followers:
+                del self._index[prefix]
+        else:
+            followers[token] -= 1
+
+    def _sync(self, input_ids: List[int]):
+        seen = len(self._tokens)
+        if seen > len(input_ids) or (seen and (input_ids[0] != self._tokens[0] or input_ids[seen - 1] != self._tokens[-1])):
+            # not a continuation of the tracked sequence
+            self._reset()
+            seen = 0
+        self._tokens.extend(input_ids[seen:])
+
+        length = len(self._tokens)
+        window_start = max(0, length - self.window_size)
+        window_end = max(window_start, length - self.ngram_size + 1)
+
+        for start in range(self._window_start, min(window_start, self._window_end)):
+            self._remove_ngram(start)
+        for start in range(max(window_start, self._window_end), window_end):
+            self._add_ngram(start)
+        self._window_start, self._window_end = window_start, window_end
+
+    def _banned_tokens(self, input_ids: List[int]) -> Set[int]:
+        self._sync(input_ids)
+        current_prefix = tuple(self._tokens[len(self._tokens) - self.ngram_size + 1:])
+        followers = self._index.get(current_prefix)
+        if not followers:
+            return set()
+        return followers.keys() - self.whitelist_token_ids
+
     def __call__(self, input_ids: List[int], scores: torch.FloatTensor) -> torch.FloatTensor:
-        if len(input_ids) < self.ngram_size:
+        if len(input_ids) < self.ngram_size or self.ngram_size == 1:
             return scores
-        
-        current_prefix = tuple(input_ids[-(self.ngram_size - 1):])
-        
-        search_start = max(0, len(input_ids) - self.window_size)
-        search_end = len(input_ids) - self.ngram_size + 1
-        
-        banned_tokens = set()
-        for i in range(search_start, search_end):
-            ngram = tuple(input_ids[i:i + self.ngram_size])
-            if ngram[:-1] == current_prefix:
-                banned_tokens.add(ngram[-1])
-        
-        banned_tokens = banned_tokens - self.whitelist_token_ids
-        
+
+        banned_tokens = self._banned_tokens(input_ids)
+
         if banned_tokens:
-            scores = scores.clone()
-            for token in banned_tokens:
-                scores[token] = -float("inf")
-        
-        return scores
\ No newline at end of file
+            banned = torch.tensor(list(banned_tokens), dtype=torch.long, device=scores.device)
+            scores.index_fill_(-1, banned, -float("inf"))
+
+        return scores
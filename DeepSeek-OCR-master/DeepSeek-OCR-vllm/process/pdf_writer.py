@@ -0,0 +1,94 @@
+import io
+
+
+class StreamingImagePDFWriter:
+    """
+    Image-per-page PDF written to disk as pages arrive.
+
+    Each page is JPEG-encoded and embedded as a DCTDecode image XObject straight away, so only
+    the object offsets stay in memory and peak RSS does not grow with the page count (unlike
+    collecting every page for img2pdf.convert). Page size follows the image at `dpi`, as img2pdf
+    does for images without resolution info. The file is created on the first page; close()
+    writes the page tree, xref table and trailer. Use as a context manager, or call close().
+    """
+
+    def __init__(self, path, quality=95, dpi=96):
+        self.path = path
+        self.quality = quality
+        self.dpi = dpi
+        self._file = None
+        # object number -> byte offset; 1 and 2 are reserved for the catalog and the page tree
+        self._offsets = {}
+        self._next_obj = 3
+        self._pages = []
+
+    @property
+    def num_pages(self):
+        return len(self._pages)
+
+    def _begin_obj(self, num=None):
+        if num is None:
+            num = self._next_obj
+            self._next_obj += 1
+        self._offsets[num] = self._file.tell()
+        self._file.write(f'{num} 0 obj\n'.encode('ascii'))
+        return num
+
+    def _write_stream_obj(self, header, data):
+        num = self._begin_obj()
+        self._file.write(f'<< {header}{" " if header else ""}/Length {len(data)} >>\nstream\n'.encode('ascii'))
+        self._file.write(data)
+        self._file.write(b'\nendstream\nendobj\n')
+        return num
+
+    def add_page(self, image):
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+            self._file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=self.quality)
+        width, height = image.size
+
+        image_obj = self._write_stream_obj(
+            f'/Type /XObject /Subtype /Image /Width {width} /Height {height} '
+            f'/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode', buffer.getvalue())
+        del buffer
+
+        page_width = width * 72 / self.dpi
+        page_height = height * 72 / self.dpi
+        content_obj = self._write_stream_obj(
+            '', f'q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q'.encode('ascii'))
+
+        page_obj = self._begin_obj()
+        self._file.write(
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.4f} {page_height:.4f}] '
+            f'/Resources << /XObject << /Im0 {image_obj} 0 R >> >> /Contents {content_obj} 0 R >>\n'
+            f'endobj\n'.encode('ascii'))
+        self._pages.append(page_obj)
+
+    def close(self):
+        if self._file is None:
+            return
+        kids = ' '.join(f'{num} 0 R' for num in self._pages)
+        self._begin_obj(2)
+        self._file.write(f'<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>\nendobj\n'.encode('ascii'))
+        self._begin_obj(1)
+        self._file.write(b'<< /Type /Catalog /Pages 2 0 R >>\nendobj\n')
+
+        xref_offset = self._file.tell()
+        size = self._next_obj
+        self._file.write(f'xref\n0 {size}\n0000000000 65535 f \n'.encode('ascii'))
+        for num in range(1, size):
+            self._file.write(f'{self._offsets[num]:010d} 00000 n \n'.encode('ascii'))
+        self._file.write(f'trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode('ascii'))
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
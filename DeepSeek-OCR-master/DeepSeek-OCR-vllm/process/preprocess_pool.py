@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+from config import NUM_WORKERS, PREPROCESS_BACKEND, PREPROCESS_CACHE_MB
+from process.image_process import DeepseekOCRProcessor
+from process.input_cache import ProcessedInputCache, content_hash, copy_request, get_input_cache
+
+
+# one processor per worker process / thread, built once and reused for every image
+_worker_processor = None
+_thread_local = threading.local()
+
+
+def _init_process_worker(processor_kwargs):
+    global _worker_processor
+    # workers only resize / crop / convert; let them not fight over cores
+    torch.set_num_threads(1)
+    _worker_processor = DeepseekOCRProcessor(**processor_kwargs)
+
+
+def _thread_processor(processor_kwargs):
+    processor = getattr(_thread_local, 'processor', None)
+    if processor is None:
+        processor = DeepseekOCRProcessor(**processor_kwargs)
+        _thread_local.processor = processor
+    return processor
+
+
+def build_request(processor, image, prompt):
+    """vLLM request for one image (tokenized with the processor's mode and the given prompt)"""
+    return {
+        "prompt": prompt,
+        "multi_modal_data": {"image": processor.tokenize_with_images(images = [image], bos=True, eos=True, prompt=prompt)},
+        "mm_processor_kwargs": processor.mm_processor_kwargs,
+    }
+
+
+def _process_worker_request(image, prompt):
+    # tensors in the result go back through torch shared memory (torch.multiprocessing reductions)
+    return build_request(_worker_processor, image, prompt)
+
+
+class PreprocessEngine:
+    """
+    Image -> vLLM request preprocessing on a thread pool or a process pool.
+
+    PIL resize / crop and tensor conversion hold the GIL, so the 'process' backend scales with
+    cores; returned tensors are moved through shared memory instead of being pickled.
+    Images already seen (same pixels, prompt and mode) are served from a ProcessedInputCache:
+    the process-wide one (PREPROCESS_CACHE_MB) by default, or a private one of cache_mb (0 disables).
+    Use as a context manager, or call close().
+    """
+
+    def __init__(self, backend=PREPROCESS_BACKEND, num_workers=NUM_WORKERS, processor_kwargs=None, cache=None,
+                 cache_mb=None):
+        if backend not in ('thread', 'process'):
+            raise ValueError(f"unknown preprocess backend: {backend}")
+        self.backend = backend
+        self.num_workers = num_workers
+        self.processor_kwargs = processor_kwargs or {}
+        if cache_mb == 0:
+            cache = None
+        elif cache is None and cache_mb is not None:
+            cache = ProcessedInputCache(max_mb=cache_mb)
+        elif cache is None and PREPROCESS_CACHE_MB > 0:
+            cache = get_input_cache()
+        self.cache = cache
+
+        if backend == 'process':
+            os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+            # fork is only safe while this process has not touched CUDA
+            method = 'spawn' if torch.cuda.is_initialized() else 'fork'
+            self._executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context(method),
+                                                 initializer=_init_process_worker, initargs=(self.processor_kwargs,))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def _thread_request(self, image, prompt):
+        return build_request(_thread_processor(self.processor_kwargs), image, prompt)
+
+    def submit(self, image, prompt):
+        if self.backend == 'process':
+            return self._executor.submit(_process_worker_request, image, prompt)
+        return self._executor.submit(self._thread_request, image, prompt)
+
+    def map(self, images, prompt, desc="Pre-processed images"):
+        start = time.perf_counter()
+        batch_inputs = [None] * len(images)
+
+        # key -> indices of the images to preprocess; repeats inside the batch are processed once
+        todo = OrderedDict()
+        for idx, image in enumerate(images):
+            key = content_hash(image, prompt, self.processor_kwargs) if self.cache is not None else idx
+            if key in todo:
+                todo[key].append(idx)
+                continue
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                batch_inputs[idx] = cached
+            else:
+                todo[key] = [idx]
+
+        unique = [images[indices[0]] for indices in todo.values()]
+        if self.backend == 'process':
+            results = self._executor.map(_process_worker_request, unique, [prompt] * len(unique),
+                                         chunksize=max(1, len(unique) // (self.num_workers * 4)))
+        else:
+            results = self._executor.map(self._thread_request, unique, [prompt] * len(unique))
+
+        for (key, indices), request in zip(todo.items(), tqdm(results, total=len(unique), desc=desc)):
+            if self.cache is not None:
+                self.cache.put(key, request)
+            for idx in indices:
+                batch_inputs[idx] = copy_request(request)
+
+        elapsed = time.perf_counter() - start
+        if batch_inputs:
+            print(f'preprocess ({self.backend} x {self.num_workers}): {len(batch_inputs)} images '
+                  f'({len(unique)} processed) in {elapsed:.2f}s, {len(batch_inputs) / elapsed:.1f} images/s')
+            if self.cache is not None:
+                print(f'preprocess cache: {self.cache.stats()}')
+        return batch_inputs
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,87 @@
+import torch
+from typing import List, Optional, Tuple
+
+
+class RepetitionLoopDetector:
+    """
+    Online detector for degenerate decoding loops.
+
+    For every candidate period p <= max_period it keeps the length of the current run of
+    tokens with ids[i] == ids[i - p], so each new token costs O(max_period). A loop is
+    reported once the periodic tail covers at least `min_loop_tokens` tokens and repeats
+    the cycle at least `min_repeats` times.
+    """
+
+    def __init__(self, max_period: int = 256, min_loop_tokens: int = 1024, min_repeats: int = 4):
+        if not isinstance(max_period, int) or max_period <= 0:
+            raise ValueError(f"`max_period` has to be a strictly positive integer, but is {max_period}")
+        self.max_period = max_period
+        self.min_loop_tokens = min_loop_tokens
+        self.min_repeats = min_repeats
+        self.reset()
+
+    def reset(self):
+        self._tokens: List[int] = []
+        self._runs = [0] * (self.max_period + 1)
+        self.loop: Optional[Tuple[int, int]] = None
+
+    def push(self, token_id: int) -> Optional[Tuple[int, int]]:
+        """append one token; returns (period, loop_span) once a loop is detected"""
+        tokens = self._tokens
+        tokens.append(token_id)
+        length = len(tokens)
+        runs = self._runs
+        for period in range(1, min(self.max_period, length - 1) + 1):
+            if tokens[-1] == tokens[-1 - period]:
+                runs[period] += 1
+                span = runs[period] + period
+                if self.loop is None and span >= self.min_loop_tokens and span >= period * self.min_repeats:
+                    self.loop = (period, span)
+            else:
+                runs[period] = 0
+        if length > 2 * (self.max_period + 1):
+            # only the last max_period + 1 tokens are ever compared
+            del tokens[:length - self.max_period - 1]
+        return self.loop
+
+    def extend(self, token_ids) -> Optional[Tuple[int, int]]:
+        for token_id in token_ids:
+            self.push(token_id)
+        return self.loop
+
+    def find_loop(self, token_ids) -> Optional[Tuple[int, int]]:
+        """one-off check of a finished sequence"""
+        self.reset()
+        return self.extend(token_ids)
+
+
+class RepetitionStopLogitsProcessor:
+    """
+    vLLM logits processor that ends a sequence as soon as its output falls into a loop,
+    by leaving only the eos token available. The freed slot goes back to the scheduler
+    instead of decoding to max_tokens.
+    """
+
+    def __init__(self, eos_token_id: int, max_period: int = 256, min_loop_tokens: int = 1024, min_repeats: int = 4):
+        self.eos_token_id = eos_token_id
+        self.detector = RepetitionLoopDetector(max_period, min_loop_tokens, min_repeats)
+        self._seen = 0
+
+    def clone(self) -> "RepetitionStopLogitsProcessor":
+        detector = self.detector
+        return RepetitionStopLogitsProcessor(self.eos_token_id, detector.max_period,
+                                             detector.min_loop_tokens, detector.min_repeats)
+
+    def __call__(self, input_ids: List[int], scores: torch.FloatTensor) -> torch.FloatTensor:
+        if len(input_ids) < self._seen:
+            # a new sequence
+            self.detector.reset()
+            self._seen = 0
+        self.detector.extend(input_ids[self._seen:])
+        self._seen = len(input_ids)
+
+        if self.detector.loop is not None:
+            eos_score = scores[self.eos_token_id].clone()
+            scores.fill_(-float("inf"))
+            scores[self.eos_token_id] = eos_score if torch.isfinite(eos_score) else 0.0
+        return scores
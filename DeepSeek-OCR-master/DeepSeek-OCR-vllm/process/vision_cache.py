@@ -0,0 +1,65 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+from config import VISION_CACHE_MB
+
+
+def image_hash_tensor(digest_hex):
+    """128-bit content hash -> [1, 2] int64 tensor that can travel as a multimodal field (zeros = no hash)"""
+    if not digest_hex:
+        return torch.zeros((1, 2), dtype=torch.long)
+    raw = bytes.fromhex(digest_hex)
+    return torch.tensor([[int.from_bytes(raw[:8], 'big', signed=True),
+                          int.from_bytes(raw[8:16], 'big', signed=True)]], dtype=torch.long)
+
+
+class VisionEmbeddingCache:
+    """
+    LRU cache of per-image vision features (SAM + CLIP + projector output, laid out for prefill),
+    keyed by the image content hash from tokenize_with_images, which also covers the resolution mode.
+    Repeated queries on one image (rec / different prompts) skip the vision encoder.
+    """
+
+    def __init__(self, max_mb=VISION_CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            features = self._entries.get(key)
+            if features is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return features
+
+    def put(self, key, features):
+        size = features.numel() * features.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = features
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.numel() * evicted.element_size()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'mb': round(self._bytes / 1024 / 1024, 1),
+                    'hits': self.hits, 'misses': self.misses}
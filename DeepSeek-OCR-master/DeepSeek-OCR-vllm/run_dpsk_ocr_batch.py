@@ -0,0 +1,220 @@
+import os
+import argparse
+import itertools
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from tqdm import tqdm
+import torch
+if torch.version.cuda == '11.8':
+    os.environ["TRITON_PTXAS_PATH"] = "/usr/local/cuda-11.8/bin/ptxas"
+os.environ['VLLM_USE_V1'] = '0'
+os.environ["CUDA_VISIBLE_DEVICES"] = '0'
+
+from config import INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, BASE_SIZE, IMAGE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS
+from config import REPEAT_STOP, LAYOUT_JSONL, PDF_WINDOW, PREPROCESS_STREAM_CACHE_MB
+from process.preprocess_pool import PreprocessEngine
+from process.grounding import MULTI_NEWLINE, parse_grounding, layout_blocks, layout_jsonl
+from process.manifest import BatchManifest, file_hash, settings_hash, parse_shard, in_shard
+# same engine, sampling and page rendering as the single-PDF script
+from run_dpsk_ocr_pdf import Colors, get_llm, get_sampling_params, iter_pdf_pages, loop_detector
+from run_dpsk_ocr_image import load_image
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+PAGE_SPLIT = '\n<--- Page Split --->'
+EOS = '<｜end▁of▁sentence｜>'
+
+# one input file; its content hash is taken right before it is loaded
+BatchItem = namedtuple('BatchItem', ['path', 'rel_path', 'is_pdf'])
+# one rendered page on its way through the engine (the pixels are dropped after preprocessing)
+PageTask = namedtuple('PageTask', ['item', 'content_hash', 'page_idx', 'size', 'is_last'])
+
+
+def discover_inputs(input_dir, shard=(0, 1)):
+    """images and PDFs under input_dir (recursively, sorted) that belong to the shard"""
+    items = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for name in sorted(files):
+            ext = os.path.splitext(name)[1].lower()
+            if ext != '.pdf' and ext not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, input_dir).replace(os.sep, '/')
+            if in_shard(rel_path, shard):
+                items.append(BatchItem(path, rel_path, ext == '.pdf'))
+    return items
+
+
+def iter_page_tasks(items, manifest, settings, on_skip=None):
+    """
+    (PageTask, image) for every page of the unfinished items, loading one file at a time;
+    files that fail to load are reported and left out of the manifest, so the next run retries them.
+    PDFs without pages never reach the engine and are recorded as done straight away.
+    """
+    for item in items:
+        try:
+            content_hash = file_hash(item.path)
+            if manifest.is_done(item.rel_path, content_hash, settings):
+                if on_skip is not None:
+                    on_skip()
+                continue
+            if item.is_pdf:
+                pages = iter_pdf_pages(item.path)
+            else:
+                # exif_transpose like run_dpsk_ocr_image.py, so rotated phone scans come out upright
+                image = load_image(item.path)
+                if image is None:
+                    raise ValueError('unreadable image')
+                pages = iter([image.convert('RGB')])
+            # look one page ahead to flag the last one
+            page = next(pages, None)
+            if page is None:
+                manifest.record(item.rel_path, content_hash, settings, pages=0, degenerate_pages=[],
+                                truncated_pages=[], outputs=[])
+                if on_skip is not None:
+                    on_skip()
+                continue
+            page_idx = 0
+            while page is not None:
+                next_page = next(pages, None)
+                yield PageTask(item, content_hash, page_idx, page.size, next_page is None), page
+                page = next_page
+                page_idx += 1
+        except Exception as e:
+            tqdm.write(f'{Colors.RED}{item.rel_path}: failed to load ({e}){Colors.RESET}')
+
+
+def prepare_window(page_tasks, size, preprocess_engine, prompt):
+    # load + preprocess the next window: (tasks, batch_inputs), or None when the corpus is done
+    window = list(itertools.islice(page_tasks, size or None))
+    if not window:
+        return None
+    tasks, images = zip(*window)
+    return tasks, preprocess_engine.map(images, prompt, desc='Pre-processed pages')
+
+
+def write_atomic(path, text):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as afile:
+        afile.write(text)
+    os.replace(tmp_path, path)
+
+
+def finish_item(output_dir, item, pages):
+    """
+    write the outputs of a finished item next to its mirrored path; returns them relative to output_dir.
+    Names keep the source extension (a.png -> a.png.md), so a.png, a.jpg and a.pdf never overwrite each other
+    """
+    base = item.rel_path
+    os.makedirs(os.path.join(output_dir, os.path.dirname(base)), exist_ok=True)
+    ext = '.mmd' if item.is_pdf else '.md'
+    outputs = {
+        f'{base}_det{ext}': ''.join(page['det'] + f'\n{PAGE_SPLIT}\n' for page in pages) if item.is_pdf else pages[0]['det'],
+        f'{base}{ext}': ''.join(page['text'] + f'\n{PAGE_SPLIT}\n' for page in pages) if item.is_pdf else pages[0]['text'],
+    }
+    if LAYOUT_JSONL:
+        outputs[f'{base}_layout.jsonl'] = ''.join(page['layout'] for page in pages)
+    for rel_output, text in outputs.items():
+        write_atomic(os.path.join(output_dir, rel_output), text)
+    return list(outputs)
+
+
+def postprocess_page(task, output):
+    content = output.outputs[0].text
+    degenerate = REPEAT_STOP and loop_detector.find_loop(output.outputs[0].token_ids) is not None
+    if degenerate:
+        period, span = loop_detector.loop
+        tqdm.write(f'{Colors.YELLOW}{task.item.rel_path} page {task.page_idx}: degenerate output '
+                   f'(cycle of {period} tokens over {span} tokens){Colors.RESET}')
+    # no eos: decoding hit max_tokens without the loop detector firing
+    truncated = EOS not in content
+    if truncated:
+        tqdm.write(f'{Colors.YELLOW}{task.item.rel_path} page {task.page_idx}: truncated output (no eos){Colors.RESET}')
+    if SKIP_REPEAT and (degenerate or truncated):
+        # run_dpsk_ocr_pdf.py drops such pages; here they stay as empty pages, so page indices in the
+        # outputs and in the manifest keep matching the source
+        return {'det': '', 'text': '', 'layout': '', 'degenerate': degenerate, 'truncated': truncated}
+    content = content.replace(EOS, '')
+
+    text, refs = parse_grounding(content)
+    layout = layout_jsonl(layout_blocks(text, refs, *task.size), page=task.page_idx + 1) if LAYOUT_JSONL else ''
+    text = text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+    text = MULTI_NEWLINE.sub('\n\n', text)
+    return {'det': content, 'text': text, 'layout': layout, 'degenerate': degenerate, 'truncated': truncated}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OCR every image and PDF under a directory; resumable through a manifest')
+    parser.add_argument('--input', default=INPUT_PATH, help='directory of images / PDFs (default: config.INPUT_PATH)')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='output directory, mirrors the input tree (default: config.OUTPUT_PATH)')
+    parser.add_argument('--shard', default='0/1', help="i/n: only process the i-th (0-based) of n disjoint parts of the corpus")
+    args = parser.parse_args()
+    try:
+        shard = parse_shard(args.shard)
+    except ValueError as e:
+        parser.error(str(e))
+
+    os.makedirs(args.output, exist_ok=True)
+    prompt = PROMPT
+    settings = settings_hash(prompt=prompt, base_size=BASE_SIZE, image_size=IMAGE_SIZE, crop_mode=CROP_MODE,
+                             min_crops=MIN_CROPS, max_crops=MAX_CROPS, skip_repeat=SKIP_REPEAT)
+
+    print(f'{Colors.RED}scanning {args.input} (shard {shard[0]}/{shard[1]}).....{Colors.RESET}')
+    items = discover_inputs(args.input, shard)
+
+    with ExitStack() as stack:
+        manifest = stack.enter_context(BatchManifest(args.output, shard))
+        print(f'{len(items)} inputs in shard, {len(manifest)} recorded as finished by earlier runs')
+
+        # repeated pages (cover sheets, letterheads, the same scan in two files) skip preprocessing;
+        # the cache is byte-bounded, so memory stays at its cap however large the corpus is
+        preprocess_engine = stack.enter_context(PreprocessEngine(cache_mb=PREPROCESS_STREAM_CACHE_MB))
+        progress = stack.enter_context(tqdm(total=len(items), desc='OCR inputs'))
+        # inputs already in the manifest are only noticed once their turn comes (after hashing)
+        page_tasks = iter_page_tasks(items, manifest, settings, on_skip=progress.update)
+        # first window in the main thread: preprocess workers are forked before vLLM touches CUDA
+        window = prepare_window(page_tasks, PDF_WINDOW, preprocess_engine, prompt)
+        prefetch = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+
+        # rel path -> results of the pages done so far (a PDF can span several windows)
+        pending = {}
+        num_done = 0
+        start = time.perf_counter()
+        while window is not None:
+            tasks, batch_inputs = window
+            next_window = prefetch.submit(prepare_window, page_tasks, PDF_WINDOW, preprocess_engine, prompt)
+
+            outputs_list = get_llm().generate(
+                batch_inputs,
+                sampling_params=get_sampling_params(),
+                use_tqdm=False
+            )
+            del batch_inputs
+
+            for task, output in zip(tasks, outputs_list):
+                pages = pending.setdefault(task.item.rel_path, [])
+                pages.append(postprocess_page(task, output))
+                if not task.is_last:
+                    continue
+                del pending[task.item.rel_path]
+                # outputs first, then the manifest line: a crash in between only redoes this item
+                outputs = finish_item(args.output, task.item, pages)
+                manifest.record(task.item.rel_path, task.content_hash, settings, pages=len(pages),
+                                degenerate_pages=[idx for idx, page in enumerate(pages) if page['degenerate']],
+                                truncated_pages=[idx for idx, page in enumerate(pages) if page['truncated']],
+                                outputs=outputs)
+                num_done += 1
+                progress.update(1)
+
+            del outputs_list, tasks
+            window = next_window.result()
+
+    print(f'{Colors.GREEN}{num_done} inputs done in {time.perf_counter() - start:.1f}s; '
+          f'manifest: {manifest.path}{Colors.RESET}')
+
+
+if __name__ == "__main__":
+    main()
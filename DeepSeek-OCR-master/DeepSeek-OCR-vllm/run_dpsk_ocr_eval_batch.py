@@ -7,41 +7,59 @@ if torch.version.cuda == '11.8':
 os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS
-from concurrent.futures import ThreadPoolExecutor
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS, get_tokenizer
+from config import REPEAT_STOP, REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES
+from functools import lru_cache
 import glob
 from PIL import Image
-from deepseek_ocr import DeepseekOCRForCausalLM
 
-from vllm.model_executor.models.registry import ModelRegistry
-
-from vllm import LLM, SamplingParams
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+from process.repeat_stop import RepetitionLoopDetector, RepetitionStopLogitsProcessor
+from process.preprocess_pool import PreprocessEngine
+from process.grounding import MULTI_NEWLINE, parse_grounding
 from process.image_process import DeepseekOCRProcessor
-ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
-
-
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
-    swap_space=0,
-    max_num_seqs = MAX_CONCURRENCY,
-    tensor_parallel_size=1,
-    gpu_memory_utilization=0.9,
-)
-
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=40, window_size=90, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
-
-sampling_params = SamplingParams(
-    temperature=0.0,
-    max_tokens=8192,
-    logits_processors=logits_processors,
-    skip_special_tokens=False,
-)
+
+
+@lru_cache(maxsize=None)
+def get_llm():
+    # built on first use so that importing this module (e.g. for clean_formula) stays cheap
+    from vllm import LLM
+    from vllm.model_executor.models.registry import ModelRegistry
+    from deepseek_ocr import DeepseekOCRForCausalLM
+
+    ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+
+    return LLM(
+        model=MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True, 
+        max_model_len=8192,
+        swap_space=0,
+        max_num_seqs = MAX_CONCURRENCY,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=0.9,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_sampling_params():
+    from vllm import SamplingParams
+
+    logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=40, window_size=90, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+    if REPEAT_STOP:
+        logits_processors.append(RepetitionStopLogitsProcessor(get_tokenizer().eos_token_id, REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES))
+
+    return SamplingParams(
+        temperature=0.0,
+        max_tokens=8192,
+        logits_processors=logits_processors,
+        skip_special_tokens=False,
+    )
+
+
+loop_detector = RepetitionLoopDetector(REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES)
 
 class Colors:
     RED = '\033[31m'
@@ -67,27 +85,6 @@ def clean_formula(text):
     
     return cleaned_text
 
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    # mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        mathes_other.append(a_match[0])
-    return matches, mathes_other
-
-def process_single_image(image):
-    """single image"""
-    prompt_in = prompt
-    cache_item = {
-        "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
-    }
-    return cache_item
-
-
 if __name__ == "__main__":
 
     # INPUT_PATH = OmniDocBench images path
@@ -122,19 +119,15 @@ if __name__ == "__main__":
     #     ]
     #     batch_inputs.extend(cache_list)
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
+    with PreprocessEngine() as preprocess_engine:
+        batch_inputs = preprocess_engine.map(images, prompt)
 
 
     
 
-    outputs_list = llm.generate(
+    outputs_list = get_llm().generate(
         batch_inputs,
-        sampling_params=sampling_params
+        sampling_params=get_sampling_params()
     )
 
 
@@ -147,13 +140,16 @@ if __name__ == "__main__":
         content = output.outputs[0].text
         mmd_det_path = output_path + image.split('/')[-1].replace('.jpg', '_det.md')
 
+        if REPEAT_STOP and loop_detector.find_loop(output.outputs[0].token_ids) is not None:
+            print(f'{Colors.YELLOW}{image}: degenerate output, stopped early (cycle of {loop_detector.loop[0]} tokens){Colors.RESET}')
+
         with open(mmd_det_path, 'w', encoding='utf-8') as afile:
             afile.write(content)
 
         content = clean_formula(content)
-        matches_ref, mathes_other = re_match(content)
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            content = content.replace(a_match_other, '').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n').replace('<center>', '').replace('</center>', '')
+        # drop every grounding span (image refs included) in one pass
+        content, _ = parse_grounding(content)
+        content = MULTI_NEWLINE.sub('\n\n', content).replace('<center>', '').replace('</center>', '')
         
         mmd_path = output_path + image.split('/')[-1].replace('.jpg', '.md')
 
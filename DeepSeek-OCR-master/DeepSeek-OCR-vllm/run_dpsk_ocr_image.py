@@ -1,5 +1,4 @@
 import asyncio
-import re
 import os
 
 import torch
@@ -9,22 +8,20 @@ if torch.version.cuda == '11.8':
 os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
-from vllm import AsyncLLMEngine, SamplingParams
-from vllm.engine.arg_utils import AsyncEngineArgs
-from vllm.model_executor.models.registry import ModelRegistry
 import time
-from deepseek_ocr import DeepseekOCRForCausalLM
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import numpy as np
 from tqdm import tqdm
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+from process.repeat_stop import RepetitionLoopDetector, RepetitionStopLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE
+from process.grounding import GroundingParser, layout_blocks, layout_jsonl
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE, get_tokenizer
+from config import REPEAT_STOP, REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES, LAYOUT_JSONL, RENDER_LAYOUTS
 
 
 
-ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
-
 def load_image(image_path):
 
     try:
@@ -42,32 +39,23 @@ def load_image(image_path):
             return None
 
 
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
-
-
-def extract_coordinates_and_label(ref_text, image_width, image_height):
-
-
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
-        return None
-
-    return (label_type, cor_list)
+def save_image_crops(image, refs):
+    # crops behind the markdown image links; cheap compared to drawing the whole page
+    image_width, image_height = image.size
+    img_idx = 0
+    for ref in refs:
+        if ref.label != 'image' or ref.boxes is None:
+            continue
+        for x1, y1, x2, y2 in ref.boxes:
+            x1 = int(x1 / 999 * image_width)
+            y1 = int(y1 / 999 * image_height)
+            x2 = int(x2 / 999 * image_width)
+            y2 = int(y2 / 999 * image_height)
+            try:
+                image.crop((x1, y1, x2, y2)).save(f"{OUTPUT_PATH}/images/{img_idx}.jpg")
+            except Exception as e:
+                print(e)
+            img_idx += 1
 
 
 def draw_bounding_boxes(image, refs):
@@ -82,13 +70,10 @@ def draw_bounding_boxes(image, refs):
     #     except IOError:
     font = ImageFont.load_default()
 
-    img_idx = 0
-    
     for i, ref in enumerate(refs):
         try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if result:
-                label_type, points_list = result
+            if ref.boxes is not None:
+                label_type, points_list = ref.label, ref.boxes
                 
                 color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
 
@@ -102,15 +87,6 @@ def draw_bounding_boxes(image, refs):
                     x2 = int(x2 / 999 * image_width)
                     y2 = int(y2 / 999 * image_height)
 
-                    if label_type == 'image':
-                        try:
-                            cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{img_idx}.jpg")
-                        except Exception as e:
-                            print(e)
-                            pass
-                        img_idx += 1
-                        
                     try:
                         if label_type == 'title':
                             draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
@@ -144,8 +120,15 @@ def process_image_with_refs(image, ref_texts):
 
 
 
-async def stream_generate(image=None, prompt=''):
+@lru_cache(maxsize=None)
+def get_engine():
+    # built on first use so that importing this module (e.g. for re_match) stays cheap
+    from vllm import AsyncLLMEngine
+    from vllm.engine.arg_utils import AsyncEngineArgs
+    from vllm.model_executor.models.registry import ModelRegistry
+    from deepseek_ocr import DeepseekOCRForCausalLM
 
+    ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
     engine_args = AsyncEngineArgs(
         model=MODEL_PATH,
@@ -157,9 +140,17 @@ async def stream_generate(image=None, prompt=''):
         tensor_parallel_size=1,
         gpu_memory_utilization=0.75,
     )
-    engine = AsyncLLMEngine.from_engine_args(engine_args)
+    return AsyncLLMEngine.from_engine_args(engine_args)
+
+
+async def stream_generate(image=None, prompt='', mm_processor_kwargs=None, grounding_parser=None):
+    from vllm import SamplingParams
+
+    engine = get_engine()
     
     logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td> 
+    if REPEAT_STOP:
+        logits_processors.append(RepetitionStopLogitsProcessor(get_tokenizer().eos_token_id, REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES))
 
     sampling_params = SamplingParams(
         temperature=0.0,
@@ -177,7 +168,8 @@ async def stream_generate(image=None, prompt=''):
     if image and '<image>' in prompt:
         request = {
             "prompt": prompt,
-            "multi_modal_data": {"image": image}
+            "multi_modal_data": {"image": image},
+            "mm_processor_kwargs": mm_processor_kwargs or {},
         }
     elif prompt:
         request = {
@@ -192,10 +184,19 @@ async def stream_generate(image=None, prompt=''):
             full_text = request_output.outputs[0].text
             new_text = full_text[printed_length:]
             print(new_text, end='', flush=True)
+            if grounding_parser is not None:
+                grounding_parser.feed(new_text)
             printed_length = len(full_text)
             final_output = full_text
+            final_token_ids = request_output.outputs[0].token_ids
     print('\n') 
 
+    if REPEAT_STOP:
+        # the engine runs a per-request clone of the processor, so re-check the finished output
+        loop = RepetitionLoopDetector(REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES).find_loop(final_token_ids)
+        if loop is not None:
+            print(f'degenerate output: stopped early after a cycle of {loop[0]} tokens')
+
     return final_output
 
 
@@ -209,15 +210,19 @@ if __name__ == "__main__":
     image = load_image(INPUT_PATH).convert('RGB')
 
     
+    processor = DeepseekOCRProcessor()
+
     if '<image>' in PROMPT:
 
-        image_features = DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
+        image_features = processor.tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE, prompt=PROMPT)
     else:
         image_features = ''
 
     prompt = PROMPT
 
-    result_out = asyncio.run(stream_generate(image_features, prompt))
+    # parses <|ref|>/<|det|> spans while the text streams in
+    grounding_parser = GroundingParser(image_link='images/{idx}.jpg')
+    result_out = asyncio.run(stream_generate(image_features, prompt, processor.mm_processor_kwargs, grounding_parser))
 
 
     save_results = 1
@@ -225,23 +230,19 @@ if __name__ == "__main__":
     if save_results and '<image>' in prompt:
         print('='*15 + 'save results:' + '='*15)
 
-        image_draw = image.copy()
-
         outputs = result_out
 
         with open(f'{OUTPUT_PATH}/result_ori.mmd', 'w', encoding = 'utf-8') as afile:
             afile.write(outputs)
 
-        matches_ref, matches_images, mathes_other = re_match(outputs)
-        # print(matches_ref)
-        result = process_image_with_refs(image_draw, matches_ref)
-
-
-        for idx, a_match_image in enumerate(tqdm(matches_images, desc="image")):
-            outputs = outputs.replace(a_match_image, f'![](images/' + str(idx) + '.jpg)\n')
+        # the parser already consumed the stream; only the tail is left
+        grounding_parser.close()
+        save_image_crops(image, grounding_parser.refs)
+        if LAYOUT_JSONL:
+            with open(f'{OUTPUT_PATH}/result_layout.jsonl', 'w', encoding = 'utf-8') as afile:
+                afile.write(layout_jsonl(layout_blocks(grounding_parser.text, grounding_parser.refs, *image.size)))
 
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            outputs = outputs.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+        outputs = grounding_parser.text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
 
         # if 'structural formula' in conversation[0]['content']:
         #     outputs = '<smiles>' + outputs + '</smiles>'
@@ -300,4 +301,5 @@ if __name__ == "__main__":
             plt.savefig(f'{OUTPUT_PATH}/geo.jpg')
             plt.close()
 
-        result.save(f'{OUTPUT_PATH}/result_with_boxes.jpg')
+        if RENDER_LAYOUTS:
+            process_image_with_refs(image.copy(), grounding_parser.refs).save(f'{OUTPUT_PATH}/result_with_boxes.jpg')
@@ -1,11 +1,13 @@
 import os
 import fitz
-import img2pdf
 import io
-import re
+import itertools
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from tqdm import tqdm
 import torch
-from concurrent.futures import ThreadPoolExecutor
  
 
 if torch.version.cuda == '11.8':
@@ -14,44 +16,64 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE, BASE_SIZE, IMAGE_SIZE, get_tokenizer
+from config import REPEAT_STOP, REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES, LAYOUT_JSONL, RENDER_LAYOUTS, PDF_WINDOW
+from config import PREPROCESS_STREAM_CACHE_MB
 
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
-from deepseek_ocr import DeepseekOCRForCausalLM
 
-from vllm.model_executor.models.registry import ModelRegistry
-
-from vllm import LLM, SamplingParams
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.repeat_stop import RepetitionLoopDetector, RepetitionStopLogitsProcessor
+from process.preprocess_pool import PreprocessEngine
+from process.grounding import MULTI_NEWLINE, parse_grounding, layout_blocks, layout_jsonl
+from process.pdf_writer import StreamingImagePDFWriter
+from process.image_process import DeepseekOCRProcessor, count_tiles
+
+
+@lru_cache(maxsize=None)
+def get_llm():
+    # built on first use so that importing this module (e.g. for re_match) stays cheap
+    from vllm import LLM
+    from vllm.model_executor.models.registry import ModelRegistry
+    from deepseek_ocr import DeepseekOCRForCausalLM
+
+    ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+
+    return LLM(
+        model=MODEL_PATH,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        enforce_eager=False,
+        trust_remote_code=True, 
+        max_model_len=8192,
+        swap_space=0,
+        max_num_seqs=MAX_CONCURRENCY,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=0.9,
+        disable_mm_preprocessor_cache=True
+    )
 
-ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
+@lru_cache(maxsize=None)
+def get_sampling_params():
+    from vllm import SamplingParams
 
-llm = LLM(
-    model=MODEL_PATH,
-    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
-    block_size=256,
-    enforce_eager=False,
-    trust_remote_code=True, 
-    max_model_len=8192,
-    swap_space=0,
-    max_num_seqs=MAX_CONCURRENCY,
-    tensor_parallel_size=1,
-    gpu_memory_utilization=0.9,
-    disable_mm_preprocessor_cache=True
-)
+    logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+    if REPEAT_STOP:
+        logits_processors.append(RepetitionStopLogitsProcessor(get_tokenizer().eos_token_id, REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES))
+
+    return SamplingParams(
+        temperature=0.0,
+        max_tokens=8192,
+        logits_processors=logits_processors,
+        skip_special_tokens=False,
+        include_stop_str_in_output=True,
+    )
 
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
 
-sampling_params = SamplingParams(
-    temperature=0.0,
-    max_tokens=8192,
-    logits_processors=logits_processors,
-    skip_special_tokens=False,
-    include_stop_str_in_output=True,
-)
+loop_detector = RepetitionLoopDetector(REPEAT_MAX_PERIOD, REPEAT_MIN_TOKENS, REPEAT_MIN_CYCLES)
 
 
 class Colors:
@@ -61,91 +83,165 @@ class Colors:
     BLUE = '\033[34m'
     RESET = '\033[0m' 
 
-def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
+def mode_render_zoom(page_width, page_height, max_dpi=600):
     """
-    pdf2images
+    smallest zoom that still gives the preprocessor every pixel it uses for the
+    configured BASE_SIZE / IMAGE_SIZE / CROP_MODE
+    """
+    if not CROP_MODE and IMAGE_SIZE <= 640:
+        # resized straight to IMAGE_SIZE x IMAGE_SIZE
+        scale = IMAGE_SIZE / min(page_width, page_height)
+    else:
+        # global view: long side padded to BASE_SIZE
+        scale = BASE_SIZE / max(page_width, page_height)
+
+    if CROP_MODE:
+        # ties between grids of the same aspect ratio are broken by area, so the grid has to come from
+        # the rendered pixel size, not the page size in points; a larger grid only grows the render,
+        # so recompute until it stops changing (pages that end up <= 640 px are not cropped)
+        grid = None
+        while True:
+            render_width, render_height = math.ceil(page_width * scale), math.ceil(page_height * scale)
+            if render_width <= 640 and render_height <= 640:
+                break
+            new_grid = count_tiles(render_width, render_height, image_size=IMAGE_SIZE)
+            if new_grid == grid:
+                break
+            grid = new_grid
+            scale = max(scale, IMAGE_SIZE * grid[0] / page_width, IMAGE_SIZE * grid[1] / page_height)
+
+    zoom = max((math.ceil(page_width * scale) + 0.5) / page_width,
+               (math.ceil(page_height * scale) + 0.5) / page_height)
+    return min(zoom, max_dpi / 72.0)
+
+
+def iter_pdf_pages(pdf_path, dpi=None, image_format="PNG"):
+    """
+    pdf2images, one page at a time; dpi=None renders each page at the resolution the current mode needs
     """
-    images = []
-    
     pdf_document = fitz.open(pdf_path)
     
-    zoom = dpi / 72.0
-    matrix = fitz.Matrix(zoom, zoom)
-    
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
-
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
-
-        if image_format.upper() == "PNG":
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-        else:
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-        
-        images.append(img)
-    
-    pdf_document.close()
-    return images
-
-def pil_to_pdf_img2pdf(pil_images, output_path):
-
-    if not pil_images:
-        return
-    
-    image_bytes_list = []
-    
-    for img in pil_images:
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='JPEG', quality=95)
-        img_bytes = img_buffer.getvalue()
-        image_bytes_list.append(img_bytes)
-    
     try:
-        pdf_bytes = img2pdf.convert(image_bytes_list)
-        with open(output_path, "wb") as f:
-            f.write(pdf_bytes)
+        for page_num in range(pdf_document.page_count):
+            page = pdf_document[page_num]
+
+            if dpi is None:
+                zoom = mode_render_zoom(page.rect.width, page.rect.height)
+            else:
+                zoom = dpi / 72.0
+            matrix = fitz.Matrix(zoom, zoom)
+
+            pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+            Image.MAX_IMAGE_PIXELS = None
+
+            if image_format.upper() == "PNG":
+                img_data = pixmap.tobytes("png")
+                img = Image.open(io.BytesIO(img_data))
+            else:
+                img_data = pixmap.tobytes("png")
+                img = Image.open(io.BytesIO(img_data))
+                if img.mode in ('RGBA', 'LA'):
+                    background = Image.new('RGB', img.size, (255, 255, 255))
+                    background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+                    img = background
+            
+            yield img
+    finally:
+        pdf_document.close()
+
+
+def pdf_to_images_high_quality(pdf_path, dpi=None, image_format="PNG"):
+    """
+    pdf2images; every page is held in memory, iter_pdf_pages streams them instead
+    """
+    return list(iter_pdf_pages(pdf_path, dpi=dpi, image_format=image_format))
 
-    except Exception as e:
-        print(f"error: {e}")
 
+def pdf_windows(pdf_path, size):
+    # lists of up to `size` rendered pages; size 0 = the whole document
+    pages = iter_pdf_pages(pdf_path)
+    while True:
+        window = list(itertools.islice(pages, size or None))
+        if not window:
+            return
+        yield window
 
 
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
+def prepare_window(windows, preprocess_engine, prompt):
+    # render + preprocess the next window: (images, batch_inputs), or None when the document is done
+    images = next(windows, None)
+    if images is None:
+        return None
+    return images, preprocess_engine.map(images, prompt)
 
 
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
+def generate_in_order(windows, preprocess_engine, prompt, prefetch, max_in_flight=MAX_CONCURRENCY):
+    """
+    (image, output) for every page in document order.
 
+    Pages are added to the engine one request at a time and topped up to max_in_flight as
+    requests finish, so the running batch does not drain at window boundaries; the next window
+    is rendered and preprocessed in the background once fewer than max_in_flight pages wait.
+    A page is yielded as soon as it and every page before it have finished.
+    """
+    # first window in the main thread: preprocess workers are forked before vLLM touches CUDA
+    window = prepare_window(windows, preprocess_engine, prompt)
+    llm_engine = get_llm().llm_engine
+    sampling_params = get_sampling_params()
+
+    ready = deque()  # (page idx, image, request) preprocessed, not yet in the engine
+    in_flight = {}  # request id -> (page idx, image)
+    finished = {}  # page idx -> (image, output), waiting for an earlier page
+    num_pages = 0
+    next_page = 0
+    next_window = None
+    while True:
+        if window is not None:
+            for image, request in zip(*window):
+                ready.append((num_pages, image, request))
+                num_pages += 1
+            window = None
+            next_window = prefetch.submit(prepare_window, windows, preprocess_engine, prompt)
+
+        while ready and len(in_flight) < max_in_flight:
+            page_idx, image, request = ready.popleft()
+            llm_engine.add_request(str(page_idx), request, sampling_params)
+            in_flight[str(page_idx)] = (page_idx, image)
+
+        if next_window is not None and len(ready) < max_in_flight and (next_window.done() or not in_flight):
+            # only waits on the prefetch when the engine has nothing left to run
+            window = next_window.result()
+            next_window = None
+            continue
+        if not in_flight:
+            return
 
-def extract_coordinates_and_label(ref_text, image_width, image_height):
+        for output in llm_engine.step():
+            if output.finished:
+                page_idx, image = in_flight.pop(output.request_id)
+                finished[page_idx] = (image, output)
+        while next_page in finished:
+            yield finished.pop(next_page)
+            next_page += 1
 
 
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
-        return None
-
-    return (label_type, cor_list)
+def save_image_crops(image, refs, jdx):
+    # crops behind the markdown image links; cheap compared to drawing the whole page
+    image_width, image_height = image.size
+    img_idx = 0
+    for ref in refs:
+        if ref.label != 'image' or ref.boxes is None:
+            continue
+        for x1, y1, x2, y2 in ref.boxes:
+            x1 = int(x1 / 999 * image_width)
+            y1 = int(y1 / 999 * image_height)
+            x2 = int(x2 / 999 * image_width)
+            y2 = int(y2 / 999 * image_height)
+            try:
+                image.crop((x1, y1, x2, y2)).save(f"{OUTPUT_PATH}/images/{jdx}_{img_idx}.jpg")
+            except Exception as e:
+                print(e)
+            img_idx += 1
 
 
 def draw_bounding_boxes(image, refs, jdx):
@@ -160,13 +256,10 @@ def draw_bounding_boxes(image, refs, jdx):
     #     except IOError:
     font = ImageFont.load_default()
 
-    img_idx = 0
-    
     for i, ref in enumerate(refs):
         try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if result:
-                label_type, points_list = result
+            if ref.boxes is not None:
+                label_type, points_list = ref.label, ref.boxes
                 
                 color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
 
@@ -180,15 +273,6 @@ def draw_bounding_boxes(image, refs, jdx):
                     x2 = int(x2 / 999 * image_width)
                     y2 = int(y2 / 999 * image_height)
 
-                    if label_type == 'image':
-                        try:
-                            cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{jdx}_{img_idx}.jpg")
-                        except Exception as e:
-                            print(e)
-                            pass
-                        img_idx += 1
-                        
                     try:
                         if label_type == 'title':
                             draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
@@ -220,16 +304,6 @@ def process_image_with_refs(image, ref_texts, jdx):
     return result_image
 
 
-def process_single_image(image):
-    """single image"""
-    prompt_in = prompt
-    cache_item = {
-        "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
-    }
-    return cache_item
-
-
 if __name__ == "__main__":
 
     os.makedirs(OUTPUT_PATH, exist_ok=True)
@@ -237,39 +311,12 @@ if __name__ == "__main__":
     
     print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
 
-
-    images = pdf_to_images_high_quality(INPUT_PATH)
+    with fitz.open(INPUT_PATH) as pdf_document:
+        num_pages = pdf_document.page_count
 
 
     prompt = PROMPT
 
-    # batch_inputs = []
-
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
-
-
-    # for image in tqdm(images):
-
-    #     prompt_in = prompt
-    #     cache_list = [
-    #         {
-    #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
-    #         }
-    #     ]
-    #     batch_inputs.extend(cache_list)
-
-
-    outputs_list = llm.generate(
-        batch_inputs,
-        sampling_params=sampling_params
-    )
-
 
     output_path = OUTPUT_PATH
 
@@ -279,52 +326,68 @@ if __name__ == "__main__":
     mmd_det_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_det.mmd')
     mmd_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('pdf', 'mmd')
     pdf_out_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_layouts.pdf')
-    contents_det = ''
-    contents = ''
-    draw_images = []
-    jdx = 0
-    for output, img in zip(outputs_list, images):
-        content = output.outputs[0].text
-
-        if '<｜end▁of▁sentence｜>' in content: # repeat no eos
-            content = content.replace('<｜end▁of▁sentence｜>', '')
-        else:
-            if SKIP_REPEAT:
-                continue
-
-        
-        page_num = f'\n<--- Page Split --->'
-
-        contents_det += content + f'\n{page_num}\n'
-
-        image_draw = img.copy()
-
-        matches_ref, matches_images, mathes_other = re_match(content)
-        # print(matches_ref)
-        result_image = process_image_with_refs(image_draw, matches_ref, jdx)
-
-
-        draw_images.append(result_image)
-
-
-        for idx, a_match_image in enumerate(matches_images):
-            content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
-
-        for idx, a_match_other in enumerate(mathes_other):
-            content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
-
-
-        contents += content + f'\n{page_num}\n'
-
-
-        jdx += 1
-
-    with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents_det)
-
-    with open(mmd_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents)
-
-
-    pil_to_pdf_img2pdf(draw_images, pdf_out_path)
-
+    layout_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_layout.jsonl')
+
+    # pages are rendered and preprocessed PDF_WINDOW at a time in the background while the engine keeps
+    # up to MAX_CONCURRENCY pages running; each page is written as soon as it and the pages before it are done,
+    # so only the pages in flight and about one window of waiting pages are resident
+    with ExitStack() as stack:
+        # byte-bounded cache: repeated pages within the document skip preprocessing
+        preprocess_engine = stack.enter_context(PreprocessEngine(cache_mb=PREPROCESS_STREAM_CACHE_MB))
+        det_file = stack.enter_context(open(mmd_det_path, 'w', encoding='utf-8'))
+        mmd_file = stack.enter_context(open(mmd_path, 'w', encoding='utf-8'))
+        layout_file = stack.enter_context(open(layout_path, 'w', encoding='utf-8')) if LAYOUT_JSONL else None
+        # annotated pages go to disk as they are drawn instead of being collected for one big convert
+        layout_pdf = stack.enter_context(StreamingImagePDFWriter(pdf_out_path)) if RENDER_LAYOUTS else None
+
+        prefetch = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        progress = stack.enter_context(tqdm(total=num_pages, desc='OCR pages'))
+        pages = generate_in_order(pdf_windows(INPUT_PATH, PDF_WINDOW), preprocess_engine, prompt, prefetch)
+
+        page_idx = 0
+        jdx = 0
+        for img, output in pages:
+            page_idx += 1
+            progress.update(1)
+            content = output.outputs[0].text
+
+            if REPEAT_STOP and loop_detector.find_loop(output.outputs[0].token_ids) is not None:
+                # stopped early by RepetitionStopLogitsProcessor: degenerate page
+                period, span = loop_detector.loop
+                tqdm.write(f'{Colors.YELLOW}page {page_idx - 1}: degenerate output (cycle of {period} tokens over {span} tokens){Colors.RESET}')
+                if SKIP_REPEAT:
+                    continue
+                content = content.replace('<｜end▁of▁sentence｜>', '')
+            elif '<｜end▁of▁sentence｜>' in content: # repeat no eos
+                content = content.replace('<｜end▁of▁sentence｜>', '')
+            else:
+                if SKIP_REPEAT:
+                    continue
+
+            
+            page_num = f'\n<--- Page Split --->'
+
+            det_file.write(content + f'\n{page_num}\n')
+
+            # one pass: clean markdown (image refs -> links to the crops) + labeled boxes
+            content, refs = parse_grounding(content, image_link=f'images/{jdx}_{{idx}}.jpg')
+            save_image_crops(img, refs, jdx)
+            if layout_file is not None:
+                layout_file.write(layout_jsonl(layout_blocks(content, refs, *img.size), page=page_idx))
+
+            if layout_pdf is not None:
+                layout_pdf.add_page(process_image_with_refs(img.copy(), refs, jdx))
+
+
+            content = content.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+            content = MULTI_NEWLINE.sub('\n\n', content)
+
+
+            mmd_file.write(content + f'\n{page_num}\n')
+
+
+            jdx += 1
+
+            for afile in (det_file, mmd_file, layout_file):
+                if afile is not None:
+                    afile.flush()
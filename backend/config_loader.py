@@ -82,7 +82,8 @@ class ConfigLoader:
             'host': self.get('service.host', '0.0.0.0'),
             'port': self.get('service.port', 8000),
             'upload': self.get('service.upload', {}),
-            'timeout': self.get('service.timeout', {})
+            'timeout': self.get('service.timeout', {}),
+            'scheduler': self.get('service.scheduler', {})
         }
 
 # 全局配置实例
@@ -0,0 +1,210 @@
+"""版面结构化输出：从 grounding 输出（<|ref|>标签<|/ref|><|det|>[[x1, y1, x2, y2]]<|/det|>）
+解析出干净的 markdown 与按阅读顺序排列的版面块，写出 JSON Lines，并按需渲染带框标注图"""
+import json
+import os
+import re
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+# grounding 片段的标记；坐标为 0..999 的归一化整数
+REF_OPEN, REF_CLOSE = "<|ref|>", "<|/ref|>"
+DET_OPEN, DET_CLOSE = "<|det|>", "<|/det|>"
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+COORD_SCALE = 999
+# 每页保存的框数据与按需渲染的标注图文件名
+BOXES_FILE = "boxes.json"
+BOXES_IMAGE_FILE = "result_with_boxes.jpg"
+
+
+def parse_boxes(det_text: str) -> Optional[List[List[int]]]:
+    """解析 '[[x1, y1, x2, y2], ...]'，不使用 eval；格式不正确时返回 None"""
+    if det_text.count('[') != det_text.count(']'):
+        return None
+    values = [int(float(number)) for number in _NUMBER.findall(det_text)]
+    if not values or len(values) % 4:
+        return None
+    return [values[i:i + 4] for i in range(0, len(values), 4)]
+
+
+def _clean_text(text: str) -> str:
+    return text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+
+
+def parse_grounding(raw_text: str, image_link: Optional[str] = None) -> Tuple[str, List[Dict]]:
+    """单次扫描解析模型原始输出，文本清理方式与模型自带的 result.mmd 一致
+
+    与 DeepSeek-OCR-vllm/process/grounding.py 的 GroundingParser 语义相同，两边输出的版面 JSONL 一致：
+    <|ref|> 后没有紧跟 <|det|> 的片段按普通文本保留，未闭合的片段原样保留，框格式不正确时 boxes 为 None。
+
+    Args:
+        image_link: 图片区域替换成的链接模板（如 "images/{idx}.jpg"，idx 为第几个 image 片段），
+            为 None 时与其他标签一样直接删除
+
+    Returns:
+        (干净文本, refs)；每个 ref 为 {"label", "boxes", "start", "end"}，
+        start/end 为该片段在干净文本中的替换位置
+    """
+    pieces = []
+    refs = []
+    length = 0
+    pos = 0
+    num_images = 0
+
+    def emit(text: str) -> None:
+        nonlocal length
+        pieces.append(text)
+        length += len(text)
+
+    while True:
+        start = raw_text.find(REF_OPEN, pos)
+        if start < 0:
+            break
+        label_end = raw_text.find(REF_CLOSE, start + len(REF_OPEN))
+        if label_end < 0:
+            break
+        det_start = label_end + len(REF_CLOSE)
+        if not raw_text.startswith(DET_OPEN, det_start):
+            # 没有框的 ref 按普通文本处理
+            emit(_clean_text(raw_text[pos:det_start]))
+            pos = det_start
+            continue
+        det_end = raw_text.find(DET_CLOSE, det_start + len(DET_OPEN))
+        if det_end < 0:
+            break
+
+        emit(_clean_text(raw_text[pos:start]))
+        label = raw_text[start + len(REF_OPEN):label_end]
+        replacement = ""
+        if label == "image":
+            if image_link is not None:
+                replacement = f"![]({image_link.format(idx=num_images)})\n"
+            num_images += 1
+        refs.append({"label": label, "boxes": parse_boxes(raw_text[det_start + len(DET_OPEN):det_end]),
+                     "start": length, "end": length + len(replacement)})
+        emit(replacement)
+        pos = det_end + len(DET_CLOSE)
+    emit(_clean_text(raw_text[pos:]))
+    return "".join(pieces), refs
+
+
+def _scale_box(box: List[int], width: int, height: int) -> Tuple[List[float], List[int]]:
+    x1, y1, x2, y2 = box
+    return ([round(x1 / COORD_SCALE, 4), round(y1 / COORD_SCALE, 4),
+             round(x2 / COORD_SCALE, 4), round(y2 / COORD_SCALE, 4)],
+            [int(x1 / COORD_SCALE * width), int(y1 / COORD_SCALE * height),
+             int(x2 / COORD_SCALE * width), int(y2 / COORD_SCALE * height)])
+
+
+def layout_blocks(clean_text: str, refs: List[Dict], width: int, height: int) -> List[Dict]:
+    """按阅读顺序生成版面块：每个 grounding 片段一个块，文本为到下一个片段之前的内容
+
+    bbox 为该片段所有框的外接框（0..1 归一化），bbox_px 为对应的页面像素坐标；
+    多个框时另附 boxes；第一个片段之前的文本作为 label 为 None 的块。
+    """
+    blocks = []
+    lead = clean_text[:refs[0]["start"] if refs else len(clean_text)].strip()
+    if lead:
+        blocks.append({"order": 0, "label": None, "bbox": None, "bbox_px": None, "text": lead})
+    for idx, ref in enumerate(refs):
+        block_end = refs[idx + 1]["start"] if idx + 1 < len(refs) else len(clean_text)
+        block = {"order": len(blocks), "label": ref["label"], "bbox": None, "bbox_px": None,
+                 "text": clean_text[ref["end"]:block_end].strip()}
+        boxes = ref["boxes"]
+        if boxes:
+            union = [min(b[0] for b in boxes), min(b[1] for b in boxes),
+                     max(b[2] for b in boxes), max(b[3] for b in boxes)]
+            block["bbox"], block["bbox_px"] = _scale_box(union, width, height)
+            if len(boxes) > 1:
+                block["boxes"] = [_scale_box(b, width, height)[0] for b in boxes]
+        blocks.append(block)
+    return blocks
+
+
+def append_layout_jsonl(path: str, page: int, blocks: List[Dict]) -> None:
+    """以紧凑的 JSON Lines 追加一页的版面块（每行一个块，带页码），便于下游流式读取和建索引"""
+    with open(path, "a", encoding="utf-8") as f:
+        for block in blocks:
+            f.write(json.dumps({"page": page, **block}, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+def _label_color(label: str) -> Tuple[int, int, int]:
+    # 同一标签固定颜色，重复渲染结果一致
+    seed = zlib.crc32(label.encode("utf-8"))
+    return (seed % 200, (seed >> 8) % 200, (seed >> 16) % 256)
+
+
+def save_image_crops(image: Image.Image, refs: List[Dict], output_dir: str) -> None:
+    """把 image 区域裁剪保存到 images/{idx}.jpg，供 markdown 中的图片链接使用"""
+    width, height = image.size
+    img_idx = 0
+    for ref in refs:
+        if ref["label"] != "image" or not ref["boxes"]:
+            continue
+        for box in ref["boxes"]:
+            x1, y1, x2, y2 = _scale_box(box, width, height)[1]
+            if x2 <= x1 or y2 <= y1:
+                continue
+            os.makedirs(os.path.join(output_dir, "images"), exist_ok=True)
+            image.crop((x1, y1, x2, y2)).convert("RGB").save(os.path.join(output_dir, "images", f"{img_idx}.jpg"))
+            img_idx += 1
+
+
+def save_boxes(output_dir: str, image_file: str, refs: List[Dict]) -> str:
+    """保存绘制标注图所需的数据（页面图片的相对路径 + 各片段的标签和框），返回 boxes.json 路径"""
+    boxes_path = os.path.join(output_dir, BOXES_FILE)
+    data = {
+        "image": os.path.relpath(image_file, output_dir),
+        "refs": [{"label": ref["label"], "boxes": ref["boxes"]} for ref in refs if ref["boxes"]],
+    }
+    with open(boxes_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    return boxes_path
+
+
+def render_boxes(image: Image.Image, refs: List[Dict]) -> Image.Image:
+    """绘制带框标注图（框 + 半透明填充 + 标签）"""
+    width, height = image.size
+    img_draw = image.convert("RGB")
+    draw = ImageDraw.Draw(img_draw)
+    overlay = Image.new("RGBA", img_draw.size, (0, 0, 0, 0))
+    draw_overlay = ImageDraw.Draw(overlay)
+    font = ImageFont.load_default()
+
+    for ref in refs:
+        if not ref["boxes"]:
+            continue
+        label = ref["label"]
+        color = _label_color(label)
+        for box in ref["boxes"]:
+            x1, y1, x2, y2 = _scale_box(box, width, height)[1]
+            if x2 <= x1 or y2 <= y1:
+                continue
+            draw.rectangle([x1, y1, x2, y2], outline=color, width=4 if label == "title" else 2)
+            draw_overlay.rectangle([x1, y1, x2, y2], fill=color + (20,))
+            text_y = max(0, y1 - 15)
+            text_box = draw.textbbox((0, 0), label, font=font)
+            draw.rectangle([x1, text_y, x1 + text_box[2] - text_box[0], text_y + text_box[3] - text_box[1]],
+                           fill=(255, 255, 255))
+            draw.text((x1, text_y), label, font=font, fill=color)
+    img_draw.paste(overlay, (0, 0), overlay)
+    return img_draw
+
+
+def render_boxes_cached(boxes_path: str) -> str:
+    """按需渲染：首次调用时根据 boxes.json 绘制 result_with_boxes.jpg，之后直接返回已缓存的文件"""
+    output_dir = os.path.dirname(boxes_path)
+    out_path = os.path.join(output_dir, BOXES_IMAGE_FILE)
+    if os.path.exists(out_path):
+        return out_path
+    with open(boxes_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    with Image.open(os.path.join(output_dir, data["image"])) as image:
+        annotated = render_boxes(image, data["refs"])
+    # 先写临时文件再替换，并发请求不会读到半张图
+    tmp_path = f"{out_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    annotated.save(tmp_path, format="JPEG")
+    os.replace(tmp_path, out_path)
+    return out_path
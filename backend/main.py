@@ -5,14 +5,18 @@ from fastapi.staticfiles import StaticFiles
 import os
 import shutil
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 import json
 from datetime import datetime
 import time
 from ocr_service import OCRService
+from scheduler import OCRScheduler, DegradationPolicy, RequestTimeouts
+from config_loader import get_config
+from layout import BOXES_FILE, render_boxes_cached
 import asyncio
 import uuid
 import threading
+import re
 from pydantic import BaseModel
 
 app = FastAPI(title="DeepSeek-OCR API", version="1.0.0")
@@ -32,6 +36,14 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 ocr_service = OCRService()
+_service_config = get_config().get_service_config()
+_scheduler_config = _service_config.get('scheduler', {})
+scheduler = OCRScheduler(
+    ocr_service,
+    policy=DegradationPolicy.from_config(_scheduler_config.get('degradation', {})),
+    max_concurrency=_scheduler_config.get('max_concurrency', 1),
+    timeouts=RequestTimeouts.from_config(_service_config.get('timeout', {}))
+)
 
 # 流式处理标志
 ENABLE_STREAMING = True  # 设置为True启用流式传输
@@ -43,6 +55,9 @@ class CancelRequest(BaseModel):
 active_jobs: Dict[str, Dict[str, object]] = {}
 jobs_lock = asyncio.Lock()
 
+# 输出目录名（上传时间戳），用作 /api/jobs/{job_id} 中的任务标识
+JOB_ID_PATTERN = re.compile(r"[0-9_]+")
+
 @app.on_event("startup")
 async def startup_event():
     await ocr_service.initialize()
@@ -56,6 +71,7 @@ async def get_configs():
     """获取所有可用的配置选项"""
     return {
         "modes": [
+            {"value": "auto", "label": "Auto (按页面内容自动选择)", "base_size": None, "image_size": None, "crop_mode": None},
             {"value": "tiny", "label": "Tiny (512×512, 64 tokens)", "base_size": 512, "image_size": 512, "crop_mode": False},
             {"value": "small", "label": "Small (640×640, 100 tokens)", "base_size": 640, "image_size": 640, "crop_mode": False},
             {"value": "base", "label": "Base (1024×1024, 256 tokens)", "base_size": 1024, "image_size": 1024, "crop_mode": False},
@@ -79,12 +95,18 @@ async def process_ocr_stream(
     file: UploadFile = File(...),
     mode: str = Form("base"),
     output_format: str = Form("markdown"),
-    custom_prompt: Optional[str] = Form(None)
+    custom_prompt: Optional[str] = Form(None),
+    tasks: Optional[str] = Form(None),
+    layout: bool = Form(False)
 ):
-    """流式OCR处理端点"""
+    """流式OCR处理端点；layout=true 时每页事件附带版面块 blocks
+
+    tasks 与 /api/ocr 相同；多任务时每页每个任务各发送一个事件，带 task（从 0 开始）和 format
+    """
     try:
         if not file.filename:
             raise HTTPException(status_code=400, detail="No file provided")
+        task_list = _parse_tasks(tasks)
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
         filename = f"{timestamp}_{file.filename}"
@@ -133,7 +155,7 @@ async def process_ocr_stream(
 
                 # 并发启动处理任务
                 task = asyncio.create_task(
-                    ocr_service.process(
+                    scheduler.submit(
                         file_path=abs_file_path,
                         mode=mode,
                         output_format=output_format,
@@ -141,7 +163,9 @@ async def process_ocr_stream(
                         output_path=abs_output_path,
                         on_progress=on_progress,
                         cancel_event=cancel_event,
-                        thread_cancel_event=thread_cancel_event
+                        thread_cancel_event=thread_cancel_event,
+                        tasks=task_list,
+                        layout=layout
                     )
                 )
                 async with jobs_lock:
@@ -165,12 +189,23 @@ async def process_ocr_stream(
                         if "page" in event:
                             payload["page"] = event.get("page")
                             payload["total"] = event.get("total")
-                        if "image_path" in event and event.get("image_path"):
-                            # 转换为相对URL路径
-                            img_path = event.get("image_path")
-                            print(f"🖼️  Found image_path: {img_path}")
-                            rel_path = os.path.relpath(img_path, str(OUTPUT_DIR))
-                            payload["image_url"] = f"/outputs/{rel_path.replace(os.sep, '/')}"
+                        if "mode" in event:
+                            payload["mode"] = event.get("mode")
+                            payload["estimated_tokens"] = event.get("estimated_tokens")
+                        if event.get("timed_out"):
+                            payload["timed_out"] = True
+                        if event.get("degenerate"):
+                            payload["degenerate"] = True
+                        if event.get("skipped"):
+                            payload["skipped"] = event.get("skipped")
+                        if "task" in event:
+                            payload["task"] = event.get("task")
+                            payload["format"] = event.get("format")
+                        if event.get("blocks") is not None:
+                            payload["blocks"] = event.get("blocks")
+                        if event.get("boxes_path"):
+                            # 标注图按需渲染，这里只给出地址
+                            payload["image_url"] = _boxes_url(event.get("boxes_path"))
                             print(f"✅ Converted to image_url: {payload['image_url']}")
                         
                         print(f"📤 Sending SSE event: page={payload.get('page')}, text_len={len(payload.get('text', ''))}, has_image={bool(payload.get('image_url'))}")
@@ -192,17 +227,9 @@ async def process_ocr_stream(
                     yield f"data: {json.dumps({'type': 'cancelled', 'job_id': job_id})}\n\n"
                     return
                 text = str(result.get("text", ""))
-                raw_image_paths = result.get("image_paths") or []
-                image_urls = []
-                for ip in raw_image_paths:
-                    try:
-                        if ip and os.path.exists(ip):
-                            rel_path = os.path.relpath(ip, str(OUTPUT_DIR))
-                            image_urls.append(f"/outputs/{rel_path.replace(os.sep, '/')}")
-                    except Exception:
-                        continue
+                image_urls = [_boxes_url(bp) for bp in result.get("boxes_paths") or []]
                 elapsed_ms = int((time.perf_counter() - t0) * 1000)
-                yield f"data: {json.dumps({'type': 'metadata', 'mode': mode, 'output_format': output_format, 'prompt_used': str(result.get('prompt', '')), 'timestamp': timestamp, 'start_time': start_iso, 'duration_ms': elapsed_ms, 'final_text_length': len(text), 'image_urls': image_urls, 'job_id': job_id})}\n\n"
+                yield f"data: {json.dumps({'type': 'metadata', 'mode': mode, 'output_format': output_format, 'prompt_used': str(result.get('prompt', '')), 'timestamp': timestamp, 'start_time': start_iso, 'duration_ms': elapsed_ms, 'final_text_length': len(text), 'image_urls': image_urls, 'page_modes': result.get('page_modes', []), 'degraded': result.get('degraded'), 'timed_out_pages': result.get('timed_out_pages', []), 'skipped_pages': result.get('skipped_pages', []), 'degenerate_pages': result.get('degenerate_pages', []), 'layout_url': (_to_output_urls([result.get('layout_path')]) or [None])[0], 'tasks': _task_payloads(result), 'job_id': job_id})}\n\n"
                 yield f"data: {json.dumps({'type': 'done', 'duration_ms': elapsed_ms, 'job_id': job_id})}\n\n"
                 
             except Exception as e:
@@ -229,6 +256,8 @@ async def process_ocr_stream(
             }
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -253,17 +282,112 @@ async def cancel_ocr(request: CancelRequest):
 
     return {"success": True}
 
+def _parse_tasks(tasks: Optional[str]) -> Optional[List[Dict]]:
+    """解析多任务参数：JSON 数组，每项为 {"format": 输出格式, "target": 可选的 rec 定位目标}
+
+    任务数量（inference.multi_task.max_tasks）和提示词在保存上传文件、占用调度槽位之前校验，不合法时返回 400。
+    """
+    if not tasks or not tasks.strip():
+        return None
+    try:
+        parsed = json.loads(tasks)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"tasks 不是合法的 JSON: {e}")
+    if not isinstance(parsed, list) or not parsed:
+        raise HTTPException(status_code=400, detail="tasks 必须是非空数组")
+    max_tasks = get_config().get('inference.multi_task.max_tasks', 8)
+    if len(parsed) > max_tasks:
+        raise HTTPException(status_code=400, detail=f"任务数量超过上限：{len(parsed)} > {max_tasks}")
+    result = []
+    for task in parsed:
+        if not isinstance(task, dict) or not isinstance(task.get("format"), str):
+            raise HTTPException(status_code=400, detail=f"无效的任务: {task}")
+        try:
+            ocr_service._get_prompt(task["format"], task.get("target"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        result.append({"format": task["format"], "target": task.get("target")})
+    return result
+
+
+def _task_payloads(result: Dict) -> Optional[List[Dict]]:
+    """多任务结果 -> 响应中的 tasks 数组；单任务请求返回 None"""
+    if result.get("tasks") is None:
+        return None
+    return [
+        {
+            "format": task["format"],
+            "target": task["target"],
+            "prompt_used": task["prompt"],
+            "text": task["text"],
+            "image_urls": [_boxes_url(bp) for bp in task["boxes_paths"]],
+            "pages": [
+                {
+                    "page": page["page"],
+                    "text": page["text"],
+                    "image_url": _boxes_url(page["boxes_path"]),
+                    "timed_out": page.get("timed_out", False),
+                    "degenerate": page.get("degenerate", False),
+                    "skipped": page.get("skipped"),
+                }
+                for page in task["pages"]
+            ],
+            "timed_out_pages": task["timed_out_pages"],
+            "degenerate_pages": task["degenerate_pages"],
+            "layout": task["layout"],
+            "layout_url": (_to_output_urls([task["layout_path"]]) or [None])[0],
+        }
+        for task in result["tasks"]
+    ]
+
+
+def _to_output_urls(paths) -> List[str]:
+    """把输出目录下的文件路径转换为 /outputs 静态地址"""
+    urls = []
+    for ip in paths or []:
+        try:
+            if ip and os.path.exists(ip):
+                rel_path = os.path.relpath(ip, str(OUTPUT_DIR))
+                urls.append(f"/outputs/{rel_path.replace(os.sep, '/')}")
+        except Exception:
+            continue
+    return urls
+
+
+def _boxes_url(boxes_path: Optional[str]) -> Optional[str]:
+    """boxes.json 路径 -> 按需渲染标注图的地址 /api/jobs/{job_id}/pages/{page}/boxes.jpg[?task=k]"""
+    if not boxes_path:
+        return None
+    parts = Path(os.path.relpath(os.path.dirname(boxes_path), str(OUTPUT_DIR))).parts
+    job_id, page, task = parts[0], 1, None
+    for part in parts[1:]:
+        if part.startswith("page_"):
+            page = int(part[len("page_"):])
+        elif part.startswith("task_"):
+            task = int(part[len("task_"):])
+    url = f"/api/jobs/{job_id}/pages/{page}/boxes.jpg"
+    return f"{url}?task={task}" if task is not None else url
+
+
 @app.post("/api/ocr")
 async def process_ocr(
     file: UploadFile = File(...),
     mode: str = Form("base"),
     output_format: str = Form("markdown"),
-    custom_prompt: Optional[str] = Form(None)
+    custom_prompt: Optional[str] = Form(None),
+    tasks: Optional[str] = Form(None),
+    layout: bool = Form(False)
 ):
-    """处理OCR请求"""
+    """处理OCR请求
+
+    tasks 为 JSON 数组时（如 [{"format": "markdown"}, {"format": "rec", "target": "标题"}]），
+    同一文件只上传、渲染一次并依次执行所有任务，结果按任务分组返回在 data.tasks 中。
+    layout=true 时 data.layout 返回每页的版面块，data.layout_url 指向 JSON Lines 文件。
+    """
     try:
         if not file.filename:
             raise HTTPException(status_code=400, detail="No file provided")
+        task_list = _parse_tasks(tasks)
         
         file_ext = Path(file.filename).suffix.lower()
         allowed_extensions = {'.jpg', '.jpeg', '.png', '.pdf', '.bmp', '.tiff', '.webp'}
@@ -308,12 +432,14 @@ async def process_ocr(
         print(f"  Output: {abs_output_path}")
         
         t0 = time.perf_counter()
-        result = await ocr_service.process(
+        result = await scheduler.submit(
             file_path=abs_file_path,
             mode=mode,
             output_format=output_format,
             custom_prompt=custom_prompt,
-            output_path=abs_output_path
+            output_path=abs_output_path,
+            tasks=task_list,
+            layout=layout
         )
         duration_ms = int((time.perf_counter() - t0) * 1000)
         
@@ -328,15 +454,7 @@ async def process_ocr(
         # 确保返回值可以被 JSON 序列化
         result_text = str(result["text"]) if result["text"] is not None else ""
         result_prompt = str(result["prompt"]) if result["prompt"] is not None else ""
-        raw_image_paths = result.get("image_paths") or []
-        image_urls = []
-        for ip in raw_image_paths:
-            try:
-                if ip and os.path.exists(ip):
-                    rel_path = os.path.relpath(ip, str(OUTPUT_DIR))
-                    image_urls.append(f"/outputs/{rel_path.replace(os.sep, '/')}")
-            except Exception:
-                continue
+        image_urls = [_boxes_url(bp) for bp in result.get("boxes_paths") or []]
         
         response_data = {
             "success": True,
@@ -347,9 +465,19 @@ async def process_ocr(
                 "prompt_used": result_prompt,
                 "timestamp": str(timestamp),
             "duration_ms": duration_ms,
-            "image_urls": image_urls
+            "image_urls": image_urls,
+            "page_modes": result.get("page_modes", []),
+            "degraded": result.get("degraded"),
+            "timed_out_pages": result.get("timed_out_pages", []),
+            "skipped_pages": result.get("skipped_pages", []),
+            "degenerate_pages": result.get("degenerate_pages", []),
+            "layout": result.get("layout"),
+            "layout_url": (_to_output_urls([result.get("layout_path")]) or [None])[0]
             }
         }
+        task_payloads = _task_payloads(result)
+        if task_payloads is not None:
+            response_data["data"]["tasks"] = task_payloads
         
         print(f"\n📤 Sending response to frontend:")
         print(f"  - Success: {response_data['success']}")
@@ -364,18 +492,45 @@ async def process_ocr(
         
     except HTTPException:
         raise
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         print(f"Error in process_ocr: {type(e).__name__}: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"{type(e).__name__}: {str(e)}")
 
+@app.get("/api/jobs/{job_id}/pages/{page}/boxes.jpg")
+async def get_page_boxes(job_id: str, page: int, task: Optional[int] = None):
+    """按需渲染带框标注图：推理时只保存框数据（boxes.json），首次请求时绘制并缓存，之后直接返回缓存文件"""
+    # job_id 即输出目录名（时间戳），拒绝其他字符以防路径穿越
+    if not JOB_ID_PATTERN.fullmatch(job_id) or page < 1 or (task is not None and task < 1):
+        raise HTTPException(status_code=404, detail="Page not found")
+    page_dir = OUTPUT_DIR / job_id / f"page_{page}"
+    if not page_dir.is_dir():
+        if page != 1:
+            raise HTTPException(status_code=404, detail="Page not found")
+        # 单张图片的结果直接位于任务目录下
+        page_dir = OUTPUT_DIR / job_id
+    if task is not None:
+        page_dir = page_dir / f"task_{task}"
+    boxes_path = page_dir / BOXES_FILE
+    if not boxes_path.exists():
+        raise HTTPException(status_code=404, detail="No boxes for this page")
+    try:
+        image_path = await asyncio.to_thread(render_boxes_cached, str(boxes_path))
+    except (OSError, ValueError, KeyError) as e:
+        raise HTTPException(status_code=500, detail=f"Render failed: {e}")
+    return FileResponse(image_path, media_type="image/jpeg")
+
 @app.get("/api/health")
 async def health_check():
     """健康检查"""
     return {
         "status": "healthy",
         "model_loaded": ocr_service.is_ready(),
+        "scheduler": scheduler.stats(),
+        "pages": ocr_service.get_stats(),
         "timestamp": datetime.now().isoformat()
     }
 
@@ -1,14 +1,34 @@
 import torch
 import os
+import math
+import shutil
 from transformers import AutoModel, AutoTokenizer
 from pathlib import Path
-from typing import Optional, Dict, Callable, Awaitable
+from typing import Optional, Dict, List, Callable, Awaitable
 from threading import Event
 import fitz  # PyMuPDF
 from PIL import Image
 import io
+import time
 import asyncio
+import concurrent.futures
+import contextlib
 from config_loader import get_config
+from page_analysis import (
+    MODE_TABLE, BLANK_INK_RATIO, DUPLICATE_MAX_DISTANCE, DUPLICATE_MAX_TILE_DIFF, analyze_page, choose_mode,
+    estimate_vision_tokens, get_tile_grid, is_duplicate_page, page_fingerprint, target_render_size
+)
+from scheduler import DeadlineEvent
+from repetition_guard import RepetitionStoppingCriteria, install_stopping_criteria
+from vision_reuse import VisionFeatureReuse, install_vision_reuse
+from layout import parse_grounding, layout_blocks, append_layout_jsonl, save_image_crops, save_boxes
+
+# auto 模式在渲染时尚未确定档位，沿用 144 DPI
+DEFAULT_RENDER_ZOOM = 2.0
+MAX_RENDER_ZOOM = 600 / 72
+
+# 单页推理超时时返回的占位文本
+TIMEOUT_PLACEHOLDER = "[页面处理超时，已跳过]"
 
 class OCRService:
     def __init__(self):
@@ -18,6 +38,14 @@ class OCRService:
         self.model_path = None
         self._ready = False
         self.config = get_config()
+        # 单页推理平均耗时（指数滑动平均），用于估算跳过页面节省的 GPU 时间
+        self._avg_page_seconds: Optional[float] = None
+        self.page_skip_stats = {"blank_pages": 0, "duplicate_pages": 0, "gpu_seconds_saved": 0.0}
+        # 重复循环检测（inference.repetition_stop），模型加载后安装
+        self._repetition_guard: Optional[RepetitionStoppingCriteria] = None
+        self.degenerate_page_count = 0
+        # 多任务请求中同一页面的视觉编码复用（inference.multi_task.reuse_vision_features），模型加载后安装
+        self._vision_reuse: Optional[VisionFeatureReuse] = None
         
     async def initialize(self):
         """初始化模型"""
@@ -121,6 +149,21 @@ class OCRService:
                 self.model = self.model.to(dtype)
                 if device == 'cuda':
                     print("⚠️  CUDA 不可用，使用 CPU")
+
+            repetition_config = self.config.get('inference.repetition_stop', {}) or {}
+            if repetition_config.get('enabled', True):
+                self._repetition_guard = RepetitionStoppingCriteria.from_config(repetition_config)
+                install_stopping_criteria(self.model, self._repetition_guard)
+                print(f"🔁 重复循环检测已启用: max_period={self._repetition_guard.max_period}, "
+                      f"min_loop_tokens={self._repetition_guard.min_loop_tokens}")
+
+            if self.config.get('inference.multi_task.reuse_vision_features', True):
+                reuse = VisionFeatureReuse()
+                if install_vision_reuse(self.model, reuse):
+                    self._vision_reuse = reuse
+                    print(f"♻️  多任务视觉编码复用已启用")
+                else:
+                    print(f"⚠️  未找到视觉编码模块（sam_model / vision_model / projector），多任务请求将逐个编码")
             
             self._ready = True
             print(f"{'='*60}")
@@ -205,15 +248,157 @@ class OCRService:
     
     def _get_mode_params(self, mode: str) -> Dict:
         """获取模式参数"""
-        modes = {
-            "tiny": {"base_size": 512, "image_size": 512, "crop_mode": False},
-            "small": {"base_size": 640, "image_size": 640, "crop_mode": False},
-            "base": {"base_size": 1024, "image_size": 1024, "crop_mode": False},
-            "large": {"base_size": 1280, "image_size": 1280, "crop_mode": False},
-            "gundam": {"base_size": 1024, "image_size": 640, "crop_mode": True}
+        return MODE_TABLE.get(mode, MODE_TABLE["base"])
+
+    def _cap_crops(self, params: Dict, width: int, height: int, max_crops: Optional[int]) -> Dict:
+        """限制动态切片数量：模型按固定范围切片，超出上限的页面只保留全局视图"""
+        if max_crops is None or not params["crop_mode"]:
+            return params
+        w_tiles, h_tiles = get_tile_grid(params, width, height)
+        if w_tiles * h_tiles > max_crops:
+            return dict(params, crop_mode=False)
+        return params
+
+    def _resolve_page_mode(self, mode: str, image_file: str, max_crops: Optional[int] = None) -> Dict:
+        """确定单页实际使用的档位；auto 模式下根据页面内容自动选择。
+
+        Args:
+            max_crops: 切片数量上限，None 表示不限制（过载降级时由调度器设置）
+
+        Returns:
+            包含 mode、params、estimated_tokens 的字典，auto 模式额外带 reason 和 stats
+        """
+        with Image.open(image_file) as img:
+            width, height = img.size
+            stats = analyze_page(img) if mode == "auto" else None
+
+        if stats is not None:
+            decision = choose_mode(stats)
+            params = self._cap_crops(self._get_mode_params(decision["mode"]), width, height, max_crops)
+            print(f"🤖 auto 模式选择: {decision['mode']} ({decision['reason']}), "
+                  f"预计 {decision['estimated_tokens']} 视觉 tokens, stats={stats}")
+            return {
+                "mode": decision["mode"],
+                "params": params,
+                "estimated_tokens": estimate_vision_tokens(params, width, height),
+                "reason": decision["reason"],
+                "stats": stats,
+            }
+
+        params = self._cap_crops(self._get_mode_params(mode), width, height, max_crops)
+        return {
+            "mode": mode if mode in MODE_TABLE else "base",
+            "params": params,
+            "estimated_tokens": estimate_vision_tokens(params, width, height),
         }
-        
-        return modes.get(mode, modes["base"])
+
+    def count_pages(self, file_path: str) -> int:
+        """返回文件页数（图片为 1），供调度器估算时间预算"""
+        if os.path.splitext(file_path)[1].lower() != '.pdf':
+            return 1
+        with fitz.open(file_path) as pdf_document:
+            return pdf_document.page_count
+
+    def _page_deadline(self, request_deadline: Optional[float], cancel_event: Optional[Event] = None) -> DeadlineEvent:
+        """为单页推理创建截止信号：取单页预算与请求剩余时间中较早者"""
+        per_page_seconds = self.config.get('service.timeout.per_page_seconds', 60)
+        expires_at = time.monotonic() + per_page_seconds
+        if request_deadline is not None:
+            expires_at = min(expires_at, request_deadline)
+        return DeadlineEvent(expires_at, cancel_event)
+
+    def _record_page_seconds(self, seconds: float) -> None:
+        if self._avg_page_seconds is None:
+            self._avg_page_seconds = seconds
+        else:
+            self._avg_page_seconds = 0.8 * self._avg_page_seconds + 0.2 * seconds
+
+    def get_stats(self) -> Dict:
+        """返回页面跳过计数及估算节省的 GPU 时间"""
+        stats = dict(self.page_skip_stats)
+        stats["gpu_seconds_saved"] = round(stats["gpu_seconds_saved"], 2)
+        stats["avg_page_seconds"] = round(self._avg_page_seconds, 2) if self._avg_page_seconds else None
+        stats["degenerate_pages"] = self.degenerate_page_count
+        stats["vision_reuse_hits"] = self._vision_reuse.hits if self._vision_reuse is not None else None
+        return stats
+
+    def _fingerprint_page(self, image_file: str) -> Dict:
+        """计算页面指纹（墨迹占比、感知哈希、逐块平均灰度），用于推理前识别空白页/重复页"""
+        with Image.open(image_file) as img:
+            return page_fingerprint(img)
+
+    def _classify_page(self, fingerprint: Dict, seen_pages: list) -> Optional[Dict]:
+        """判断页面是否可以跳过推理
+
+        Returns:
+            None 表示需要推理；否则返回 {"reason": "blank"} 或 {"reason": "duplicate", "source": 已推理页面}
+        """
+        skip_config = self.config.get('inference.page_skip', {}) or {}
+        if not skip_config.get('enabled', True):
+            return None
+        if fingerprint["ink_ratio"] < skip_config.get('blank_ink_ratio', BLANK_INK_RATIO):
+            return {"reason": "blank"}
+        # 感知哈希相近的页面再逐块比较，填写内容不同的表单不会被当作重复页
+        max_distance = skip_config.get('duplicate_max_distance', DUPLICATE_MAX_DISTANCE)
+        max_tile_diff = skip_config.get('duplicate_max_tile_diff', DUPLICATE_MAX_TILE_DIFF)
+        for seen in seen_pages:
+            if is_duplicate_page(fingerprint, seen["fingerprint"], max_distance, max_tile_diff):
+                return {"reason": "duplicate", "source": seen}
+        return None
+
+    def _infer(self, prompt: str, image_file: str, output_dir: str, mode_params: Dict,
+               cancel_event: Optional[Event] = None):
+        """同步调用模型推理，返回带 grounding 标签的原始输出
+
+        使用 eval_mode，模型不绘制、不保存标注图；由 _layout_page 解析输出并保存框数据，
+        标注图在前端首次请求时才渲染（/api/jobs/{job_id}/pages/{page}/boxes.jpg）。
+        """
+        if self._repetition_guard is not None:
+            self._repetition_guard.reset()
+        return self.model.infer(
+            self.tokenizer,
+            prompt=prompt,
+            image_file=image_file,
+            output_path=output_dir,
+            base_size=mode_params["base_size"],
+            image_size=mode_params["image_size"],
+            crop_mode=mode_params["crop_mode"],
+            save_results=False,
+            test_compress=False,
+            eval_mode=True,
+            cancel_event=cancel_event
+        )
+
+    def _last_infer_degenerate(self) -> bool:
+        """当前线程上一次推理是否因重复循环被提前结束（须在执行推理的线程中调用）"""
+        if self._repetition_guard is None or self._repetition_guard.loop is None:
+            return False
+        period, span = self._repetition_guard.loop
+        print(f"🔁 检测到重复循环（周期 {period} token，跨度 {span} token），已提前结束生成")
+        self.degenerate_page_count += 1
+        return True
+
+    def _layout_page(self, raw_text: str, image_file: str, out_dir: str) -> tuple:
+        """解析原始输出并保存框数据（不渲染标注图）
+
+        Returns:
+            (干净文本, 版面页, boxes.json 路径)；没有任何框时路径为 None
+        """
+        clean_text, refs = parse_grounding(raw_text, image_link="images/{idx}.jpg")
+        with Image.open(image_file) as img:
+            width, height = img.size
+            # markdown 中的图片链接指向这些裁剪，需要立即保存
+            save_image_crops(img, refs, out_dir)
+        boxes_path = save_boxes(out_dir, image_file, refs) if any(ref["boxes"] for ref in refs) else None
+        page_layout = {"width": width, "height": height, "blocks": layout_blocks(clean_text, refs, width, height)}
+        return clean_text, page_layout, boxes_path
+
+    def _keep_source_image(self, file_path: str, output_dir: str) -> str:
+        """把上传的图片复制到输出目录（不重新编码），返回副本路径"""
+        source_image = os.path.join(output_dir, "source" + os.path.splitext(file_path)[1].lower())
+        if not os.path.exists(source_image):
+            shutil.copyfile(file_path, source_image)
+        return source_image
 
     def _read_fallback_output(self, out_dir: str) -> str:
         """当 model.infer 返回 None 时，尝试从输出目录读取结果文件。"""
@@ -274,7 +459,7 @@ class OCRService:
         """在输出目录中保存结果文件：若包含 mermaid 则生成 result.mmd，否则保存为 result.md。
         rec模式跳过保存，因为只需要图片。"""
         try:
-            # rec模式不需要保存文本结果，只需要result_with_boxes.jpg
+            # rec模式不需要保存文本结果，只需要标注图（按需渲染）
             if output_format == "rec":
                 print(f"🎯 rec模式：跳过文本文件保存，只依赖图片")
                 return
@@ -283,7 +468,7 @@ class OCRService:
             content = text or ""
             
             # 检查是否为空或占位符
-            if not content.strip() or "[OCR返回为空" in content:
+            if not content.strip() or "[OCR返回为空" in content or content.strip() == TIMEOUT_PLACEHOLDER:
                 print(f"⚠️  内容为空或错误占位符，跳过保存")
                 return
             
@@ -305,8 +490,18 @@ class OCRService:
             print(f"❌ 保存输出文件失败: {e}")
             pass
     
-    def _pdf_to_images(self, pdf_path: str, output_dir: str) -> list:
-        """将PDF转换为图片列表"""
+    def _render_zoom(self, mode: str, page_rect) -> float:
+        """根据目标档位计算页面渲染缩放倍数，只渲染预处理实际会用到的像素"""
+        if mode not in MODE_TABLE:
+            return DEFAULT_RENDER_ZOOM
+        target_width, target_height = target_render_size(MODE_TABLE[mode], page_rect.width, page_rect.height)
+        # 向上取整，避免渲染结果比目标尺寸少一个像素而被放大
+        zoom = max((math.ceil(target_width) + 0.5) / page_rect.width,
+                   (math.ceil(target_height) + 0.5) / page_rect.height)
+        return min(zoom, MAX_RENDER_ZOOM)
+
+    def _pdf_to_images(self, pdf_path: str, output_dir: str, mode: str = "auto") -> list:
+        """将PDF转换为图片列表，渲染分辨率由目标档位决定"""
         try:
             pdf_document = fitz.open(pdf_path)
             image_paths = []
@@ -315,13 +510,13 @@ class OCRService:
             
             for page_num in range(len(pdf_document)):
                 page = pdf_document[page_num]
-                # 使用较高的DPI以获得更好的质量
-                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))  # 2x zoom = 144 DPI
+                zoom = self._render_zoom(mode, page.rect)
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
                 
                 img_path = os.path.join(output_dir, f"page_{page_num + 1}.png")
                 pix.save(img_path)
                 image_paths.append(img_path)
-                print(f"Converted PDF page {page_num + 1} to {img_path}")
+                print(f"Converted PDF page {page_num + 1} to {img_path} ({pix.width}x{pix.height}, {zoom * 72:.0f} DPI)")
             
             pdf_document.close()
             return image_paths
@@ -329,6 +524,54 @@ class OCRService:
         except Exception as e:
             raise RuntimeError(f"PDF conversion failed: {str(e)}")
     
+    def _result_text(self, result, out_dir: str, output_format: str) -> str:
+        """把 model.infer 的返回值转换为文本，返回 None 时回退读取输出目录"""
+        if result is None:
+            if output_format == "rec":
+                return ""
+            fallback_text = self._read_fallback_output(out_dir)
+            return fallback_text if fallback_text.strip() else "[OCR返回为空，请检查图片质量或prompt]"
+        if isinstance(result, (list, tuple)):
+            return str(result[0]) if result else ""
+        if isinstance(result, dict):
+            return str(result.get('text', result))
+        return str(result)
+
+    def _reuse_vision(self, records: Optional[list]):
+        """同一页面的后续任务复用视觉编码结果（见 vision_reuse）；未启用时不做任何事"""
+        if self._vision_reuse is None or records is None:
+            return contextlib.nullcontext()
+        return self._vision_reuse.replay(records)
+
+    async def _infer_page(self, loop, executor, prompt: str, image_file: str, out_dir: str, page_params: Dict,
+                          deadline: Optional[float], thread_cancel_event: Optional[Event],
+                          vision_records: Optional[list]) -> tuple:
+        """在线程池中对一页执行一个提示词的推理，避免阻塞事件循环
+
+        Returns:
+            (model.infer 返回值, 是否超时, 是否因重复循环被提前结束)；超时时返回值为 None
+        """
+        page_deadline = self._page_deadline(deadline, thread_cancel_event)
+
+        def sync_infer():
+            with self._reuse_vision(vision_records):
+                page_result = self._infer(prompt, image_file, out_dir, page_params, page_deadline)
+            return page_result, self._last_infer_degenerate()
+
+        if page_deadline.is_set() and page_deadline.timed_out:
+            return None, True, False
+        try:
+            infer_started = time.perf_counter()
+            result, degenerate = await loop.run_in_executor(executor, sync_infer)
+            self._record_page_seconds(time.perf_counter() - infer_started)
+        except RuntimeError as infer_error:
+            if "inference_cancelled" not in str(infer_error).lower():
+                raise
+            if not page_deadline.timed_out or (thread_cancel_event is not None and thread_cancel_event.is_set()):
+                raise asyncio.CancelledError()
+            return None, True, False
+        return result, False, degenerate
+
     async def process(
         self,
         file_path: str,
@@ -338,187 +581,84 @@ class OCRService:
         output_path: str = "",
         on_progress: Optional[Callable[[Dict], Awaitable[None]]] = None,
         cancel_event: Optional[asyncio.Event] = None,
-        thread_cancel_event: Optional[Event] = None
+        thread_cancel_event: Optional[Event] = None,
+        max_crops: Optional[int] = None,
+        deadline: Optional[float] = None,
+        tasks: Optional[List[Dict]] = None,
+        layout: bool = False
     ) -> Dict:
-        """处理OCR请求"""
+        """处理OCR请求
+
+        每页只渲染、识别空白/重复页、选择档位一次，再依次执行每个任务的提示词；
+        单任务请求即只有一个提示词的情况。
+
+        Args:
+            deadline: 请求截止时间（time.monotonic() 时间戳），由调度器根据 service.timeout 计算；
+                每个提示词的推理时间不超过 per_page_seconds 且不晚于该时间，超时的页面标记为超时并继续
+            tasks: 多任务请求 [{"format": ..., "target": ...}]（如 markdown + figure + 多个 rec 定位），
+                给定时忽略 output_format/custom_prompt，结果按任务分组返回在 tasks 中；
+                同一页面的后续任务复用第一个任务的视觉编码结果，只重新生成文本
+            layout: 同时输出结构化版面：每页的块（标签、归一化/像素坐标、文本、阅读顺序）
+                放在返回值的 layout 中，并以 JSON Lines 写入输出目录的 layout.jsonl（多任务时为 task_k/layout.jsonl）
+        """
         if not self._ready:
             raise RuntimeError("Model is not ready")
-        
-        prompt = self._get_prompt(output_format, custom_prompt)
-        mode_params = self._get_mode_params(mode)
-        collected_image_paths = []
-        
-        try:
-            def _check_cancel():
-                if cancel_event is not None and cancel_event.is_set():
-                    print("⛔ Cancellation requested inside OCR process")
-                    raise asyncio.CancelledError()
 
+        multi_task = bool(tasks)
+        task_specs = tasks if multi_task else [{"format": output_format, "target": custom_prompt}]
+        # 先校验全部任务，避免执行到一半才发现提示词错误
+        task_results = []
+        for k, task in enumerate(task_specs):
+            fmt = (task.get("format") or "").strip().lower()
+            task_dir = os.path.join(output_path, f"task_{k + 1}") if multi_task else output_path
+            task_results.append({
+                "format": fmt,
+                "target": task.get("target"),
+                "prompt": self._get_prompt(fmt, task.get("target")),
+                "dir": task_dir,
+                "pages": [],
+                "boxes_paths": [],
+                "timed_out_pages": [],
+                "degenerate_pages": [],
+                "layout": [] if layout else None,
+                "layout_path": os.path.join(task_dir, "layout.jsonl") if layout else None,
+            })
+
+        mode = (mode or "").strip().lower()
+        page_modes = []
+        skipped_pages = []
+
+        def _check_cancel():
+            if cancel_event is not None and cancel_event.is_set():
+                print("⛔ Cancellation requested inside OCR process")
+                raise asyncio.CancelledError()
+
+        try:
             _check_cancel()
             # 验证文件存在
             if not os.path.exists(file_path):
                 raise RuntimeError(f"File not found: {file_path}")
-            
+
             file_size = os.path.getsize(file_path)
             if file_size == 0:
                 raise RuntimeError(f"File is empty: {file_path}")
-            
+
             # 检测文件类型
             file_ext = os.path.splitext(file_path)[1].lower()
-            print(f"Processing OCR with mode={mode}, format={output_format}")
+            is_pdf = file_ext == '.pdf'
+            print(f"Processing OCR with mode={mode}, tasks={[t['format'] for t in task_results]}")
             print(f"File: {file_path} ({file_size} bytes)")
             print(f"File type: {file_ext}")
-            print(f"Mode params: {mode_params}")
-            
-            # 处理 PDF 文件
-            if file_ext == '.pdf':
+            os.makedirs(output_path, exist_ok=True)
+            for task_result in task_results:
+                os.makedirs(task_result["dir"], exist_ok=True)
+
+            if is_pdf:
                 print("PDF file detected, converting to images...")
                 pdf_images_dir = os.path.join(output_path, "pdf_pages")
                 os.makedirs(pdf_images_dir, exist_ok=True)
-                os.makedirs(output_path, exist_ok=True)
-                
-                image_paths = self._pdf_to_images(file_path, pdf_images_dir)
-                
-                # 处理每一页
-                all_results = []
-                # 初始化/清空流式结果文件
-                try:
-                    open(self._get_stream_path(output_path), "w", encoding="utf-8", errors="ignore").close()
-                except Exception:
-                    pass
-                
-                # 创建线程池用于同步推理
-                import asyncio
-                import concurrent.futures
-                loop = asyncio.get_event_loop()
-                executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-                try:
-                    for idx, img_path in enumerate(image_paths):
-                        _check_cancel()
-                        print(f"\nProcessing page {idx + 1}/{len(image_paths)}...")
-                        print(f"Prompt: {prompt[:100]}...")
-                        
-                        # 为每一页创建独立的输出目录
-                        page_output_dir = os.path.join(output_path, f"page_{idx + 1}")
-                        os.makedirs(page_output_dir, exist_ok=True)
-                        
-                        # 在线程池中运行同步推理，避免阻塞事件循环
-                        def sync_infer():
-                            return self.model.infer(
-                                self.tokenizer,
-                                prompt=prompt,
-                                image_file=img_path,
-                                output_path=page_output_dir,
-                                base_size=mode_params["base_size"],
-                                image_size=mode_params["image_size"],
-                                crop_mode=mode_params["crop_mode"],
-                                save_results=True,
-                                test_compress=False,
-                                cancel_event=thread_cancel_event
-                            )
-                        
-                        print(f"⏳ Starting async inference for page {idx + 1}...")
-                        try:
-                            result = await loop.run_in_executor(executor, sync_infer)
-                        except asyncio.CancelledError:
-                            raise
-                        except RuntimeError as infer_error:
-                            if "inference_cancelled" in str(infer_error).lower():
-                                raise asyncio.CancelledError()
-                            raise
-                        print(f"⏳ Inference completed for page {idx + 1}")
-                    
-                        print(f"📋 Page {idx + 1} infer result type: {type(result)}")
-                        print(f"📋 Page {idx + 1} infer result: {result}")
-                        
-                        # 转换结果为字符串
-                        if result is None:
-                            # 模型返回None时，尝试从保存的文件读取
-                            print(f"⚠️  Page {idx + 1}: Model returned None, trying fallback read...")
-                            fallback_text = self._read_fallback_output(page_output_dir)
-                            if fallback_text and fallback_text.strip():
-                                page_text = fallback_text
-                                print(f"✅ Page {idx + 1}: Fallback read success, {len(page_text)} chars")
-                            else:
-                                page_text = "[OCR返回为空，请检查图片质量或prompt]"
-                                print(f"❌ Page {idx + 1}: Model returned None and no saved file found")
-                        elif isinstance(result, (list, tuple)):
-                            page_text = str(result[0]) if result else ""
-                            print(f"✅ Page {idx + 1}: Got result from list/tuple, {len(page_text)} chars")
-                        elif isinstance(result, dict):
-                            page_text = str(result.get('text', result))
-                            print(f"✅ Page {idx + 1}: Got result from dict, {len(page_text)} chars")
-                        else:
-                            page_text = str(result)
-                            print(f"✅ Page {idx + 1}: Got result as string, {len(page_text)} chars")
-                        
-                        print(f"📝 Page {idx + 1} text length: {len(page_text)} chars")
-                        all_results.append(f"--- Page {idx + 1} ---\n{page_text}")
-
-                        # 检查是否有带框图片（等待写入完成）
-                        result_with_boxes = os.path.join(page_output_dir, "result_with_boxes.jpg")
-                        has_image = self._wait_for_file(result_with_boxes, timeout=6.0)
-
-                        image_path = None
-                        if has_image:
-                            collected_image_paths.append(result_with_boxes)
-                            image_path = result_with_boxes
-                            print(f"✅ Page {idx + 1} result_with_boxes.jpg found")
-                        else:
-                            # 即使图片不存在，也继续处理，不影响文本结果
-                            print(f"⚠️  Page {idx + 1} result_with_boxes.jpg NOT found after waiting, continuing...")
-
-                        # 边解析边保存与输出
-                        self._append_stream(output_path, page_text, header=f"--- Page {idx + 1} ---")
-                        try:
-                            print(f"\n[Stream] Page {idx + 1} output (first 200 chars):\n{page_text[:200]}\n")
-                        except Exception:
-                            pass
-
-                        # 即时向上层回调，驱动前端实时显示
-                        print(f"🚀 Sending page {idx + 1} to frontend via callback...")
-                        if on_progress is not None:
-                            try:
-                                await on_progress({
-                                    "type": "page",
-                                    "page": idx + 1,
-                                    "total": len(image_paths),
-                                    "text": page_text,
-                                    "image_path": image_path
-                                })
-                                print(f"✅ Page {idx + 1} callback completed")
-                                # 重要：让出控制权给事件循环，确保SSE立即发送
-                                import asyncio
-                                await asyncio.sleep(0.1)
-                            except Exception as e:
-                                print(f"❌ Page {idx + 1} callback failed: {e}")
-                                pass
-                        _check_cancel()
-                        
-                        # 不删除临时图片，保留用于预览
-                        # 注释掉：os.remove(img_path)
-                finally:
-                    executor.shutdown(wait=False)
-                
-                _check_cancel()
-
-                # 合并所有页面结果
-                final_result = "\n\n".join(all_results)
-                # 如果每页均为空占位，尝试整体回退读取一次
-                if not final_result.strip() or all('[OCR返回为空' in r for r in all_results):
-                    fb_all = self._read_fallback_output(output_path)
-                    if fb_all.strip():
-                        final_result = fb_all
-                print(f"\nProcessed {len(image_paths)} pages successfully")
-                _check_cancel()
-                if not (output_format == "rec" and final_result == ""):
-                    try:
-                        self._post_save_outputs(output_path, final_result, output_format)
-                    except Exception:
-                        pass
-                
+                image_paths = self._pdf_to_images(file_path, pdf_images_dir, mode)
             else:
-                # 处理图片文件
                 try:
                     with Image.open(file_path) as test_img:
                         test_img.verify()
@@ -527,102 +667,175 @@ class OCRService:
                     print(f"PIL image validation: OK")
                 except Exception as pil_error:
                     raise RuntimeError(f"Invalid image file: {pil_error}")
-                
-                print(f"\n🔍 Starting image OCR inference...")
-                print(f"  Full Prompt: {prompt}")
-                print(f"  Image file: {file_path}")
-                print(f"  Output path: {output_path}")
-                print(f"  Base size: {mode_params['base_size']}")
-                print(f"  Image size: {mode_params['image_size']}")
-                print(f"  Crop mode: {mode_params['crop_mode']}")
-                os.makedirs(output_path, exist_ok=True)
-                
-                _check_cancel()
+                # 上传文件在请求结束后删除，推理和按需渲染标注图都使用输出目录中的副本
+                image_paths = [self._keep_source_image(file_path, output_path)]
 
-                try:
-                    result = self.model.infer(
-                        self.tokenizer,
-                        prompt=prompt,
-                        image_file=file_path,
-                        output_path=output_path,
-                        base_size=mode_params["base_size"],
-                        image_size=mode_params["image_size"],
-                        crop_mode=mode_params["crop_mode"],
-                        save_results=True,
-                        test_compress=False,
-                        cancel_event=thread_cancel_event
-                    )
-                except RuntimeError as infer_error:
-                    if "inference_cancelled" in str(infer_error).lower():
-                        raise asyncio.CancelledError()
-                    raise
-                
-                print(f"🔍 Inference completed!")
-                _check_cancel()
-                
-                print(f"\n📋 Raw infer result:")
-                print(f"  Type: {type(result)}")
-                print(f"  Content: {result}")
-                print(f"  Preview (first 500 chars): {str(result)[:500]}...")
-                
-                # 确保 result 是字符串类型
-                if result is None:
-                    if output_format == "rec":
-                        print("⚠️  Model returned None but rec mode only needs image; skipping fallback text read")
-                        final_result = ""
+            # 初始化/清空流式结果文件
+            try:
+                open(self._get_stream_path(output_path), "w", encoding="utf-8", errors="ignore").close()
+            except Exception:
+                pass
+
+            loop = asyncio.get_event_loop()
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            # 已完成推理的页面，用于识别后续的重复页
+            seen_pages = []
+            try:
+                for idx, img_path in enumerate(image_paths):
+                    _check_cancel()
+                    page_no = idx + 1
+                    print(f"\nProcessing page {page_no}/{len(image_paths)}...")
+                    page_output_dir = os.path.join(output_path, f"page_{page_no}") if is_pdf else output_path
+
+                    # 推理前识别空白页/重复页，命中时不占用 GPU
+                    fingerprint = self._fingerprint_page(img_path) if is_pdf else None
+                    skip = self._classify_page(fingerprint, seen_pages) if is_pdf else None
+                    if skip is not None:
+                        source = skip.get("source")
+                        self.page_skip_stats["blank_pages" if source is None else "duplicate_pages"] += 1
+                        self.page_skip_stats["gpu_seconds_saved"] += (self._avg_page_seconds or 0.0) * len(task_results)
+                        skipped_pages.append({"page": page_no, "reason": skip["reason"],
+                                              "source_page": source["page"] if source else None})
+                        page_mode = source["page_mode"] if source else {"mode": None, "estimated_tokens": 0}
+                        page_modes.append({"page": page_no, "mode": page_mode["mode"],
+                                           "estimated_tokens": 0, "skipped": skip["reason"]})
+                        print(f"⏭️  Page {page_no}: skipped ({skip['reason']})")
+                        page_results = [
+                            dict(source["results"][k], timed_out=False, degenerate=False) if source else
+                            {"text": "", "boxes_path": None, "layout": None, "timed_out": False, "degenerate": False}
+                            for k in range(len(task_results))
+                        ]
                     else:
-                        fallback_text = self._read_fallback_output(output_path)
-                        final_result = fallback_text if fallback_text.strip() else "[OCR返回为空，请检查图片质量或prompt]"
-                        print(f"⚠️  Model returned None!")
-                elif isinstance(result, (list, tuple)):
-                    final_result = str(result[0]) if result else ""
-                    print(f"✅ Converted from list/tuple, length: {len(final_result)}")
-                elif isinstance(result, dict):
-                    final_result = str(result.get('text', result))
-                    print(f"✅ Converted from dict, length: {len(final_result)}")
+                        # 档位只按页面内容选择一次，所有任务共用
+                        page_mode = self._resolve_page_mode(mode, img_path, max_crops)
+                        page_params = page_mode["params"]
+                        page_modes.append({"page": page_no, "mode": page_mode["mode"],
+                                           "estimated_tokens": page_mode["estimated_tokens"]})
+                        print(f"  Mode: {page_mode['mode']} (~{page_mode['estimated_tokens']} vision tokens), "
+                              f"base_size={page_params['base_size']}, image_size={page_params['image_size']}, "
+                              f"crop_mode={page_params['crop_mode']}")
+                        # 同一页面的多个任务共用一份视觉编码记录，页面结束后释放
+                        vision_records = [] if len(task_results) > 1 else None
+                        page_results = []
+                        for k, task_result in enumerate(task_results):
+                            _check_cancel()
+                            out_dir = os.path.join(page_output_dir, f"task_{k + 1}") if multi_task else page_output_dir
+                            os.makedirs(out_dir, exist_ok=True)
+                            print(f"⏳ Starting inference for page {page_no} ({task_result['format']}): "
+                                  f"{task_result['prompt'][:100]}...")
+                            result, timed_out, degenerate = await self._infer_page(
+                                loop, executor, task_result["prompt"], img_path, out_dir, page_params,
+                                deadline, thread_cancel_event, vision_records)
+
+                            page_layout = None
+                            boxes_path = None
+                            if timed_out:
+                                page_text = TIMEOUT_PLACEHOLDER
+                                print(f"⏱️  Page {page_no}: exceeded its time budget, skipped")
+                            else:
+                                page_text = self._result_text(result, out_dir, task_result["format"])
+                                if result is not None:
+                                    # 原始输出：解析出干净文本与框数据，标注图留到首次请求时再渲染
+                                    page_text, page_layout, boxes_path = self._layout_page(page_text, img_path, out_dir)
+                            print(f"📝 Page {page_no} ({task_result['format']}) text length: {len(page_text)} chars")
+                            page_results.append({"text": page_text, "boxes_path": boxes_path, "layout": page_layout,
+                                                 "timed_out": timed_out, "degenerate": degenerate})
+                        if vision_records is not None and self._vision_reuse is not None:
+                            print(f"♻️  视觉编码复用: 累计命中 {self._vision_reuse.hits} 次")
+
+                        # 仅复用有效结果，超时/空结果的页面仍需重新推理
+                        if is_pdf and all(not page["timed_out"] and '[OCR返回为空' not in page["text"]
+                                          for page in page_results):
+                            seen_pages.append({"page": page_no, "fingerprint": fingerprint,
+                                               "results": page_results, "page_mode": page_mode})
+
+                    for k, (task_result, page) in enumerate(zip(task_results, page_results)):
+                        skipped = skip["reason"] if skip is not None else None
+                        task_result["pages"].append({"page": page_no, "text": page["text"],
+                                                     "boxes_path": page["boxes_path"], "timed_out": page["timed_out"],
+                                                     "degenerate": page["degenerate"], "skipped": skipped})
+                        if page["boxes_path"]:
+                            task_result["boxes_paths"].append(page["boxes_path"])
+                        if page["timed_out"]:
+                            task_result["timed_out_pages"].append(page_no)
+                        if page["degenerate"]:
+                            task_result["degenerate_pages"].append(page_no)
+                        page_layout = page["layout"] or {"width": None, "height": None, "blocks": []}
+                        if layout:
+                            task_result["layout"].append(dict(page_layout, page=page_no))
+                            append_layout_jsonl(task_result["layout_path"], page_no, page_layout["blocks"])
+
+                        # 边解析边保存与输出
+                        header = f"--- Page {page_no} ---" if is_pdf else "--- Image Result ---"
+                        if multi_task:
+                            header = f"{header} [{task_result['format']}]"
+                        self._append_stream(output_path, page["text"], header=header)
+
+                        # 即时向上层回调，驱动前端实时显示
+                        if on_progress is not None:
+                            event = {
+                                "type": "page" if is_pdf else "image",
+                                "text": page["text"],
+                                "boxes_path": page["boxes_path"],
+                                "mode": page_mode["mode"],
+                                "estimated_tokens": page_mode["estimated_tokens"],
+                                "timed_out": page["timed_out"],
+                                "degenerate": page["degenerate"],
+                                "skipped": skipped,
+                                "blocks": page_layout["blocks"] if layout else None,
+                            }
+                            if is_pdf:
+                                event.update(page=page_no, total=len(image_paths))
+                            if multi_task:
+                                event.update(task=k, format=task_result["format"])
+                            try:
+                                await on_progress(event)
+                                # 让出控制权给事件循环，确保SSE立即发送
+                                await asyncio.sleep(0.1)
+                            except Exception as e:
+                                print(f"❌ Page {page_no} callback failed: {e}")
+                    _check_cancel()
+            finally:
+                executor.shutdown(wait=False)
+
+            _check_cancel()
+            for task_result in task_results:
+                pages = task_result["pages"]
+                if is_pdf:
+                    final_result = "\n\n".join(f"--- Page {page['page']} ---\n{page['text']}" for page in pages)
+                    # 如果每页均为空占位，尝试整体回退读取一次
+                    if not final_result.strip() or all('[OCR返回为空' in page["text"] for page in pages):
+                        fb_all = self._read_fallback_output(task_result["dir"])
+                        if fb_all.strip():
+                            final_result = fb_all
                 else:
-                    final_result = str(result)
-                    print(f"✅ Converted to string, length: {len(final_result)}")
-                
-                print(f"\n✨ Final result length: {len(final_result)} characters")
-                print(f"✨ Final result preview (first 200 chars): {final_result[:200]}...")
-                # 立即写入流式结果文件
-                self._append_stream(output_path, final_result, header="--- Image Result ---")
-
-                # 检查是否有带框图片
-                result_with_boxes = os.path.join(output_path, "result_with_boxes.jpg")
-                image_path = result_with_boxes if self._wait_for_file(result_with_boxes, timeout=6.0) else None
-                if image_path:
-                    collected_image_paths.append(image_path)
-                    print(f"✅ result_with_boxes.jpg found for single image")
-                    if output_format == "rec" and final_result == "":
-                        print("🎯 rec模式：仅返回标注图，无需文本")
-
-                # 单图也向上层回调一次，便于统一前端逻辑
-                if on_progress is not None:
-                    try:
-                        print(f"📤 Sending image callback to frontend, image_path: {image_path}")
-                        await on_progress({
-                            "type": "image",
-                            "text": final_result,
-                            "image_path": image_path
-                        })
-                        print(f"✅ Image callback sent successfully")
-                    except Exception as e:
-                        print(f"❌ Image callback failed: {e}")
-                        pass
+                    final_result = pages[0]["text"]
+                task_result["text"] = final_result
                 # 强制保存输出，确保生成 .mmd/.md 文件
                 try:
-                    self._post_save_outputs(output_path, final_result, output_format)
+                    self._post_save_outputs(task_result["dir"], final_result, task_result["format"])
                 except Exception:
                     pass
-            
-            return {
-                "text": final_result,
-                "prompt": prompt,
-                "image_paths": collected_image_paths
-            }   
-            
+                del task_result["dir"]
+            print(f"\nProcessed {len(image_paths)} page(s) x {len(task_results)} task(s)")
+
+            # 顶层字段沿用单任务结构，多任务时取第一个任务，便于旧客户端读取
+            first = task_results[0]
+            result = {
+                "text": first["text"],
+                "prompt": first["prompt"],
+                "boxes_paths": [path for task_result in task_results for path in task_result["boxes_paths"]],
+                "page_modes": page_modes,
+                "timed_out_pages": sorted({p for t in task_results for p in t["timed_out_pages"]}),
+                "skipped_pages": skipped_pages,
+                "degenerate_pages": sorted({p for t in task_results for p in t["degenerate_pages"]}),
+                "layout": first["layout"],
+                "layout_path": first["layout_path"],
+            }
+            if multi_task:
+                result["tasks"] = task_results
+            return result
+
         except asyncio.CancelledError:
             print("OCR processing cancelled by user")
             raise
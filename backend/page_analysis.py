@@ -0,0 +1,260 @@
+"""页面内容分析：为 auto 模式挑选最省的分辨率档位，并估算视觉 token 数"""
+import math
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# 分辨率档位表（与 /api/configs 中的 modes 保持一致）
+MODE_TABLE: Dict[str, Dict] = {
+    "tiny": {"base_size": 512, "image_size": 512, "crop_mode": False},
+    "small": {"base_size": 640, "image_size": 640, "crop_mode": False},
+    "base": {"base_size": 1024, "image_size": 1024, "crop_mode": False},
+    "large": {"base_size": 1280, "image_size": 1280, "crop_mode": False},
+    "gundam": {"base_size": 1024, "image_size": 640, "crop_mode": True},
+}
+
+# 与模型 dynamic_preprocess 默认值一致的切片数量范围
+MIN_CROPS = 2
+MAX_CROPS = 9
+
+PATCH_SIZE = 16
+DOWNSAMPLE_RATIO = 4
+
+# 分析参数
+ANALYSIS_MAX_SIDE = 1024      # 分析前将长边缩到该尺寸以内，控制 CPU 开销
+INK_THRESHOLD = 160           # 灰度低于该值视为墨迹
+ROW_INK_MIN = 0.002           # 行内墨迹占比超过该值视为文字行
+BLANK_INK_RATIO = 0.001       # 整页墨迹占比低于该值视为空白页
+MIN_LINE_PX = 10              # 缩放到模型输入后，文字行高至少需要的像素数
+MAX_COMPRESSION = 10.0        # 文本 token / 视觉 token 的最大压缩比，超过则精度明显下降
+CHAR_WIDTH_RATIO = 0.5        # 平均字符宽度 / 行高
+LINE_FILL = 0.7               # 文字行平均填充率
+CHARS_PER_TOKEN = 3.0         # 平均每个文本 token 对应的字符数
+HASH_SIZE = 32                # 感知哈希边长（32×32 = 1024 位）
+DUPLICATE_MAX_DISTANCE = 32   # 感知哈希汉明距离不超过该值的页面才进入逐块比较
+TILE_SIZE = 8                 # 逐块比较的块边长（像素，在缩放到 ANALYSIS_MAX_SIDE 的灰度图上）
+DUPLICATE_MAX_TILE_DIFF = 8.0 # 去掉整体亮度差后，每个块的平均灰度差都不超过该值才视为重复页
+
+
+@lru_cache(maxsize=None)
+def _target_ratios(min_num: int, max_num: int) -> Tuple[Tuple[int, int], ...]:
+    ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1)
+        if min_num <= i * j <= max_num
+    )
+    return tuple(sorted(ratios, key=lambda x: x[0] * x[1]))
+
+
+def count_tiles(width: int, height: int, image_size: int = 640,
+                min_num: int = MIN_CROPS, max_num: int = MAX_CROPS) -> Tuple[int, int]:
+    """按模型的切片规则计算 (宽方向切片数, 高方向切片数)"""
+    aspect_ratio = width / height
+    area = width * height
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    for ratio in _target_ratios(min_num, max_num):
+        ratio_diff = abs(aspect_ratio - ratio[0] / ratio[1])
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    return best_ratio
+
+
+def get_tile_grid(mode_params: Dict, width: int, height: int, max_crops: int = MAX_CROPS) -> Tuple[int, int]:
+    """返回该档位下页面的切片网格，未切片时为 (1, 1)"""
+    if not mode_params.get("crop_mode") or (width <= 640 and height <= 640):
+        return (1, 1)
+    if max_crops < MIN_CROPS:
+        return (1, 1)
+    return count_tiles(width, height, mode_params["image_size"], MIN_CROPS, max_crops)
+
+
+def estimate_vision_tokens(mode_params: Dict, width: int, height: int, max_crops: int = MAX_CROPS) -> int:
+    """估算一页在指定档位下产生的视觉 token 数（全局视图 + 局部切片 + 分隔符）"""
+    n_base = math.ceil((mode_params["base_size"] // PATCH_SIZE) / DOWNSAMPLE_RATIO)
+    tokens = n_base * (n_base + 1) + 1
+
+    w_tiles, h_tiles = get_tile_grid(mode_params, width, height, max_crops)
+    if w_tiles > 1 or h_tiles > 1:
+        n_local = math.ceil((mode_params["image_size"] // PATCH_SIZE) / DOWNSAMPLE_RATIO)
+        tokens += (n_local * h_tiles) * (n_local * w_tiles + 1)
+    return tokens
+
+
+def target_render_size(mode_params: Dict, width: float, height: float) -> Tuple[float, float]:
+    """返回预处理实际会用到的最小像素尺寸，用于确定 PDF 渲染分辨率
+
+    Args:
+        width, height: 页面原始尺寸（如 PDF 点数）；实际渲染尺寸为返回值向上取整
+    """
+    base_size = mode_params["base_size"]
+    image_size = mode_params["image_size"]
+    if not mode_params.get("crop_mode") and image_size <= 640:
+        # tiny/small 直接拉伸到 image_size × image_size，短边需要 image_size 像素
+        scale = image_size / min(width, height)
+    else:
+        # 全局视图按长边等比缩放到 base_size
+        scale = base_size / max(width, height)
+
+    if mode_params.get("crop_mode"):
+        # 宽高比相同的候选网格按面积取舍，所以网格要按渲染后的像素尺寸计算，不能用页面点数；
+        # 面积越大网格只会越大，放大后重新计算，直到网格不再变化
+        grid = None
+        while True:
+            new_grid = get_tile_grid(mode_params, math.ceil(width * scale), math.ceil(height * scale))
+            if new_grid == grid:
+                break
+            grid = new_grid
+            scale = max(scale, image_size * grid[0] / width, image_size * grid[1] / height)
+    return width * scale, height * scale
+
+
+def _vertical_scale(mode_params: Dict, width: int, height: int, max_crops: int = MAX_CROPS) -> float:
+    """页面缩放到模型输入后的纵向缩放比例（取全局视图与切片中分辨率更高者）"""
+    base_size = mode_params["base_size"]
+    image_size = mode_params["image_size"]
+    if not mode_params.get("crop_mode") and image_size <= 640:
+        # tiny/small 直接拉伸到 image_size × image_size
+        scale = image_size / height
+    else:
+        scale = base_size / max(width, height)
+
+    w_tiles, h_tiles = get_tile_grid(mode_params, width, height, max_crops)
+    if w_tiles > 1 or h_tiles > 1:
+        scale = max(scale, image_size * h_tiles / height)
+    return scale
+
+
+def analyze_page(image: Image.Image) -> Dict:
+    """对页面做快速 CPU 分析：分辨率、墨迹占比、文字密度、估计行高"""
+    width, height = image.size
+    gray = image.convert("L")
+    scale = min(1.0, ANALYSIS_MAX_SIDE / max(width, height))
+    if scale < 1.0:
+        gray = gray.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+
+    ink = np.asarray(gray) < INK_THRESHOLD
+    ink_ratio = float(ink.mean()) if ink.size else 0.0
+
+    # 行投影：连续含墨迹的行视为一行文字
+    text_rows = ink.mean(axis=1) > ROW_INK_MIN
+    padded = np.concatenate(([0], text_rows.astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(padded))
+    run_lengths = edges[1::2] - edges[0::2]
+    run_lengths = run_lengths[run_lengths >= 2]
+
+    line_height: Optional[float] = None
+    if run_lengths.size:
+        line_height = float(np.median(run_lengths)) / scale
+
+    inked_cols = np.flatnonzero(ink.any(axis=0))
+    content_width = float(inked_cols[-1] - inked_cols[0] + 1) / scale if inked_cols.size else 0.0
+
+    num_lines = int(run_lengths.size)
+    est_text_tokens = 0
+    if line_height:
+        est_chars = num_lines * content_width / (CHAR_WIDTH_RATIO * line_height) * LINE_FILL
+        est_text_tokens = int(est_chars / CHARS_PER_TOKEN)
+
+    return {
+        "width": width,
+        "height": height,
+        "ink_ratio": round(ink_ratio, 5),
+        "text_density": round(float(text_rows.mean()) if text_rows.size else 0.0, 4),
+        "line_height": round(line_height, 2) if line_height else None,
+        "num_lines": num_lines,
+        "est_text_tokens": est_text_tokens,
+    }
+
+
+def choose_mode(stats: Dict, max_crops: int = MAX_CROPS) -> Dict:
+    """按估算 token 数从低到高尝试各档位，返回第一个预计能保持精度的档位"""
+    width, height = stats["width"], stats["height"]
+    costs = {name: estimate_vision_tokens(params, width, height, max_crops) for name, params in MODE_TABLE.items()}
+
+    if stats["ink_ratio"] < BLANK_INK_RATIO:
+        return {"mode": "tiny", "estimated_tokens": costs["tiny"], "reason": "blank"}
+
+    line_height = stats.get("line_height")
+    if not line_height:
+        # 无可识别文字行（图片/图表），分辨率要求不高
+        return {"mode": "small", "estimated_tokens": costs["small"], "reason": "no_text_lines"}
+
+    best_name, best_px = None, -1.0
+    for name in sorted(costs, key=costs.get):
+        params = MODE_TABLE[name]
+        line_px = line_height * _vertical_scale(params, width, height, max_crops)
+        if line_px > best_px:
+            best_name, best_px = name, line_px
+        if line_px >= MIN_LINE_PX and stats["est_text_tokens"] <= MAX_COMPRESSION * costs[name]:
+            return {"mode": name, "estimated_tokens": costs[name], "reason": f"line_px={line_px:.1f}"}
+
+    # 没有档位满足条件时，退回分辨率最高的档位
+    return {"mode": best_name, "estimated_tokens": costs[best_name], "reason": f"max_resolution line_px={best_px:.1f}"}
+
+
+def _analysis_gray(image: Image.Image) -> np.ndarray:
+    """长边缩到 ANALYSIS_MAX_SIDE 以内的灰度像素"""
+    gray = image.convert("L")
+    gray.thumbnail((ANALYSIS_MAX_SIDE, ANALYSIS_MAX_SIDE), Image.BILINEAR)
+    return np.asarray(gray)
+
+
+def perceptual_hash(gray: np.ndarray, hash_size: int = HASH_SIZE) -> int:
+    """均值哈希：缩成 hash_size × hash_size 后每格是否亮于整页均值
+
+    文档页面大面积为白底，差值哈希在白底上的比较位会被扫描噪声随机翻转；均值哈希的比较对象是整页均值，
+    白底格和文字格都远离均值，噪声不会改变结果。
+    """
+    small = np.asarray(Image.fromarray(gray).resize((hash_size, hash_size), Image.BILINEAR), dtype=np.float32)
+    bits = (small > small.mean()).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def tile_means(gray: np.ndarray, tile: int = TILE_SIZE) -> np.ndarray:
+    """灰度图每个 tile × tile 块的平均灰度（边缘不足一块的部分按边缘像素补齐）"""
+    height, width = gray.shape
+    padded = np.pad(gray.astype(np.float32), ((0, -height % tile), (0, -width % tile)), mode="edge")
+    return padded.reshape(padded.shape[0] // tile, tile, padded.shape[1] // tile, tile).mean(axis=(1, 3))
+
+
+def max_tile_difference(a: np.ndarray, b: np.ndarray) -> float:
+    """两页对应块平均灰度差的最大值；先减去差值的中位数，扫描件整体偏亮/偏暗不计入"""
+    if a.shape != b.shape:
+        return float("inf")
+    diff = a - b
+    return float(np.abs(diff - np.median(diff)).max())
+
+
+def page_fingerprint(image: Image.Image) -> Dict:
+    """推理前识别空白页/重复页所需的页面指纹：尺寸、墨迹占比、感知哈希和逐块平均灰度"""
+    gray = _analysis_gray(image)
+    return {
+        "size": image.size,
+        "ink_ratio": float((gray < INK_THRESHOLD).mean()),
+        "phash": perceptual_hash(gray),
+        "tiles": tile_means(gray),
+    }
+
+
+def is_duplicate_page(fingerprint: Dict, other: Dict, max_distance: int = DUPLICATE_MAX_DISTANCE,
+                      max_tile_diff: float = DUPLICATE_MAX_TILE_DIFF) -> bool:
+    """两页是否为同一页面（重复扫描、重复封面等）
+
+    感知哈希只做候选过滤：只有填写内容不同的表单、发票在感知哈希下几乎相同，
+    所以还要逐块比较平均灰度，任一块（约一个字符大小）不同就不算重复。
+    """
+    if fingerprint["size"] != other["size"]:
+        return False
+    if hamming_distance(fingerprint["phash"], other["phash"]) > max_distance:
+        return False
+    return max_tile_difference(fingerprint["tiles"], other["tiles"]) <= max_tile_diff
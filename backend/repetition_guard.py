@@ -0,0 +1,124 @@
+"""解码重复循环检测：模型陷入周期性输出时提前结束生成，并把页面标记为退化结果"""
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+class RepetitionLoopDetector:
+    """在线检测 token 序列末尾的周期性循环
+
+    对每个候选周期 p（1..max_period）维护末尾满足 ids[i] == ids[i - p] 的连续长度，
+    每个新 token 的开销为 O(max_period)。当周期性尾部覆盖至少 min_loop_tokens 个 token
+    且至少重复 min_repeats 轮时判定为循环。
+    """
+
+    def __init__(self, max_period: int = 256, min_loop_tokens: int = 1024, min_repeats: int = 4):
+        if max_period <= 0:
+            raise ValueError(f"max_period 必须为正整数: {max_period}")
+        self.max_period = max_period
+        self.min_loop_tokens = min_loop_tokens
+        self.min_repeats = min_repeats
+        self.reset()
+
+    def reset(self) -> None:
+        self._tokens: List[int] = []
+        self._runs = [0] * (self.max_period + 1)
+        self.loop: Optional[Tuple[int, int]] = None
+
+    def push(self, token_id: int) -> Optional[Tuple[int, int]]:
+        """追加一个 token，检测到循环后返回 (周期, 循环跨度)"""
+        tokens = self._tokens
+        tokens.append(token_id)
+        length = len(tokens)
+        runs = self._runs
+        for period in range(1, min(self.max_period, length - 1) + 1):
+            if tokens[-1] == tokens[-1 - period]:
+                runs[period] += 1
+                span = runs[period] + period
+                if self.loop is None and span >= self.min_loop_tokens and span >= period * self.min_repeats:
+                    self.loop = (period, span)
+            else:
+                runs[period] = 0
+        if length > 2 * (self.max_period + 1):
+            # 只会与最近 max_period + 1 个 token 比较
+            del tokens[:length - self.max_period - 1]
+        return self.loop
+
+    def extend(self, token_ids) -> Optional[Tuple[int, int]]:
+        for token_id in token_ids:
+            self.push(token_id)
+        return self.loop
+
+
+class RepetitionStoppingCriteria(StoppingCriteria):
+    """transformers 停止条件：生成内容出现周期性循环时结束生成
+
+    检测状态按线程保存，同一实例可被多个推理线程共享；每次推理前调用 reset()。
+    为减少 GPU 同步，每 check_interval 步才把新生成的 token 取回 CPU 检查一次。
+    """
+
+    def __init__(self, max_period: int = 256, min_loop_tokens: int = 1024,
+                 min_repeats: int = 4, check_interval: int = 32):
+        self.max_period = max_period
+        self.min_loop_tokens = min_loop_tokens
+        self.min_repeats = min_repeats
+        self.check_interval = max(1, check_interval)
+        self._local = threading.local()
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "RepetitionStoppingCriteria":
+        """从 inference.repetition_stop 配置构建"""
+        return cls(
+            max_period=config.get("max_period", 256),
+            min_loop_tokens=config.get("min_loop_tokens", 1024),
+            min_repeats=config.get("min_repeats", 4),
+            check_interval=config.get("check_interval", 32),
+        )
+
+    def _state(self):
+        state = self._local
+        if not hasattr(state, "detector"):
+            state.detector = RepetitionLoopDetector(self.max_period, self.min_loop_tokens, self.min_repeats)
+            state.seen = None
+        return state
+
+    def reset(self) -> None:
+        state = self._state()
+        state.detector.reset()
+        state.seen = None
+
+    @property
+    def loop(self) -> Optional[Tuple[int, int]]:
+        """当前线程最近一次推理检测到的循环 (周期, 跨度)，未检测到时为 None"""
+        return self._state().detector.loop
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        state = self._state()
+        length = input_ids.shape[-1]
+        if state.seen is None or length < state.seen:
+            # 第一次调用时已生成 1 个 token，之前的部分是 prompt（含大量相同的图像占位 token）
+            state.detector.reset()
+            state.seen = length - 1
+        stop = state.detector.loop is not None
+        if not stop and length - state.seen >= self.check_interval:
+            stop = state.detector.extend(input_ids[0, state.seen:].tolist()) is not None
+            state.seen = length
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+def install_stopping_criteria(model, criteria: StoppingCriteria) -> None:
+    """包装 model.generate，为每次生成追加停止条件
+
+    模型自带的 infer() 内部直接调用 self.generate，无法从外部传入 stopping_criteria，
+    因此在实例上替换 generate。
+    """
+    original_generate = model.generate
+
+    def generate(*args, **kwargs):
+        existing = kwargs.get("stopping_criteria") or []
+        kwargs["stopping_criteria"] = StoppingCriteriaList(list(existing) + [criteria])
+        return original_generate(*args, **kwargs)
+
+    model.generate = generate
@@ -0,0 +1,294 @@
+"""OCR 请求调度器：控制推理并发，并在过载时按策略降级分辨率档位"""
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from page_analysis import MODE_TABLE, estimate_vision_tokens
+
+# 用于给档位排序的参考页面尺寸（A4 @ 144 DPI）
+_REFERENCE_PAGE = (1191, 1684)
+
+
+def _mode_cost(mode: str) -> int:
+    return estimate_vision_tokens(MODE_TABLE[mode], *_REFERENCE_PAGE)
+
+
+# 按参考页面的视觉 token 数从低到高排列的档位
+MODES_BY_COST = sorted(MODE_TABLE, key=_mode_cost)
+
+
+def read_gpu_utilization() -> Optional[float]:
+    """读取当前 GPU 利用率（百分比），不可用时返回 None"""
+    try:
+        import torch
+        if not torch.cuda.is_available():
+            return None
+        return float(torch.cuda.utilization())
+    except Exception:
+        return None
+
+
+class RequestTimeouts:
+    """由 service.timeout 配置推导出的请求/单页时间预算"""
+
+    def __init__(self, default_seconds: float = 300.0, per_page_seconds: float = 60.0):
+        self.default_seconds = default_seconds
+        self.per_page_seconds = per_page_seconds
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "RequestTimeouts":
+        return cls(
+            default_seconds=config.get("default_seconds", 300.0),
+            per_page_seconds=config.get("per_page_seconds", 60.0),
+        )
+
+    def request_budget(self, num_pages: int) -> float:
+        """整个请求的时间预算：至少 default_seconds，多页文档按页数放宽"""
+        return max(self.default_seconds, self.per_page_seconds * max(1, num_pages))
+
+
+class DeadlineEvent:
+    """传给推理线程的取消信号
+
+    与 threading.Event 接口兼容；用户取消或超过截止时间后 is_set() 返回 True，
+    推理在下一次轮询时停止。timed_out 标记区分超时与用户取消。
+    """
+
+    def __init__(self, expires_at: float, cancel_event: Optional[threading.Event] = None):
+        self.expires_at = expires_at
+        self.cancel_event = cancel_event
+        self.timed_out = False
+        self._event = threading.Event()
+
+    def is_set(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return True
+        if time.monotonic() >= self.expires_at:
+            self.timed_out = True
+            return True
+        return False
+
+    def set(self) -> None:
+        self._event.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        remaining = self.expires_at - time.monotonic()
+        if timeout is None or timeout > remaining:
+            timeout = max(0.0, remaining)
+        self._event.wait(timeout)
+        return self.is_set()
+
+
+class DegradationPolicy:
+    """过载降级策略
+
+    当排队等待时间或 GPU 利用率超过阈值时，将请求降到更便宜的档位，
+    并限制动态切片数量。auto 模式只限制切片数量，档位仍由页面内容决定。
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        queue_wait_seconds: float = 30.0,
+        gpu_utilization_percent: Optional[float] = 95.0,
+        min_mode: str = "small",
+        max_crops: int = 4,
+        gpu_utilization_fn: Optional[Callable[[], Optional[float]]] = None,
+    ):
+        if min_mode not in MODE_TABLE:
+            raise ValueError(f"未知的降级下限档位: {min_mode}")
+        self.enabled = enabled
+        self.queue_wait_seconds = queue_wait_seconds
+        self.gpu_utilization_percent = gpu_utilization_percent
+        self.min_mode = min_mode
+        self.max_crops = max_crops
+        self.gpu_utilization_fn = gpu_utilization_fn or read_gpu_utilization
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "DegradationPolicy":
+        """从 service.scheduler.degradation 配置构建策略"""
+        return cls(
+            enabled=config.get("enabled", False),
+            queue_wait_seconds=config.get("queue_wait_seconds", 30.0),
+            gpu_utilization_percent=config.get("gpu_utilization_percent", 95.0),
+            min_mode=config.get("min_mode", "small"),
+            max_crops=config.get("max_crops", 4),
+        )
+
+    def gpu_utilization(self) -> Optional[float]:
+        if not self.enabled or self.gpu_utilization_percent is None:
+            return None
+        return self.gpu_utilization_fn()
+
+    def _overload_reason(self, queue_wait: float, gpu_utilization: Optional[float]) -> Optional[str]:
+        if queue_wait >= self.queue_wait_seconds:
+            return f"queue_wait={queue_wait:.1f}s"
+        if (gpu_utilization is not None and self.gpu_utilization_percent is not None
+                and gpu_utilization >= self.gpu_utilization_percent):
+            return f"gpu_utilization={gpu_utilization:.0f}%"
+        return None
+
+    def decide(self, mode: str, queue_wait: float, gpu_utilization: Optional[float] = None) -> Optional[Dict]:
+        """根据当前负载决定是否降级
+
+        Args:
+            mode: 请求的档位
+            queue_wait: 请求排队等待的秒数
+            gpu_utilization: 当前 GPU 利用率百分比，未知时为 None
+
+        Returns:
+            不降级时返回 None，否则返回 {"from", "to", "max_crops", "reason"}
+        """
+        if not self.enabled:
+            return None
+        reason = self._overload_reason(queue_wait, gpu_utilization)
+        if reason is None:
+            return None
+
+        target = mode
+        if mode in MODE_TABLE and not MODE_TABLE[mode]["crop_mode"]:
+            rank = MODES_BY_COST.index(mode)
+            floor = MODES_BY_COST.index(self.min_mode)
+            if rank <= floor:
+                return None
+            target = MODES_BY_COST[rank - 1]
+        elif mode != "auto" and mode not in MODE_TABLE:
+            return None
+
+        return {"from": mode, "to": target, "max_crops": self.max_crops, "reason": reason}
+
+
+class _Job:
+    """排队中的请求"""
+
+    def __init__(self, expires_at: float, num_pages: int):
+        self.expires_at = expires_at
+        self.num_pages = num_pages
+        self.future: Optional[asyncio.Future] = None
+
+
+class OCRScheduler:
+    """位于 OCRService.process 前的调度器
+
+    空闲槽位优先分配给预计仍能在截止时间前完成的请求（其中截止时间早的优先），
+    已经赶不上的请求排在后面，等到时已超过截止时间的请求直接以 TimeoutError 拒绝。
+
+    service 只需提供 async process(**kwargs) 方法，便于在测试中替换为桩实现；
+    若还提供 count_pages(file_path)，多页文档会按页数放宽时间预算。
+    """
+
+    def __init__(
+        self,
+        service,
+        policy: Optional[DegradationPolicy] = None,
+        max_concurrency: int = 1,
+        timeouts: Optional[RequestTimeouts] = None,
+    ):
+        self.service = service
+        self.policy = policy or DegradationPolicy()
+        self.timeouts = timeouts or RequestTimeouts()
+        self.max_concurrency = max_concurrency
+        self._running = 0
+        self._waiters: List[_Job] = []
+        self._degraded_count = 0
+        self._expired_count = 0
+        # 单页平均耗时（指数滑动平均），用于判断请求能否按时完成
+        self._page_seconds = self.timeouts.per_page_seconds / 4
+
+    @property
+    def waiting(self) -> int:
+        """当前排队中的请求数"""
+        return len(self._waiters)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "waiting": len(self._waiters),
+            "running": self._running,
+            "degraded": self._degraded_count,
+            "expired": self._expired_count,
+            "page_seconds": round(self._page_seconds, 2),
+        }
+
+    def _can_meet_deadline(self, job: _Job, now: float) -> bool:
+        return now + job.num_pages * self._page_seconds <= job.expires_at
+
+    def _dispatch(self) -> None:
+        while self._running < self.max_concurrency and self._waiters:
+            now = time.monotonic()
+            job = min(self._waiters, key=lambda j: (not self._can_meet_deadline(j, now), j.expires_at))
+            self._waiters.remove(job)
+            self._running += 1
+            job.future.set_result(None)
+
+    async def _acquire(self, job: _Job) -> None:
+        if self._running < self.max_concurrency and not self._waiters:
+            self._running += 1
+            return
+        job.future = asyncio.get_running_loop().create_future()
+        self._waiters.append(job)
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job in self._waiters:
+                self._waiters.remove(job)
+            elif job.future.done() and not job.future.cancelled():
+                # 已分配到槽位但随即被取消，归还槽位
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        self._running -= 1
+        self._dispatch()
+
+    def _count_pages(self, file_path: Optional[str]) -> int:
+        count_pages = getattr(self.service, "count_pages", None)
+        if count_pages is None or not file_path:
+            return 1
+        try:
+            return max(1, int(count_pages(file_path)))
+        except Exception:
+            return 1
+
+    async def submit(self, **kwargs) -> Dict:
+        """排队执行一次 OCR 请求，参数与 OCRService.process 相同"""
+        enqueued_at = time.monotonic()
+        # 多任务请求每页推理多次，按任务数放大时间预算
+        num_tasks = max(1, len(kwargs.get("tasks") or []))
+        num_pages = 1
+        if kwargs.get("file_path"):
+            # 统计页数要打开 PDF，属于阻塞 IO，放到线程中执行，避免卡住事件循环
+            num_pages = await asyncio.to_thread(self._count_pages, kwargs["file_path"])
+        num_pages *= num_tasks
+        job = _Job(enqueued_at + self.timeouts.request_budget(num_pages), num_pages)
+
+        await self._acquire(job)
+        try:
+            started_at = time.monotonic()
+            if started_at >= job.expires_at:
+                self._expired_count += 1
+                raise TimeoutError(f"请求排队超过截止时间 ({started_at - enqueued_at:.1f}s)")
+
+            queue_wait = started_at - enqueued_at
+            mode = (kwargs.get("mode") or "").strip().lower()
+            decision = self.policy.decide(mode, queue_wait, self.policy.gpu_utilization())
+            if decision is not None:
+                self._degraded_count += 1
+                print(f"⚠️  负载过高，降级处理: {decision['from']} -> {decision['to']} "
+                      f"(max_crops={decision['max_crops']}, {decision['reason']})")
+                kwargs["mode"] = decision["to"]
+                kwargs["max_crops"] = decision["max_crops"]
+
+            result = await self.service.process(deadline=job.expires_at, **kwargs)
+
+            pages = max(1, len(result.get("page_modes") or [])) * num_tasks
+            elapsed = time.monotonic() - started_at
+            self._page_seconds = 0.8 * self._page_seconds + 0.2 * (elapsed / pages)
+        finally:
+            self._release()
+
+        result["degraded"] = decision
+        result["queue_wait_ms"] = int(queue_wait * 1000)
+        return result
@@ -0,0 +1,82 @@
+"""多任务请求的视觉特征复用：同一页面的多个提示词只做一次视觉编码"""
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+
+import torch
+
+# HF 模型（model.model）上的视觉编码模块：SAM、CLIP 与投影层
+VISION_MODULES = ("sam_model", "vision_model", "projector")
+
+
+def _same_inputs(recorded, current) -> bool:
+    if isinstance(recorded, torch.Tensor) or isinstance(current, torch.Tensor):
+        return (isinstance(recorded, torch.Tensor) and isinstance(current, torch.Tensor)
+                and recorded.shape == current.shape and recorded.dtype == current.dtype
+                and recorded.device == current.device and torch.equal(recorded, current))
+    if isinstance(recorded, (list, tuple)) and isinstance(current, (list, tuple)):
+        return len(recorded) == len(current) and all(_same_inputs(r, c) for r, c in zip(recorded, current))
+    return recorded == current
+
+
+class VisionFeatureReuse:
+    """按调用顺序记录并回放视觉编码模块的输出
+
+    模型自带的 infer() 每次都会重新预处理图片并在 prefill 时调用 SAM -> CLIP -> 投影层。
+    同一页面、同一档位的预处理结果完全相同，因此第一个任务推理时记录每次调用的输入和输出，
+    后续任务按相同顺序调用时，只要输入逐元素相等（torch.equal）就直接返回记录的输出；
+    输入不同则丢弃之后的记录并照常计算，结果与不复用时一致。
+
+    回放状态按线程保存，只在 replay() 范围内生效，范围外的调用（单任务请求等）不受影响。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def replay(self, records: Optional[List]):
+        """在当前线程中复用 records 里的记录；records 由调用方按页面持有，为 None 时不复用"""
+        self._local.records = records
+        self._local.cursor = 0
+        try:
+            yield
+        finally:
+            self._local.records = None
+
+    def wrap(self, name: str, module) -> None:
+        """替换模块实例的 forward，在 replay() 范围内记录或回放其输出"""
+        original_forward = module.forward
+
+        def forward(*args, **kwargs):
+            records = getattr(self._local, "records", None)
+            if records is None:
+                return original_forward(*args, **kwargs)
+            cursor = self._local.cursor
+            self._local.cursor = cursor + 1
+            if cursor < len(records):
+                recorded_name, recorded_args, recorded_kwargs, output = records[cursor]
+                if recorded_name == name and _same_inputs(recorded_args, args) and \
+                        recorded_kwargs.keys() == kwargs.keys() and \
+                        all(_same_inputs(recorded_kwargs[key], kwargs[key]) for key in kwargs):
+                    self.hits += 1
+                    return output
+                del records[cursor:]
+            self.misses += 1
+            output = original_forward(*args, **kwargs)
+            records.append((name, args, kwargs, output))
+            return output
+
+        module.forward = forward
+
+
+def install_vision_reuse(model, reuse: VisionFeatureReuse) -> bool:
+    """包装模型的视觉编码模块；找不到这些模块时返回 False（模型结构与预期不同，不复用）"""
+    inner = getattr(model, "model", model)
+    modules = [getattr(inner, name, None) for name in VISION_MODULES]
+    if any(module is None for module in modules):
+        return False
+    for name, module in zip(VISION_MODULES, modules):
+        reuse.wrap(name, module)
+    return True
@@ -0,0 +1,65 @@
+"""
+Per-forward cost of the resized position embeddings in the SAM and CLIP encoders, on CPU:
+get_abs_pos (bicubic resize every forward, previous behavior) vs the memoized _abs_pos.
+
+    python benchmarks/bench_abs_pos.py [--repeat 50] [--dtype bfloat16]
+
+Uses the pretrained grids of build_sam_vit_b (64 x 64 x 768) and build_clip_l (16 x 16 x 1024)
+without the transformer blocks, and the view sizes of the vLLM modes.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'DeepSeek-OCR-master', 'DeepSeek-OCR-vllm'))
+
+from deepencoder import clip_sdpa, sam_vary_sdpa  # noqa: E402
+
+# view size -> SAM grid (patch 16); CLIP sees the SAM output after two stride-2 convs
+VIEW_SIZES = {'640 crop / small': 640, 'tiny': 512, 'large': 1280}
+
+
+def time_per_call(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='resized position embedding microbenchmark')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--dtype', default='bfloat16', choices=['bfloat16', 'float16', 'float32'])
+    args = parser.parse_args()
+    dtype = getattr(torch, args.dtype)
+
+    torch.manual_seed(0)
+    sam = sam_vary_sdpa.ImageEncoderViT(depth=0).to(dtype)
+    torch.nn.init.normal_(sam.pos_embed)
+    clip = clip_sdpa.CLIPVisionEmbeddings(hidden_size=1024, image_size=224, patch_size=14).to(dtype)
+
+    with torch.no_grad():
+        for label, view_size in VIEW_SIZES.items():
+            sam_grid = view_size // 16
+            clip_tokens = (sam_grid // 4) ** 2 + 1
+            sam_old = time_per_call(lambda: sam_vary_sdpa.get_abs_pos(sam.pos_embed, sam_grid), args.repeat)
+            sam_new = time_per_call(lambda: sam._abs_pos(sam_grid), args.repeat)
+            clip_old = time_per_call(
+                lambda: clip_sdpa.get_abs_pos(clip.position_embedding(clip.position_ids), clip_tokens), args.repeat)
+            clip_new = time_per_call(lambda: clip._abs_pos(clip_tokens), args.repeat)
+            assert torch.equal(sam._abs_pos(sam_grid), sam_vary_sdpa.get_abs_pos(sam.pos_embed, sam_grid))
+            assert torch.equal(clip._abs_pos(clip_tokens),
+                               clip_sdpa.get_abs_pos(clip.position_embedding(clip.position_ids), clip_tokens))
+            print(f'{label:>16} ({view_size}px): '
+                  f'SAM {sam_grid}x{sam_grid} {sam_old * 1e3:6.2f} -> {sam_new * 1e3:6.3f} ms, '
+                  f'CLIP {clip_tokens} tokens {clip_old * 1e3:6.2f} -> {clip_new * 1e3:6.3f} ms per forward '
+                  f'(saves {(sam_old + clip_old - sam_new - clip_new) * 1e3:.2f} ms)')
+
+
+if __name__ == '__main__':
+    main()
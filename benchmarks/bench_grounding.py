@@ -0,0 +1,112 @@
+"""
+Grounding post-processing of one dense page: the previous re_match + eval + replace loop
+against parse_grounding, one-shot and fed in small streamed chunks.
+
+    python benchmarks/bench_grounding.py [--boxes 500] [--repeat 20] [--chunk 4]
+
+Checks that both give the same boxes and the same markdown before timing.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'DeepSeek-OCR-master', 'DeepSeek-OCR-vllm'))
+
+from process.grounding import MULTI_NEWLINE, GroundingParser, parse_grounding  # noqa: E402
+
+LABELS = ('text', 'title', 'table', 'equation', 'sub_title', 'image')
+
+
+def synthetic_page(num_boxes, seed=0):
+    rng = random.Random(seed)
+    parts = []
+    for idx in range(num_boxes):
+        label = 'image' if idx % 25 == 0 else rng.choice(LABELS[:-1])
+        x1, y1 = rng.randrange(900), rng.randrange(900)
+        parts.append(f'<|ref|>{label}<|/ref|><|det|>[[{x1}, {y1}, {x1 + rng.randrange(1, 99)}, '
+                     f'{y1 + rng.randrange(1, 99)}]]<|/det|>\n')
+        if label != 'image':
+            parts.append(' '.join(f'word{rng.randrange(10000)}' for _ in range(rng.randint(3, 20))) + '\n\n')
+    return ''.join(parts)
+
+
+def re_match(text):
+    # previous run_dpsk_ocr_*.py code
+    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
+    matches = re.findall(pattern, text, re.DOTALL)
+    mathes_image = []
+    mathes_other = []
+    for a_match in matches:
+        if '<|ref|>image<|/ref|>' in a_match[0]:
+            mathes_image.append(a_match[0])
+        else:
+            mathes_other.append(a_match[0])
+    return matches, mathes_image, mathes_other
+
+
+def previous_postprocess(content, jdx=0):
+    matches_ref, matches_images, mathes_other = re_match(content)
+    boxes = []
+    for ref in matches_ref:
+        try:
+            boxes.append((ref[1], eval(ref[2])))
+        except Exception:
+            boxes.append((ref[1], None))
+    for idx, a_match_image in enumerate(matches_images):
+        content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
+    for idx, a_match_other in enumerate(mathes_other):
+        content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
+    return content, boxes
+
+
+def current_postprocess(content, jdx=0):
+    text, refs = parse_grounding(content, image_link=f'images/{jdx}_{{idx}}.jpg')
+    text = text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+    return MULTI_NEWLINE.sub('\n\n', text), [(ref.label, ref.boxes) for ref in refs]
+
+
+def streamed_postprocess(content, chunk, jdx=0):
+    parser = GroundingParser(image_link=f'images/{jdx}_{{idx}}.jpg')
+    for pos in range(0, len(content), chunk):
+        parser.feed(content[pos:pos + chunk])
+    parser.close()
+    text = parser.text.replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+    return MULTI_NEWLINE.sub('\n\n', text), [(ref.label, ref.boxes) for ref in parser.refs]
+
+
+def time_per_call(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='grounding post-processing microbenchmark')
+    parser.add_argument('--boxes', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--chunk', type=int, default=4, help='characters per streamed chunk (about one token)')
+    args = parser.parse_args()
+
+    page = synthetic_page(args.boxes)
+    old_text, old_boxes = previous_postprocess(page)
+    new_text, new_boxes = current_postprocess(page)
+    assert new_boxes == old_boxes, 'boxes differ'
+    assert new_text == MULTI_NEWLINE.sub('\n\n', old_text), 'markdown differs'
+    assert streamed_postprocess(page, args.chunk) == (new_text, new_boxes), 'streamed output differs'
+
+    old_seconds = time_per_call(lambda: previous_postprocess(page), args.repeat)
+    new_seconds = time_per_call(lambda: current_postprocess(page), args.repeat)
+    streamed_seconds = time_per_call(lambda: streamed_postprocess(page, args.chunk), args.repeat)
+    print(f'{args.boxes} boxes, {len(page)} chars: '
+          f're_match + eval + replace {old_seconds * 1e3:8.2f} ms, '
+          f'parse_grounding {new_seconds * 1e3:6.2f} ms ({old_seconds / new_seconds:.0f}x), '
+          f'streamed in {args.chunk}-char chunks {streamed_seconds * 1e3:6.2f} ms; outputs identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Per-step cost of NoRepeatNGramLogitsProcessor: previous full window scan vs the rolling n-gram index.
+
+    python benchmarks/bench_ngram_norepeat.py [--tokens 4096] [--vocab 129280]
+
+Simulates one decode (the processor sees every prefix of a synthetic output) for the n-gram /
+window settings the scripts use, then replays both implementations side by side and checks
+that the logits they return are identical.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'DeepSeek-OCR-master', 'DeepSeek-OCR-vllm'))
+
+from process.ngram_norepeat import NoRepeatNGramLogitsProcessor  # noqa: E402
+
+
+class WindowScanProcessor:
+    """previous implementation: rebuild every n-gram in the window, clone, ban tokens one by one"""
+
+    def __init__(self, ngram_size, window_size, whitelist_token_ids):
+        self.ngram_size = ngram_size
+        self.window_size = window_size
+        self.whitelist_token_ids = whitelist_token_ids
+
+    def __call__(self, input_ids, scores):
+        if len(input_ids) < self.ngram_size:
+            return scores
+        current_prefix = tuple(input_ids[-(self.ngram_size - 1):])
+        search_start = max(0, len(input_ids) - self.window_size)
+        search_end = len(input_ids) - self.ngram_size + 1
+        banned_tokens = set()
+        for i in range(search_start, search_end):
+            ngram = tuple(input_ids[i:i + self.ngram_size])
+            if ngram[:-1] == current_prefix:
+                banned_tokens.add(ngram[-1])
+        banned_tokens = banned_tokens - self.whitelist_token_ids
+        if banned_tokens:
+            scores = scores.clone()
+            for token in banned_tokens:
+                scores[token] = -float('inf')
+        return scores
+
+
+def synthetic_tokens(length, vocab, seed=0):
+    # document-like output: lots of repeated table fragments
+    rng = random.Random(seed)
+    tokens = []
+    while len(tokens) < length:
+        if tokens and rng.random() < 0.4:
+            start = rng.randrange(len(tokens))
+            tokens.extend(tokens[start:start + rng.randint(5, 60)])
+        else:
+            tokens.append(rng.randrange(vocab))
+    return tokens[:length]
+
+
+def time_decode(processor, tokens, scores):
+    start = time.perf_counter()
+    for length in range(1, len(tokens) + 1):
+        processor(tokens[:length], scores.clone())
+    return time.perf_counter() - start
+
+
+def check_identical(old, new, tokens, scores):
+    for length in range(1, len(tokens) + 1):
+        expected = old(tokens[:length], scores.clone())
+        actual = new(tokens[:length], scores.clone())
+        assert torch.equal(expected, actual), f'outputs differ at step {length}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NoRepeatNGramLogitsProcessor microbenchmark')
+    parser.add_argument('--tokens', type=int, default=4096)
+    parser.add_argument('--vocab', type=int, default=129280)
+    parser.add_argument('--token-vocab', type=int, default=2000, help='distinct token ids in the synthetic output')
+    args = parser.parse_args()
+
+    tokens = synthetic_tokens(args.tokens, args.token_vocab)
+    scores = torch.zeros(args.vocab)
+    whitelist = {128821, 128822}
+    # run_dpsk_ocr_pdf.py, run_dpsk_ocr_image.py, run_dpsk_ocr_eval_batch.py
+    for ngram_size, window_size in [(20, 50), (30, 90), (40, 90)]:
+        old_seconds = time_decode(WindowScanProcessor(ngram_size, window_size, whitelist), tokens, scores)
+        new_seconds = time_decode(NoRepeatNGramLogitsProcessor(ngram_size, window_size, whitelist), tokens, scores)
+        check_identical(WindowScanProcessor(ngram_size, window_size, whitelist),
+                        NoRepeatNGramLogitsProcessor(ngram_size, window_size, whitelist), tokens, scores)
+        print(f'ngram={ngram_size:2d} window={window_size:2d}: '
+              f'window scan {old_seconds / len(tokens) * 1e6:7.1f} us/token, '
+              f'rolling index {new_seconds / len(tokens) * 1e6:7.1f} us/token '
+              f'({old_seconds / new_seconds:.1f}x), outputs identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+PreprocessEngine throughput on synthetic pages: thread pool against process pool, for several
+worker counts, with the input cache off.
+
+    python benchmarks/bench_preprocess_pool.py [--pages 128] [--workers 1,4,16,64] [--mode gundam]
+
+Checks that both backends return the same requests before timing. Pool start-up is timed
+separately from steady-state throughput. Prints the PREPROCESS_BACKEND / NUM_WORKERS pair that
+was fastest on this host; needs the tokenizer from config.MODEL_PATH.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import torch
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'DeepSeek-OCR-master', 'DeepSeek-OCR-vllm'))
+
+from config import MODES, PROMPT, UINT8_TILES  # noqa: E402
+from process.preprocess_pool import PreprocessEngine  # noqa: E402
+
+# A4 / Letter at 144 DPI, a landscape slide and a small receipt that is not cropped
+PAGE_SIZES = ((1191, 1684), (1224, 1584), (1600, 900), (500, 620))
+
+
+def synthetic_pages(num_pages, seed=0):
+    rng = random.Random(seed)
+    pages = []
+    for idx in range(num_pages):
+        size = PAGE_SIZES[idx % len(PAGE_SIZES)]
+        page = Image.new('RGB', size, 'white')
+        draw = ImageDraw.Draw(page)
+        for y in range(60, size[1] - 60, 26):
+            draw.text((60, y), ' '.join(f'word{rng.randrange(10000)}' for _ in range(size[0] // 90)), fill='black')
+        pages.append(page)
+    return pages
+
+
+def same_request(a, b):
+    if isinstance(a, torch.Tensor):
+        return isinstance(b, torch.Tensor) and a.dtype == b.dtype and torch.equal(a, b)
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same_request(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(same_request(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def run(backend, workers, pages, processor_kwargs):
+    start = time.perf_counter()
+    with PreprocessEngine(backend=backend, num_workers=workers, processor_kwargs=processor_kwargs,
+                          cache_mb=0) as engine:
+        engine.map(pages[:workers], PROMPT, desc='warm-up')  # starts the workers and builds their processors
+        startup = time.perf_counter() - start
+        start = time.perf_counter()
+        requests = engine.map(pages, PROMPT)
+        seconds = time.perf_counter() - start
+    return startup, seconds, requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description='thread vs process preprocessing benchmark')
+    parser.add_argument('--pages', type=int, default=128)
+    parser.add_argument('--workers', default=f'1,4,16,{os.cpu_count()}')
+    parser.add_argument('--mode', default='gundam', choices=sorted(MODES))
+    args = parser.parse_args()
+
+    pages = synthetic_pages(args.pages)
+    processor_kwargs = dict(MODES[args.mode], uint8_tiles=UINT8_TILES)
+    worker_counts = sorted({int(w) for w in args.workers.split(',')})
+
+    _, _, thread_requests = run('thread', 2, pages[:8], processor_kwargs)
+    _, _, process_requests = run('process', 2, pages[:8], processor_kwargs)
+    assert same_request(thread_requests, process_requests), 'thread and process backends differ'
+
+    print(f'{args.pages} pages, mode {args.mode}, uint8 tiles {UINT8_TILES}, {os.cpu_count()} CPUs:')
+    best = None
+    for workers in worker_counts:
+        for backend in ('thread', 'process'):
+            startup, seconds, _ = run(backend, workers, pages, processor_kwargs)
+            rate = args.pages / seconds
+            print(f'  {backend:7s} x {workers:3d}: {rate:7.1f} pages/s (pool start-up {startup:5.2f}s)')
+            if best is None or rate > best[0]:
+                best = (rate, backend, workers)
+    print(f"fastest: PREPROCESS_BACKEND = '{best[1]}', NUM_WORKERS = {best[2]} ({best[0]:.1f} pages/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Per-page preprocessing cost of DeepseekOCRProcessor.tokenize_with_images.
+
+    python benchmarks/bench_tokenize_with_images.py [--pages 20] [--no-processor]
+
+Part 1 times the image-token sequence alone: the previous list concatenation plus per-token
+masking loop against the cached image_token_block template + torch.cat, for every mode.
+Part 2 times the whole tokenize_with_images call per page (resize, crops, tensors, tokens) on
+synthetic A4 pages in every mode; it needs the tokenizer from config.MODEL_PATH.
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import torch
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'DeepSeek-OCR-master', 'DeepSeek-OCR-vllm'))
+
+from config import MODES  # noqa: E402
+from process.image_process import DeepseekOCRProcessor, count_tiles, image_token_block  # noqa: E402
+
+IMAGE_TOKEN_ID = 128815
+IGNORE_ID = -100
+PROMPT_TOKENS = list(range(1, 12))
+A4_PAGE = (1191, 1684)
+
+
+def list_sequence(num_width_tiles, num_height_tiles, base_size, image_size):
+    # previous code path: list concatenation, per-token masking loop, then tensors
+    num_queries = math.ceil((image_size // 16) / 4)
+    num_queries_base = math.ceil((base_size // 16) / 4)
+    tokenized_str = list(PROMPT_TOKENS)
+    images_seq_mask = [False] * len(tokenized_str)
+    tokenized_image = ([IMAGE_TOKEN_ID] * num_queries_base + [IMAGE_TOKEN_ID]) * num_queries_base
+    tokenized_image += [IMAGE_TOKEN_ID]
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        tokenized_image += ([IMAGE_TOKEN_ID] * (num_queries * num_width_tiles) + [IMAGE_TOKEN_ID]) * (
+                    num_queries * num_height_tiles)
+    tokenized_str += tokenized_image
+    images_seq_mask += [True] * len(tokenized_image)
+    masked_tokenized_str = [IGNORE_ID if token == IMAGE_TOKEN_ID else token for token in tokenized_str]
+    return (torch.LongTensor(tokenized_str), torch.LongTensor(masked_tokenized_str),
+            torch.tensor(images_seq_mask, dtype=torch.bool))
+
+
+def tensor_sequence(num_width_tiles, num_height_tiles, base_size, image_size):
+    tokens, mask = image_token_block(IMAGE_TOKEN_ID, num_width_tiles, num_height_tiles, base_size, image_size)
+    input_ids = torch.cat([torch.tensor(PROMPT_TOKENS, dtype=torch.long), tokens])
+    images_seq_mask = torch.cat([torch.zeros(len(PROMPT_TOKENS), dtype=torch.bool), mask])
+    target_ids = input_ids.clone()
+    target_ids[input_ids == IMAGE_TOKEN_ID] = IGNORE_ID
+    return input_ids, target_ids, images_seq_mask
+
+
+def per_call(fn, *args, repeat=200):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(*args)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def synthetic_page(size=A4_PAGE):
+    page = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(page)
+    for y in range(80, size[1] - 80, 28):
+        draw.text((80, y), 'Lorem ipsum dolor sit amet, consectetur adipiscing elit ' * 2, fill='black')
+    return page
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tokenize_with_images benchmark')
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--no-processor', action='store_true', help='skip part 2 (no tokenizer needed)')
+    args = parser.parse_args()
+
+    print('image-token sequence (per page):')
+    for name, mode in MODES.items():
+        tiles = count_tiles(*A4_PAGE, image_size=mode['image_size']) if mode['crop_mode'] else (1, 1)
+        old_seconds, old = per_call(list_sequence, *tiles, mode['base_size'], mode['image_size'])
+        new_seconds, new = per_call(tensor_sequence, *tiles, mode['base_size'], mode['image_size'])
+        assert all(torch.equal(a, b) for a, b in zip(old, new))
+        print(f'  {name:7s} {len(new[0]):5d} tokens: lists {old_seconds * 1e6:8.1f} us, '
+              f'template {new_seconds * 1e6:7.1f} us ({old_seconds / new_seconds:.1f}x)')
+
+    if args.no_processor:
+        return
+    print('tokenize_with_images (per page):')
+    page = synthetic_page()
+    for name, mode in MODES.items():
+        processor = DeepseekOCRProcessor(**mode)
+        processor.tokenize_with_images(images=[page], bos=True, eos=True)
+        start = time.perf_counter()
+        for _ in range(args.pages):
+            processor.tokenize_with_images(images=[page], bos=True, eos=True)
+        print(f'  {name:7s} {(time.perf_counter() - start) / args.pages * 1000:7.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+"""pytest 配置：把后端和 vLLM 推理脚本目录加入 sys.path（两者都按目录内模块方式导入）
+
+依赖缺失（torch / vllm / numpy / Pillow 等）的测试用 pytest.importorskip 跳过。
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, "backend")
+VLLM_DIR = os.path.join(ROOT, "DeepSeek-OCR-master", "DeepSeek-OCR-vllm")
+
+for path in (BACKEND_DIR, VLLM_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,80 @@
+"""
+Memoized resized position embeddings in the SAM image encoder and the CLIP embeddings:
+one entry per (target size, dtype, device), identical to get_abs_pos, dropped when the weights change.
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+for _dependency in ('flash_attn', 'easydict'):
+    pytest.importorskip(_dependency)
+
+from deepencoder import clip_sdpa, sam_vary_sdpa  # noqa: E402
+
+
+def sam_encoder():
+    # 4 x 4 pretrained grid
+    encoder = sam_vary_sdpa.ImageEncoderViT(img_size=64, patch_size=16, embed_dim=8, depth=0, num_heads=2)
+    torch.nn.init.normal_(encoder.pos_embed)
+    return encoder, encoder.pos_embed, lambda: sam_vary_sdpa.get_abs_pos(encoder.pos_embed, 6), 6, 4
+
+
+def clip_embeddings():
+    # 4 x 4 pretrained grid plus the class position
+    embeddings = clip_sdpa.CLIPVisionEmbeddings(hidden_size=8, image_size=56, patch_size=14)
+    return (embeddings, embeddings.position_embedding.weight,
+            lambda: clip_sdpa.get_abs_pos(embeddings.position_embedding(embeddings.position_ids), 37), 37, 17)
+
+
+@pytest.fixture(params=[sam_encoder, clip_embeddings], ids=['sam', 'clip'])
+def encoder(request):
+    torch.manual_seed(0)
+    return request.param()
+
+
+def test_cached_matches_get_abs_pos(encoder):
+    module, _, reference, tgt_size, _ = encoder
+    with torch.no_grad():
+        first = module._abs_pos(tgt_size)
+        assert torch.equal(first, reference())
+        assert module._abs_pos(tgt_size) is first
+    assert len(module._pos_embed_cache) == 1
+
+
+def test_one_entry_per_size_and_dtype(encoder):
+    module, _, _, tgt_size, native_size = encoder
+    with torch.no_grad():
+        module._abs_pos(tgt_size)
+        # pretrained grid: no resize, nothing to cache
+        module._abs_pos(native_size)
+        assert len(module._pos_embed_cache) == 1
+        module.to(torch.bfloat16)
+        assert module._abs_pos(tgt_size).dtype == torch.bfloat16
+    assert len(module._pos_embed_cache) == 2
+
+
+def test_not_cached_with_autograd(encoder):
+    module, _, reference, tgt_size, _ = encoder
+    resized = module._abs_pos(tgt_size)
+    assert resized.requires_grad
+    assert torch.equal(resized.detach(), reference().detach())
+    assert not module._pos_embed_cache
+
+
+def test_in_place_update_invalidates(encoder):
+    module, weight, reference, tgt_size, _ = encoder
+    with torch.no_grad():
+        stale = module._abs_pos(tgt_size)
+        weight.add_(1.0)
+        fresh = module._abs_pos(tgt_size)
+        assert not torch.equal(fresh, stale)
+        assert torch.equal(fresh, reference())
+
+
+def test_clear_after_weight_load(encoder):
+    # weight loaders copy through .data, which the version check cannot see: load_weights clears the cache
+    module, weight, reference, tgt_size, _ = encoder
+    with torch.no_grad():
+        module._abs_pos(tgt_size)
+        weight.data.copy_(torch.randn_like(weight))
+        module.clear_pos_embed_cache()
+        assert torch.equal(module._abs_pos(tgt_size), reference())
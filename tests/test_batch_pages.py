@@ -0,0 +1,56 @@
+"""
+run_dpsk_ocr_batch.postprocess_page: loop-stopped pages are `degenerate`, pages that ran out of
+tokens without eos are `truncated`; with SKIP_REPEAT both stay as empty pages.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+for _dependency in ('torch', 'torchvision', 'transformers', 'fitz', 'PIL', 'numpy', 'tqdm'):
+    pytest.importorskip(_dependency)
+
+import run_dpsk_ocr_batch  # noqa: E402
+from process.repeat_stop import RepetitionLoopDetector  # noqa: E402
+
+EOS = run_dpsk_ocr_batch.EOS
+TASK = run_dpsk_ocr_batch.PageTask(run_dpsk_ocr_batch.BatchItem('in/doc.pdf', 'doc.pdf', True), 'hash', 2,
+                                   (1000, 1400), False)
+NORMAL = list(range(100, 140))
+LOOP = list(range(100, 110)) + [7, 8, 9] * 10
+
+
+def output(text, token_ids):
+    return SimpleNamespace(outputs=[SimpleNamespace(text=text, token_ids=token_ids)])
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    monkeypatch.setattr(run_dpsk_ocr_batch, 'REPEAT_STOP', True)
+    monkeypatch.setattr(run_dpsk_ocr_batch, 'LAYOUT_JSONL', False)
+    monkeypatch.setattr(run_dpsk_ocr_batch, 'loop_detector', RepetitionLoopDetector(8, 20, 4))
+    return run_dpsk_ocr_batch
+
+
+@pytest.mark.parametrize('skip_repeat', [False, True])
+def test_finished_page(batch, monkeypatch, skip_repeat):
+    monkeypatch.setattr(batch, 'SKIP_REPEAT', skip_repeat)
+    page = batch.postprocess_page(TASK, output(f'# Title\n\nbody{EOS}', NORMAL))
+    assert (page['degenerate'], page['truncated']) == (False, False)
+    assert page['det'] == '# Title\n\nbody'
+
+
+@pytest.mark.parametrize('skip_repeat', [False, True])
+def test_loop_is_degenerate_not_truncated(batch, monkeypatch, skip_repeat):
+    # RepetitionStopLogitsProcessor ends the sequence with eos
+    monkeypatch.setattr(batch, 'SKIP_REPEAT', skip_repeat)
+    page = batch.postprocess_page(TASK, output(f'a b c a b c{EOS}', LOOP))
+    assert (page['degenerate'], page['truncated']) == (True, False)
+    assert page['det'] == ('' if skip_repeat else 'a b c a b c')
+
+
+@pytest.mark.parametrize('skip_repeat', [False, True])
+def test_max_tokens_without_eos_is_truncated_not_degenerate(batch, monkeypatch, skip_repeat):
+    monkeypatch.setattr(batch, 'SKIP_REPEAT', skip_repeat)
+    page = batch.postprocess_page(TASK, output('a long table that never ends', NORMAL))
+    assert (page['degenerate'], page['truncated']) == (False, True)
+    assert page['det'] == ('' if skip_repeat else 'a long table that never ends')
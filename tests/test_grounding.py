@@ -0,0 +1,136 @@
+"""GroundingParser / parse_grounding and the layout blocks built from them"""
+import json
+import random
+
+import pytest
+
+from process.grounding import (GroundingParser, layout_blocks, layout_jsonl, parse_boxes, parse_grounding,
+                               REF_OPEN, REF_CLOSE, DET_OPEN, DET_CLOSE)
+
+
+def span(label, det):
+    return f'{REF_OPEN}{label}{REF_CLOSE}{DET_OPEN}{det}{DET_CLOSE}'
+
+
+PAGE = (
+    'intro line\n'
+    + span('title', '[[10, 20, 500, 60]]') + '\n# Heading\n\n'
+    + span('image', '[[0, 100, 999, 600]]') + '\n'
+    + span('text', '[[12, 610, 980, 700], [12, 700, 600, 760]]') + '\nx \\coloneqq y\n\n\n\n'
+    + span('table', '[[1, 2, 3]]') + '\n<table></table>\n'
+)
+
+
+def feed_in_chunks(text, sizes, image_link=None):
+    parser = GroundingParser(image_link=image_link)
+    pieces, pos = [], 0
+    for size in sizes:
+        pieces.append(parser.feed(text[pos:pos + size]))
+        pos += size
+    pieces.append(parser.feed(text[pos:]))
+    pieces.append(parser.close())
+    assert ''.join(pieces) == parser.text
+    return parser.text, parser.refs
+
+
+def test_spans_removed_and_boxes_parsed():
+    text, refs = parse_grounding(PAGE)
+    assert text == 'intro line\n\n# Heading\n\n\n\nx \\coloneqq y\n\n\n\n\n<table></table>\n'
+    assert [ref.label for ref in refs] == ['title', 'image', 'text', 'table']
+    assert refs[0].boxes == [[10, 20, 500, 60]]
+    assert refs[2].boxes == [[12, 610, 980, 700], [12, 700, 600, 760]]
+    assert refs[0].raw == span('title', '[[10, 20, 500, 60]]')
+    assert all(ref.raw in PAGE for ref in refs)
+
+
+def test_image_refs_become_links():
+    text, refs = parse_grounding(PAGE, image_link='images/3_{idx}.jpg')
+    assert '![](images/3_0.jpg)\n' in text
+    image = refs[1]
+    assert text[image.start:image.end] == '![](images/3_0.jpg)\n'
+    # non-image spans leave nothing behind
+    assert all(ref.start == ref.end for ref in refs if ref.label != 'image')
+    two_images = span('image', '[[0, 0, 1, 1]]') + 'a' + span('image', '[[0, 0, 2, 2]]')
+    assert parse_grounding(two_images, image_link='{idx}.jpg')[0] == '![](0.jpg)\na![](1.jpg)\n'
+
+
+@pytest.mark.parametrize('det', ['[[1, 2, 3]]', '[[1, 2, 3, 4]', '', 'none', '[[1, 2, 3, 4], [5, 6]]'])
+def test_malformed_boxes_are_none(det):
+    text, refs = parse_grounding('a' + span('text', det) + 'b')
+    assert text == 'ab'
+    assert refs[0].boxes is None
+    assert parse_boxes(det) is None
+
+
+def test_parse_boxes_takes_floats_and_negatives_without_eval():
+    assert parse_boxes('[[1.7, -2, 3, 4]]') == [[1, -2, 3, 4]]
+    assert parse_boxes('[[__import__("os"), 1, 2, 3]]') is None
+
+
+def test_ref_without_det_is_text():
+    text = f'a {REF_OPEN}note{REF_CLOSE} b ' + span('text', '[[1, 2, 3, 4]]') + 'c'
+    clean, refs = parse_grounding(text)
+    assert clean == f'a {REF_OPEN}note{REF_CLOSE} b c'
+    assert [ref.label for ref in refs] == ['text']
+
+
+@pytest.mark.parametrize('tail', [
+    REF_OPEN + 'tit',
+    REF_OPEN + 'title' + REF_CLOSE,
+    REF_OPEN + 'title' + REF_CLOSE + '<|de',
+    REF_OPEN + 'title' + REF_CLOSE + DET_OPEN + '[[1, 2',
+    '<|re',
+])
+def test_unterminated_span_kept_verbatim(tail):
+    text, refs = parse_grounding('body ' + tail)
+    assert text == 'body ' + tail
+    assert refs == []
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_streaming_matches_one_shot(seed):
+    rng = random.Random(seed)
+    page = PAGE * 3 + REF_OPEN + 'x' + REF_CLOSE + ' tail ' + REF_OPEN + 'cut'
+    sizes = [rng.randint(1, 12) for _ in range(len(page))]
+    expected = parse_grounding(page, image_link='images/{idx}.jpg')
+    assert feed_in_chunks(page, sizes, image_link='images/{idx}.jpg') == expected
+
+
+def test_one_character_at_a_time():
+    assert feed_in_chunks(PAGE, [1] * len(PAGE)) == parse_grounding(PAGE)
+
+
+def test_layout_blocks():
+    text, refs = parse_grounding(PAGE)
+    blocks = layout_blocks(text, refs, 1000, 2000)
+    assert [block['order'] for block in blocks] == list(range(5))
+    assert [block['label'] for block in blocks] == [None, 'title', 'image', 'text', 'table']
+    assert blocks[0]['text'] == 'intro line'
+    assert blocks[1]['text'] == '# Heading'
+    assert blocks[1]['bbox'] == [round(10 / 999, 4), round(20 / 999, 4), round(500 / 999, 4), round(60 / 999, 4)]
+    assert blocks[1]['bbox_px'] == [10, 40, 500, 120]
+    # several boxes: union plus the individual boxes
+    assert blocks[3]['bbox_px'] == [12, 1221, 980, 1521]
+    assert len(blocks[3]['boxes']) == 2
+    assert blocks[3]['text'] == 'x := y'
+    # malformed payload: the block is kept without a box
+    assert blocks[4]['bbox'] is None and blocks[4]['bbox_px'] is None
+    assert blocks[4]['text'] == '<table></table>'
+
+
+def test_layout_blocks_without_spans():
+    assert layout_blocks('  plain page \n', [], 10, 10) == [
+        {'order': 0, 'label': None, 'bbox': None, 'bbox_px': None, 'text': 'plain page'}]
+    assert layout_blocks('', [], 10, 10) == []
+
+
+def test_layout_jsonl():
+    text, refs = parse_grounding(PAGE)
+    blocks = layout_blocks(text, refs, 1000, 2000)
+    lines = layout_jsonl(blocks, page=3).splitlines()
+    assert len(lines) == len(blocks)
+    decoded = [json.loads(line) for line in lines]
+    assert all(line['page'] == 3 for line in decoded)
+    assert [{k: v for k, v in line.items() if k != 'page'} for line in decoded] == blocks
+    assert next(iter(decoded[0])) == 'page'
+    assert layout_jsonl([]) == ''
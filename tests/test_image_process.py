@@ -0,0 +1,38 @@
+"""image_token_block against the previous list-based construction of the image-token sequence"""
+import math
+
+import pytest
+
+torch = pytest.importorskip('torch')
+for _dependency in ('torchvision', 'transformers', 'PIL'):
+    pytest.importorskip(_dependency)
+
+from process.image_process import image_token_block  # noqa: E402
+
+IMAGE_TOKEN_ID = 128815
+
+
+def reference_image_tokens(num_width_tiles, num_height_tiles, base_size, image_size, patch_size=16, downsample_ratio=4):
+    """previous tokenize_with_images code: Python list concatenation"""
+    num_queries = math.ceil((image_size // patch_size) / downsample_ratio)
+    num_queries_base = math.ceil((base_size // patch_size) / downsample_ratio)
+    tokenized_image = ([IMAGE_TOKEN_ID] * num_queries_base + [IMAGE_TOKEN_ID]) * num_queries_base
+    tokenized_image += [IMAGE_TOKEN_ID]
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        tokenized_image += ([IMAGE_TOKEN_ID] * (num_queries * num_width_tiles) + [IMAGE_TOKEN_ID]) * (
+                    num_queries * num_height_tiles)
+    return tokenized_image
+
+
+@pytest.mark.parametrize('base_size,image_size', [(512, 512), (640, 640), (1024, 1024), (1280, 1280), (1024, 640)])
+@pytest.mark.parametrize('tiles', [(1, 1), (2, 1), (1, 2), (2, 3), (3, 3), (1, 9)])
+def test_image_token_block_matches_list_construction(base_size, image_size, tiles):
+    tokens, mask = image_token_block(IMAGE_TOKEN_ID, *tiles, base_size, image_size)
+    expected = reference_image_tokens(*tiles, base_size, image_size)
+    assert tokens.dtype == torch.long and mask.dtype == torch.bool
+    assert tokens.tolist() == expected
+    assert mask.tolist() == [True] * len(expected)
+
+
+def test_image_token_block_is_cached():
+    assert image_token_block(IMAGE_TOKEN_ID, 2, 3, 1024, 640) is image_token_block(IMAGE_TOKEN_ID, 2, 3, 1024, 640)
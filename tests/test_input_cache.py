@@ -0,0 +1,136 @@
+"""ProcessedInputCache: LRU / byte eviction, copy isolation, counters, concurrent use"""
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from process.input_cache import ProcessedInputCache, copy_request  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def request(nbytes, fill=0):
+    """vLLM-shaped request whose tensors take nbytes"""
+    return {
+        'prompt': '<image>\nFree OCR.',
+        'multi_modal_data': {'image': [[torch.full((nbytes,), fill, dtype=torch.uint8)]]},
+        'mm_processor_kwargs': {'crop_mode': True},
+    }
+
+
+def test_hit_returns_equal_request():
+    cache = ProcessedInputCache(max_mb=1)
+    cache.put('a', request(100, fill=7))
+    hit = cache.get('a')
+    assert hit['prompt'] == '<image>\nFree OCR.'
+    assert torch.equal(hit['multi_modal_data']['image'][0][0], torch.full((100,), 7, dtype=torch.uint8))
+
+
+def test_byte_cap_evicts_least_recently_used():
+    cache = ProcessedInputCache(max_mb=1)
+    for key in 'abc':
+        cache.put(key, request(MB // 4))
+    assert cache.get('a') is not None  # a is now the most recent
+    cache.put('d', request(MB // 4))
+    cache.put('e', request(MB // 4))  # 5 x 256 KB > 1 MB: b goes first
+    assert cache.get('b') is None
+    assert all(cache.get(key) is not None for key in 'acde')
+    assert cache.stats()['entries'] == 4
+    assert cache.stats()['mb'] == 1.0
+
+
+def test_eviction_frees_enough_bytes_for_a_large_entry():
+    cache = ProcessedInputCache(max_mb=1)
+    for key in 'abcd':
+        cache.put(key, request(MB // 4))
+    cache.put('big', request(MB * 3 // 4))
+    assert [key for key in 'abcd' if cache.get(key) is not None] == ['d']
+    assert cache.get('big') is not None
+
+
+def test_entry_larger_than_cap_is_not_stored():
+    cache = ProcessedInputCache(max_mb=1)
+    cache.put('a', request(MB // 2))
+    cache.put('huge', request(2 * MB))
+    assert cache.get('huge') is None
+    assert cache.get('a') is not None
+
+
+def test_put_of_existing_key_keeps_first_entry():
+    cache = ProcessedInputCache(max_mb=1)
+    cache.put('a', request(10, fill=1))
+    cache.put('a', request(10, fill=2))
+    assert cache.get('a')['multi_modal_data']['image'][0][0][0].item() == 1
+    assert cache.stats()['entries'] == 1
+    assert cache.stats()['mb'] == 0.0
+
+
+def test_get_returns_isolated_copies():
+    cache = ProcessedInputCache(max_mb=1)
+    cache.put('a', request(10))
+    first = cache.get('a')
+    first['prompt'] = 'changed'
+    first['mm_processor_kwargs']['crop_mode'] = False
+    first['multi_modal_data']['image'].append('extra')
+    first['multi_modal_data']['image'][0].append('extra')
+    second = cache.get('a')
+    assert second['prompt'] == '<image>\nFree OCR.'
+    assert second['mm_processor_kwargs'] == {'crop_mode': True}
+    assert len(second['multi_modal_data']['image']) == 1
+    assert len(second['multi_modal_data']['image'][0]) == 1
+    # tensors are shared, not copied
+    assert second['multi_modal_data']['image'][0][0] is first['multi_modal_data']['image'][0][0]
+
+
+def test_copy_request_shares_leaves():
+    original = request(4)
+    copied = copy_request(original)
+    assert copied['prompt'] == original['prompt']
+    assert copied['multi_modal_data'] is not original['multi_modal_data']
+    assert copied['multi_modal_data']['image'][0][0] is original['multi_modal_data']['image'][0][0]
+
+
+def test_hit_and_miss_counters():
+    cache = ProcessedInputCache(max_mb=1)
+    assert cache.stats() == {'entries': 0, 'mb': 0.0, 'hits': 0, 'misses': 0, 'hit_rate': 0.0}
+    cache.get('a')
+    cache.put('a', request(10))
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (2, 2, 0.5)
+
+
+def test_concurrent_get_put_keeps_accounting_consistent():
+    cache = ProcessedInputCache(max_mb=1)
+    size = MB // 16
+    num_threads, num_ops = 8, 200
+    errors = []
+    barrier = threading.Barrier(num_threads)
+
+    def worker(tid):
+        barrier.wait()
+        try:
+            for op in range(num_ops):
+                key = (tid * 7 + op) % 40
+                hit = cache.get(key)
+                if hit is None:
+                    cache.put(key, request(size, fill=key))
+                elif hit['multi_modal_data']['image'][0][0][0].item() != key:
+                    errors.append((key, hit))
+        except Exception as e:  # pragma: no cover - reported below
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(tid,)) for tid in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == num_threads * num_ops
+    assert stats['entries'] <= 16
+    assert cache._bytes == stats['entries'] * size <= cache.max_bytes
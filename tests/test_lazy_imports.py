@@ -0,0 +1,59 @@
+"""
+Import-time checks for the vLLM package: importing config, the pre/post-processing helpers or a
+run_dpsk_ocr_*.py script must not load the tokenizer, import vllm or build the engine.
+
+Each check runs in a fresh interpreter (so earlier imports do not hide the cost) and prints
+the measured import time; run with `pytest -s` to see it.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import VLLM_DIR
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+seconds = time.perf_counter() - start
+import config
+llm_cached = [m for m in {modules!r} if hasattr(sys.modules[m], 'get_llm') and sys.modules[m].get_llm.cache_info().currsize]
+print(json.dumps({{
+    'seconds': seconds,
+    'vllm': 'vllm' in sys.modules,
+    'transformers': 'transformers' in sys.modules,
+    'tokenizer_loaded': config.get_tokenizer.cache_info().currsize > 0,
+    'engines_built': llm_cached,
+}}))
+'''
+
+
+def probe_import(modules):
+    env = dict(os.environ, HF_HUB_OFFLINE='1', TRANSFORMERS_OFFLINE='1')
+    result = subprocess.run([sys.executable, '-c', PROBE.format(modules=list(modules))], cwd=VLLM_DIR, env=env,
+                            capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    print(f"import {', '.join(modules)}: {report['seconds'] * 1000:.0f} ms")
+    return report
+
+
+def test_helpers_import_without_model_stack():
+    report = probe_import(['config', 'process.grounding', 'process.manifest', 'process.pdf_writer'])
+    assert not report['vllm'] and not report['transformers']
+    assert not report['tokenizer_loaded']
+    assert report['seconds'] < 1.0
+
+
+@pytest.mark.parametrize('script', ['run_dpsk_ocr_pdf', 'run_dpsk_ocr_image', 'run_dpsk_ocr_eval_batch', 'run_dpsk_ocr_batch'])
+def test_scripts_import_without_engine(script):
+    for dependency in ('torch', 'torchvision', 'transformers', 'fitz', 'PIL', 'numpy', 'tqdm'):
+        pytest.importorskip(dependency)
+    report = probe_import([script])
+    assert not report['vllm']
+    assert not report['tokenizer_loaded']
+    assert not report['engines_built']
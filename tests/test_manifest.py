@@ -0,0 +1,118 @@
+"""BatchManifest and sharding: shard parsing, disjoint shards, resume across re-sharded runs, torn lines"""
+import json
+import os
+
+import pytest
+
+from process.manifest import BatchManifest, in_shard, parse_shard, settings_hash
+
+PATHS = [f'scans/{folder}/page_{idx:04d}.png' for folder in ('a', 'b', 'c') for idx in range(200)]
+
+
+@pytest.mark.parametrize('text,expected', [('0/1', (0, 1)), ('3/4', (3, 4)), (' 1 / 2 ', (1, 2))])
+def test_parse_shard(text, expected):
+    assert parse_shard(text) == expected
+
+
+@pytest.mark.parametrize('text,message', [
+    ('1', 'i/n'), ('a/b', 'i/n'), ('1/2/3', 'i/n'), ('', 'i/n'),
+    ('0/0', 'at least 1'), ('0/-2', 'at least 1'),
+    ('2/2', r'\[0, 2\)'), ('-1/3', r'\[0, 3\)'),
+])
+def test_parse_shard_errors(text, message):
+    with pytest.raises(ValueError, match=message):
+        parse_shard(text)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 8])
+def test_shards_partition_the_inputs(count):
+    shards = [[path for path in PATHS if in_shard(path, (index, count))] for index in range(count)]
+    assert sorted(path for shard in shards for path in shard) == sorted(PATHS)
+    # roughly even
+    assert min(len(shard) for shard in shards) > len(PATHS) / count / 2
+
+
+def test_shard_of_a_file_does_not_depend_on_the_others():
+    before = {path: [index for index in range(4) if in_shard(path, (index, 4))] for path in PATHS}
+    added = PATHS + [f'new/{idx}.pdf' for idx in range(50)]
+    assert {path: [index for index in range(4) if in_shard(path, (index, 4))] for path in added[:len(PATHS)]} == before
+
+
+def test_record_and_resume(tmp_path):
+    settings = settings_hash(prompt='<image>\nFree OCR.', crop_mode=True)
+    with BatchManifest(str(tmp_path)) as manifest:
+        manifest.record('a.png', 'h1', settings, pages=1, outputs=['a.png.md'])
+        assert manifest.is_done('a.png', 'h1', settings)
+    assert os.path.basename(manifest.path) == 'manifest.jsonl'
+
+    resumed = BatchManifest(str(tmp_path))
+    assert len(resumed) == 1
+    assert resumed.is_done('a.png', 'h1', settings)
+    # changed file or changed settings: not done
+    assert not resumed.is_done('a.png', 'h2', settings)
+    assert not resumed.is_done('a.png', 'h1', settings_hash(prompt='other', crop_mode=True))
+    assert not resumed.is_done('b.png', 'h1', settings)
+    resumed.close()
+
+
+def test_resume_across_resharded_manifests(tmp_path):
+    output_dir = str(tmp_path)
+    # first run: 3 shards, each finishes part of its inputs
+    for index in range(3):
+        with BatchManifest(output_dir, (index, 3)) as manifest:
+            assert os.path.basename(manifest.path) == f'manifest.{index}-of-3.jsonl'
+            for path in PATHS[:300]:
+                if in_shard(path, (index, 3)):
+                    manifest.record(path, f'hash-{path}', 's')
+
+    # second run: 2 shards over the same directory see what every earlier shard finished
+    num_recorded = 300
+    for index in range(2):
+        with BatchManifest(output_dir, (index, 2)) as manifest:
+            assert len(manifest) == num_recorded
+            mine = [path for path in PATHS if in_shard(path, (index, 2))]
+            todo = [path for path in mine if not manifest.is_done(path, f'hash-{path}', 's')]
+            assert todo == [path for path in mine if path in PATHS[300:]]
+            for path in todo:
+                manifest.record(path, f'hash-{path}', 's')
+            num_recorded += len(todo)
+
+    # third run: a single process has nothing left to do
+    with BatchManifest(output_dir) as manifest:
+        assert len(manifest) == len(PATHS)
+        assert all(manifest.is_done(path, f'hash-{path}', 's') for path in PATHS)
+    # nothing recorded, so no manifest.jsonl either
+    assert sorted(os.listdir(output_dir)) == ['manifest.0-of-2.jsonl', 'manifest.0-of-3.jsonl',
+                                              'manifest.1-of-2.jsonl', 'manifest.1-of-3.jsonl',
+                                              'manifest.2-of-3.jsonl']
+
+
+def test_torn_last_line_is_skipped_and_finished(tmp_path):
+    with BatchManifest(str(tmp_path)) as manifest:
+        manifest.record('a.png', 'h1', 's')
+        manifest.record('b.png', 'h2', 's')
+    # crash in the middle of writing the third line
+    with open(manifest.path, 'a', encoding='utf-8') as f:
+        f.write('{"path": "c.png", "hash": "h')
+
+    with BatchManifest(str(tmp_path)) as resumed:
+        assert len(resumed) == 2
+        assert not resumed.is_done('c.png', 'h3', 's')
+        resumed.record('c.png', 'h3', 's', pages=1)
+
+    with open(manifest.path, encoding='utf-8') as f:
+        lines = f.read().split('\n')
+    assert lines[-1] == ''
+    assert lines[2] == '{"path": "c.png", "hash": "h'
+    assert json.loads(lines[3]) == {'path': 'c.png', 'hash': 'h3', 'settings': 's', 'pages': 1}
+    with BatchManifest(str(tmp_path)) as again:
+        assert len(again) == 3
+        assert again.is_done('c.png', 'h3', 's')
+
+
+def test_record_keeps_extra_fields(tmp_path):
+    with BatchManifest(str(tmp_path)) as manifest:
+        manifest.record('doc.pdf', 'h', 's', pages=3, degenerate_pages=[1], truncated_pages=[2], outputs=['doc.pdf.mmd'])
+    with open(manifest.path, encoding='utf-8') as f:
+        entry = json.loads(f.readline())
+    assert entry['degenerate_pages'] == [1] and entry['truncated_pages'] == [2]
@@ -0,0 +1,273 @@
+"""多任务请求：process() 的每页多提示词流程、视觉编码复用和 tasks 参数校验"""
+import asyncio
+import json
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from vision_reuse import VisionFeatureReuse, install_vision_reuse  # noqa: E402
+
+
+class CountingModule(torch.nn.Module):
+    """记录调用次数的视觉模块桩：输出依赖输入，便于检查回放结果"""
+
+    def __init__(self, scale: float):
+        super().__init__()
+        self.scale = scale
+        self.calls = 0
+
+    def forward(self, x, extra=None):
+        self.calls += 1
+        return x * self.scale + (0 if extra is None else extra)
+
+
+class StubInner(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.sam_model = CountingModule(2.0)
+        self.vision_model = CountingModule(3.0)
+        self.projector = CountingModule(5.0)
+
+    def encode(self, x):
+        sam = self.sam_model(x)
+        clip = self.vision_model(x, sam)
+        return self.projector(clip)
+
+
+class StubModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.model = StubInner()
+
+
+def make_reused_model():
+    model = StubModel()
+    reuse = VisionFeatureReuse()
+    assert install_vision_reuse(model, reuse)
+    return model, reuse
+
+
+def test_replay_returns_recorded_outputs():
+    model, reuse = make_reused_model()
+    x = torch.arange(6, dtype=torch.float32).reshape(2, 3)
+    expected = model.model.encode(x)
+    records = []
+    with reuse.replay(records):
+        first = model.model.encode(x)
+    with reuse.replay(records):
+        second = model.model.encode(x.clone())
+    assert torch.equal(first, expected) and torch.equal(second, expected)
+    # 未复用 1 次 + 记录 1 次 + 回放 0 次
+    assert [model.model.sam_model.calls, model.model.vision_model.calls, model.model.projector.calls] == [2, 2, 2]
+    assert (reuse.hits, reuse.misses) == (3, 3)
+
+
+def test_different_input_recomputes_and_replaces_records():
+    model, reuse = make_reused_model()
+    x = torch.ones(2, 3)
+    y = torch.full((2, 3), 2.0)
+    records = []
+    with reuse.replay(records):
+        model.model.encode(x)
+    with reuse.replay(records):
+        out = model.model.encode(y)
+    assert torch.equal(out, StubModel().model.encode(y))
+    assert model.model.sam_model.calls == 2
+    # 记录已换成 y 的结果，之后 y 可以回放
+    with reuse.replay(records):
+        assert torch.equal(model.model.encode(y), out)
+    assert model.model.sam_model.calls == 2
+
+
+def test_dtype_or_shape_change_is_not_replayed():
+    model, reuse = make_reused_model()
+    x = torch.ones(2, 3)
+    records = []
+    with reuse.replay(records):
+        model.model.encode(x)
+    with reuse.replay(records):
+        model.model.encode(x.double())
+    with reuse.replay(records):
+        model.model.encode(torch.ones(3, 2))
+    assert model.model.sam_model.calls == 3
+
+
+def test_outside_replay_is_pass_through():
+    model, reuse = make_reused_model()
+    x = torch.ones(2, 2)
+    records = []
+    with reuse.replay(records):
+        model.model.encode(x)
+    model.model.encode(x)
+    with reuse.replay(None):
+        model.model.encode(x)
+    assert model.model.sam_model.calls == 3
+    assert len(records) == 3
+
+
+def test_install_requires_all_modules():
+    model = StubModel()
+    del model.model.projector
+    assert not install_vision_reuse(model, VisionFeatureReuse())
+
+
+# ---------------------------------------------------------------------------
+# OCRService.process：用桩模型代替 HF 模型的 infer()
+
+pytest.importorskip("transformers")
+pytest.importorskip("fitz")
+Image = pytest.importorskip("PIL.Image")
+
+import fitz  # noqa: E402
+
+from ocr_service import OCRService  # noqa: E402
+
+TASKS = [{"format": "markdown"}, {"format": "free_ocr"}, {"format": "rec", "target": "标题"}]
+
+
+def make_service(reuse: bool = True):
+    """跳过模型加载的 OCRService：_infer 调用桩视觉模块后按提示词返回带 grounding 标签的文本"""
+    service = OCRService()
+    service._ready = True
+    service.model = StubModel()
+    if reuse:
+        service._vision_reuse = VisionFeatureReuse()
+        install_vision_reuse(service.model, service._vision_reuse)
+    calls = []
+
+    def fake_infer(prompt, image_file, output_dir, mode_params, cancel_event=None):
+        with Image.open(image_file) as img:
+            pixels = torch.tensor(list(img.convert("L").resize((8, 8)).getdata()), dtype=torch.float32)
+        features = service.model.model.encode(pixels)
+        calls.append((prompt, image_file, output_dir))
+        return (f"<|ref|>title<|/ref|><|det|>[[10, 10, 500, 100]]<|/det|>\n"
+                f"{prompt.splitlines()[-1]} {int(features.sum())}\n")
+
+    service._infer = fake_infer
+    return service, calls
+
+
+def make_pdf(path, texts):
+    with fitz.open() as doc:
+        for text in texts:
+            page = doc.new_page(width=300, height=400)
+            page.insert_text((40, 60), text, fontsize=18)
+        doc.save(str(path))
+
+
+def make_png(path):
+    img = Image.new("RGB", (320, 240), "white")
+    for x in range(20, 300):
+        for y in range(40, 50):
+            img.putpixel((x, y), (0, 0, 0))
+    img.save(str(path))
+
+
+def run(service, path, out_dir, **kwargs):
+    kwargs.setdefault("mode", "tiny")
+    kwargs.setdefault("output_format", "markdown")
+    return asyncio.run(service.process(file_path=str(path), output_path=str(out_dir), **kwargs))
+
+
+def test_multi_task_matches_single_task_runs(tmp_path):
+    pdf = tmp_path / "doc.pdf"
+    make_pdf(pdf, ["first page", "second page"])
+    service, calls = make_service()
+    multi = run(service, pdf, tmp_path / "multi", tasks=TASKS)
+    assert len(calls) == 2 * len(TASKS)
+    # 每页视觉编码只执行一次，其余任务回放
+    assert service.model.model.sam_model.calls == 2
+    assert service._vision_reuse.hits == 2 * (len(TASKS) - 1) * 3
+
+    for k, task in enumerate(TASKS):
+        single_service, _ = make_service(reuse=False)
+        single = run(single_service, pdf, tmp_path / f"single_{k}",
+                     output_format=task["format"], custom_prompt=task.get("target"))
+        assert multi["tasks"][k]["text"] == single["text"]
+        assert multi["tasks"][k]["prompt"] == single["prompt"]
+        assert len(multi["tasks"][k]["boxes_paths"]) == 2
+    assert multi["text"] == multi["tasks"][0]["text"]
+    assert "tasks" not in run(make_service()[0], pdf, tmp_path / "plain")
+    assert (tmp_path / "multi" / "task_1" / "result.md").exists()
+    assert (tmp_path / "multi" / "page_1" / "task_3").is_dir()
+
+
+def test_single_task_does_not_record(tmp_path):
+    png = tmp_path / "img.png"
+    make_png(png)
+    service, calls = make_service()
+    result = run(service, png, tmp_path / "out")
+    assert len(calls) == 1
+    assert service._vision_reuse.hits == 0 and service._vision_reuse.misses == 0
+    assert result["text"].startswith("Convert the document to markdown.")
+    assert result["boxes_paths"] and result["layout"] is None
+
+
+def test_progress_events_carry_task_index(tmp_path):
+    pdf = tmp_path / "doc.pdf"
+    make_pdf(pdf, ["a page", "another page"])
+    service, _ = make_service()
+    events = []
+
+    async def on_progress(event):
+        events.append(event)
+
+    run(service, pdf, tmp_path / "out", tasks=TASKS[:2], on_progress=on_progress)
+    assert [(e["page"], e["task"], e["format"]) for e in events] == [
+        (1, 0, "markdown"), (1, 1, "free_ocr"), (2, 0, "markdown"), (2, 1, "free_ocr")]
+    stream = (tmp_path / "out" / "result_stream.md").read_text(encoding="utf-8")
+    assert "--- Page 2 --- [free_ocr]" in stream
+
+
+def test_layout_with_tasks_writes_one_jsonl_per_task(tmp_path):
+    png = tmp_path / "img.png"
+    make_png(png)
+    service, _ = make_service()
+    result = run(service, png, tmp_path / "out", tasks=TASKS[:2], layout=True)
+    for k, task in enumerate(result["tasks"]):
+        assert task["layout_path"] == str(tmp_path / "out" / f"task_{k + 1}" / "layout.jsonl")
+        lines = [json.loads(line) for line in open(task["layout_path"], encoding="utf-8")]
+        assert [line["label"] for line in lines] == ["title"]
+        assert task["layout"][0]["blocks"][0]["label"] == "title"
+    assert result["layout_path"] == result["tasks"][0]["layout_path"]
+
+
+def test_invalid_task_prompt_fails_before_inference(tmp_path):
+    png = tmp_path / "img.png"
+    make_png(png)
+    service, calls = make_service()
+    with pytest.raises(ValueError):
+        run(service, png, tmp_path / "out", tasks=[{"format": "markdown"}, {"format": "rec"}])
+    assert calls == []
+
+
+# ---------------------------------------------------------------------------
+# main._parse_tasks
+
+pytest.importorskip("fastapi")
+
+from fastapi import HTTPException  # noqa: E402
+
+import main  # noqa: E402
+
+
+def test_parse_tasks_rejects_too_many_tasks():
+    max_tasks = main.get_config().get("inference.multi_task.max_tasks", 8)
+    assert len(main._parse_tasks(json.dumps([{"format": "ocr"}] * max_tasks))) == max_tasks
+    with pytest.raises(HTTPException) as info:
+        main._parse_tasks(json.dumps([{"format": "ocr"}] * (max_tasks + 1)))
+    assert info.value.status_code == 400
+
+
+@pytest.mark.parametrize("tasks", ['{"format": "ocr"}', "[]", "[1]", "not json",
+                                   '[{"format": "rec"}]', '[{"format": "unknown"}]'])
+def test_parse_tasks_rejects_invalid_tasks(tasks):
+    with pytest.raises(HTTPException) as info:
+        main._parse_tasks(tasks)
+    assert info.value.status_code == 400
+
+
+def test_parse_tasks_empty_is_single_task():
+    assert main._parse_tasks(None) is None
+    assert main._parse_tasks("  ") is None
@@ -0,0 +1,79 @@
+"""NoRepeatNGramLogitsProcessor (rolling n-gram index) against the previous full window scan, step by step"""
+import random
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from process.ngram_norepeat import NoRepeatNGramLogitsProcessor  # noqa: E402
+
+
+def reference_banned(input_ids, ngram_size, window_size, whitelist):
+    """previous implementation: rescan every n-gram in the window on each step"""
+    current_prefix = tuple(input_ids[-(ngram_size - 1):])
+    search_start = max(0, len(input_ids) - window_size)
+    search_end = len(input_ids) - ngram_size + 1
+    banned = set()
+    for i in range(search_start, search_end):
+        ngram = tuple(input_ids[i:i + ngram_size])
+        if ngram[:-1] == current_prefix:
+            banned.add(ngram[-1])
+    return banned - whitelist
+
+
+def reference_call(input_ids, scores, ngram_size, window_size, whitelist):
+    if len(input_ids) < ngram_size:
+        return scores
+    banned = reference_banned(input_ids, ngram_size, window_size, whitelist)
+    if banned:
+        scores = scores.clone()
+        for token in banned:
+            scores[token] = -float("inf")
+    return scores
+
+
+def random_sequence(rng, length, vocab):
+    # small vocabulary plus copied spans, so repeated n-grams are common
+    tokens = []
+    while len(tokens) < length:
+        if tokens and rng.random() < 0.3:
+            start = rng.randrange(len(tokens))
+            tokens.extend(tokens[start:start + rng.randint(1, 12)])
+        else:
+            tokens.append(rng.randrange(vocab))
+    return tokens[:length]
+
+
+@pytest.mark.parametrize("ngram_size,window_size", [(2, 10), (3, 7), (5, 50), (20, 50), (40, 90), (4, 4)])
+def test_banned_tokens_match_window_scan(ngram_size, window_size):
+    rng = random.Random(ngram_size * 1000 + window_size)
+    whitelist = {0, 1}
+    for _ in range(20):
+        sequence = random_sequence(rng, 400, vocab=8)
+        processor = NoRepeatNGramLogitsProcessor(ngram_size, window_size, whitelist)
+        for length in range(ngram_size, len(sequence) + 1):
+            input_ids = sequence[:length]
+            assert set(processor._banned_tokens(input_ids)) == \
+                reference_banned(input_ids, ngram_size, window_size, whitelist)
+
+
+def test_scores_match_reference_and_reset_on_new_sequence():
+    rng = random.Random(0)
+    processor = NoRepeatNGramLogitsProcessor(3, 20, {2})
+    for _ in range(3):
+        # the same instance fed a different sequence has to rebuild its index
+        sequence = random_sequence(rng, 120, vocab=6)
+        for length in range(1, len(sequence) + 1):
+            input_ids = sequence[:length]
+            scores = torch.randn(6)
+            expected = reference_call(input_ids, scores.clone(), 3, 20, {2})
+            assert torch.equal(processor(input_ids, scores.clone()), expected)
+
+
+def test_clone_starts_empty():
+    processor = NoRepeatNGramLogitsProcessor(2, 10)
+    processor._banned_tokens([1, 2, 1, 2, 1])
+    clone = processor.clone()
+    assert clone._tokens == [] and clone._index == {}
+    assert (clone.ngram_size, clone.window_size) == (2, 10)
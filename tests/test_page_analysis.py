@@ -0,0 +1,203 @@
+"""页面分析：行高估计与档位选择、空白页/重复页识别（合成页面）"""
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+from PIL import Image, ImageDraw, ImageFont  # noqa: E402
+
+from page_analysis import (  # noqa: E402
+    ANALYSIS_MAX_SIDE, BLANK_INK_RATIO, DUPLICATE_MAX_DISTANCE, DUPLICATE_MAX_TILE_DIFF, MAX_COMPRESSION, MIN_LINE_PX,
+    MODE_TABLE, analyze_page, choose_mode, estimate_vision_tokens, get_tile_grid, hamming_distance, is_duplicate_page,
+    max_tile_difference, page_fingerprint
+)
+
+A4_150DPI = (1240, 1754)
+
+
+def font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1：只有固定大小的位图字体
+        return ImageFont.load_default()
+
+
+def make_form(values, size=A4_150DPI):
+    """带标题、表格线和若干填写栏的表单页面"""
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    draw.text((120, 100), "APPLICATION FORM", fill="black", font=font(48))
+    for row, (label, value) in enumerate(values):
+        top = 260 + row * 110
+        draw.rectangle((100, top, size[0] - 100, top + 90), outline="black", width=3)
+        draw.text((130, top + 25), label, fill="black", font=font(32))
+        draw.text((560, top + 25), value, fill="black", font=font(32))
+    return img
+
+
+def rescan(img, seed=0, noise=8.0, brightness=-4.0):
+    """同一页面的另一次扫描：加高斯噪声并整体变暗"""
+    rng = np.random.default_rng(seed)
+    pixels = np.asarray(img, dtype=np.float32) + rng.normal(brightness, noise, size=(img.height, img.width, 1))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def make_lines(size, line_height, gap=None, margin=50):
+    """用实心横条模拟文字行：返回 (页面, 行数)"""
+    gap = line_height if gap is None else gap
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    num_lines = 0
+    top = margin
+    while top + line_height <= size[1] - margin:
+        draw.rectangle((margin, top, size[0] - margin - 1, top + line_height - 1), fill="black")
+        num_lines += 1
+        top += line_height + gap
+    return img, num_lines
+
+
+def stats(width, height, line_height, est_text_tokens=0, ink_ratio=0.05):
+    return {"width": width, "height": height, "ink_ratio": ink_ratio, "line_height": line_height,
+            "est_text_tokens": est_text_tokens}
+
+
+FORM_A = [("Name", "Alice Smith"), ("Date of birth", "1984-03-12"), ("Amount", "1,250.00"), ("Account", "DE44 5001")]
+FORM_B = [("Name", "Bob Jones"), ("Date of birth", "1991-11-02"), ("Amount", "9,870.45"), ("Account", "FR76 3000")]
+
+
+def test_blank_page():
+    blank = page_fingerprint(Image.new("RGB", A4_150DPI, "white"))
+    assert blank["ink_ratio"] < BLANK_INK_RATIO
+    assert page_fingerprint(rescan(Image.new("RGB", A4_150DPI, "white")))["ink_ratio"] < BLANK_INK_RATIO
+    assert page_fingerprint(make_form(FORM_A))["ink_ratio"] > BLANK_INK_RATIO
+
+
+def test_identical_page_is_duplicate():
+    a = page_fingerprint(make_form(FORM_A))
+    assert is_duplicate_page(a, page_fingerprint(make_form(FORM_A)))
+    assert max_tile_difference(a["tiles"], a["tiles"]) == 0.0
+
+
+def test_noisy_rescan_of_same_page_is_duplicate():
+    original = make_form(FORM_A)
+    a = page_fingerprint(original)
+    b = page_fingerprint(rescan(original))
+    assert hamming_distance(a["phash"], b["phash"]) <= DUPLICATE_MAX_DISTANCE
+    assert max_tile_difference(a["tiles"], b["tiles"]) <= DUPLICATE_MAX_TILE_DIFF
+    assert is_duplicate_page(a, b)
+    assert is_duplicate_page(b, page_fingerprint(rescan(original, seed=1)))
+
+
+def test_forms_with_different_values_are_not_merged():
+    a = page_fingerprint(make_form(FORM_A))
+    b = page_fingerprint(make_form(FORM_B))
+    # 感知哈希认为两页相近，逐块比较拒绝合并
+    assert hamming_distance(a["phash"], b["phash"]) <= DUPLICATE_MAX_DISTANCE
+    assert max_tile_difference(a["tiles"], b["tiles"]) > 2 * DUPLICATE_MAX_TILE_DIFF
+    assert not is_duplicate_page(a, b)
+    assert not is_duplicate_page(page_fingerprint(rescan(make_form(FORM_A))), b)
+
+
+def test_single_changed_field_is_not_merged():
+    changed = list(FORM_A)
+    changed[2] = ("Amount", "1,250.09")
+    assert not is_duplicate_page(page_fingerprint(make_form(FORM_A)), page_fingerprint(make_form(changed)))
+
+
+def test_different_size_or_layout_is_not_duplicate():
+    a = page_fingerprint(make_form(FORM_A))
+    assert not is_duplicate_page(a, page_fingerprint(make_form(FORM_A, size=(1240, 1760))))
+    other = Image.new("RGB", A4_150DPI, "white")
+    ImageDraw.Draw(other).rectangle((0, 0, 1240, 877), fill="black")
+    assert hamming_distance(a["phash"], page_fingerprint(other)["phash"]) > DUPLICATE_MAX_DISTANCE
+    assert not is_duplicate_page(a, page_fingerprint(other))
+
+
+@pytest.mark.parametrize("line_height", [12, 20, 33])
+def test_line_height_without_downscaling(line_height):
+    img, num_lines = make_lines((1000, 1000), line_height)
+    result = analyze_page(img)
+    assert result["line_height"] == line_height
+    assert result["num_lines"] == num_lines
+    assert result["est_text_tokens"] > 0
+
+
+@pytest.mark.parametrize("line_height", [24, 40, 64])
+def test_line_height_is_scaled_back_to_page_pixels(line_height):
+    # A4 300 DPI：分析前缩到 ANALYSIS_MAX_SIDE，行高按缩放比例换算回原图像素
+    size = (2480, 3508)
+    scale = ANALYSIS_MAX_SIDE / size[1]
+    img, num_lines = make_lines(size, line_height, margin=150)
+    result = analyze_page(img)
+    assert result["line_height"] == pytest.approx(line_height, abs=2 / scale)
+    assert result["num_lines"] == num_lines
+
+
+def test_blank_page_and_rules_only_page():
+    assert choose_mode(analyze_page(Image.new("RGB", A4_150DPI, "white")))["reason"] == "blank"
+    # 只有 1 像素宽的表格线：没有可识别的文字行
+    img = Image.new("RGB", (1000, 1000), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(50, 950, 20):
+        draw.line((50, y, 949, y), fill="black")
+    result = analyze_page(img)
+    assert result["line_height"] is None
+    assert choose_mode(result) == {"mode": "small", "estimated_tokens": 111, "reason": "no_text_lines"}
+
+
+# 1000×1000 页面各档位的视觉 token 数和纵向缩放比例：
+# tiny 73 / 0.512，small 111 / 0.64，base 273 / 1.024，large 421 / 1.28，gundam（2×2 切片）693 / 1.28
+@pytest.mark.parametrize("line_height,mode", [(20, "tiny"), (19, "small"), (10, "base"), (8, "large")])
+def test_cheapest_mode_with_line_px_at_least_min(line_height, mode):
+    result = choose_mode(stats(1000, 1000, line_height))
+    assert result["mode"] == mode
+    assert result["estimated_tokens"] == estimate_vision_tokens(MODE_TABLE[mode], 1000, 1000)
+    assert float(result["reason"].split("=")[1]) >= MIN_LINE_PX
+
+
+def test_no_mode_reaches_min_line_px_falls_back_to_highest_resolution():
+    result = choose_mode(stats(1000, 1000, 5))
+    assert result["mode"] == "large"
+    assert result["reason"] == "max_resolution line_px=6.4"
+
+
+@pytest.mark.parametrize("est_text_tokens,mode", [(730, "tiny"), (731, "small"), (1110, "small"), (1111, "base"),
+                                                  (3000, "large")])
+def test_compression_limit(est_text_tokens, mode):
+    # 行高足够，所有档位都满足 line_px；文本 token 超过视觉 token 的 10 倍时换更大的档位
+    result = choose_mode(stats(1000, 1000, 40, est_text_tokens))
+    assert result["mode"] == mode
+    assert est_text_tokens <= MAX_COMPRESSION * result["estimated_tokens"]
+
+
+def test_compression_limit_exceeded_everywhere():
+    result = choose_mode(stats(1000, 1000, 40, est_text_tokens=100000))
+    assert result["mode"] == "large"
+    assert result["reason"].startswith("max_resolution")
+
+
+def test_analyzed_page_end_to_end():
+    img, _ = make_lines((1000, 1000), 20)
+    assert choose_mode(analyze_page(img))["mode"] == "tiny"
+    # 行高减半、行数翻倍：tiny/small 的行高不够，base 满足
+    img, _ = make_lines((1000, 1000), 10)
+    assert choose_mode(analyze_page(img))["mode"] == "base"
+
+
+def test_max_crops_caps_the_tile_grid():
+    gundam = MODE_TABLE["gundam"]
+    assert get_tile_grid(gundam, 1000, 3000) == (1, 3)
+    assert get_tile_grid(gundam, 1000, 3000, max_crops=2) == (1, 2)
+    assert get_tile_grid(gundam, 1000, 3000, max_crops=1) == (1, 1)
+    assert [estimate_vision_tokens(gundam, 1000, 3000, max_crops) for max_crops in (9, 2, 1)] == [603, 493, 273]
+    # 小页面不切片
+    assert get_tile_grid(gundam, 640, 600) == (1, 1)
+
+
+def test_max_crops_changes_the_chosen_mode():
+    # 1000×3000 长页：只有 3 个纵向切片的 gundam 行高够（20 × 0.64 = 12.8 像素）
+    page = stats(1000, 3000, 20)
+    assert choose_mode(page) == {"mode": "gundam", "estimated_tokens": 603, "reason": "line_px=12.8"}
+    # 最多 2 个切片时 gundam 与 large 同为 8.5 像素，都不够，退回 large
+    assert choose_mode(page, max_crops=2) == {"mode": "large", "estimated_tokens": 421,
+                                              "reason": "max_resolution line_px=8.5"}
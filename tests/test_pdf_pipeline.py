@@ -0,0 +1,103 @@
+"""
+generate_in_order: continuous feeding of the engine from prefetched windows, with a fake LLMEngine.
+
+Requests finish out of order (each takes a different number of steps); the pages must still come
+out in document order, the engine must never hold more than max_in_flight requests, and it must be
+topped up as soon as a request finishes instead of draining at window boundaries.
+"""
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+for _dependency in ('torch', 'torchvision', 'transformers', 'fitz', 'PIL', 'numpy', 'tqdm'):
+    pytest.importorskip(_dependency)
+
+import run_dpsk_ocr_pdf  # noqa: E402
+
+
+class FakeEngine:
+    """add_request / step like vLLM's LLMEngine; request `page` needs steps_for(page) steps"""
+
+    def __init__(self, steps_for):
+        self.steps_for = steps_for
+        self.running = {}
+        self.max_running = 0
+        self.num_steps = 0
+
+    def add_request(self, request_id, request, params):
+        assert request_id not in self.running
+        self.running[request_id] = [request, self.steps_for(request['page'])]
+        self.max_running = max(self.max_running, len(self.running))
+
+    def step(self):
+        self.num_steps += 1
+        outputs = []
+        for request_id, entry in list(self.running.items()):
+            entry[1] -= 1
+            finished = entry[1] <= 0
+            if finished:
+                del self.running[request_id]
+            text = f"page {entry[0]['page']}"
+            outputs.append(SimpleNamespace(request_id=request_id, finished=finished,
+                                           outputs=[SimpleNamespace(text=text, token_ids=[])]))
+        return outputs
+
+
+class FakePreprocess:
+    def __init__(self):
+        self.windows = []
+
+    def map(self, images, prompt):
+        self.windows.append(list(images))
+        return [{'page': image} for image in images]
+
+
+class InlineExecutor:
+    """runs the prefetch at submit time, so the step counts do not depend on thread timing"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def windows_of(num_pages, size):
+    pages = list(range(num_pages))
+    return iter([pages[start:start + size] for start in range(0, num_pages, size)])
+
+
+def run(monkeypatch, num_pages, window, max_in_flight, steps_for):
+    engine = FakeEngine(steps_for)
+    monkeypatch.setattr(run_dpsk_ocr_pdf, 'get_llm', lambda: SimpleNamespace(llm_engine=engine))
+    monkeypatch.setattr(run_dpsk_ocr_pdf, 'get_sampling_params', lambda: None)
+    preprocess = FakePreprocess()
+    pages = list(run_dpsk_ocr_pdf.generate_in_order(windows_of(num_pages, window), preprocess, 'p', InlineExecutor(),
+                                                    max_in_flight=max_in_flight))
+    return engine, preprocess, pages
+
+
+@pytest.mark.parametrize('num_pages,window,max_in_flight', [(1, 4, 4), (23, 5, 4), (23, 4, 8), (10, 100, 3)])
+def test_pages_come_out_in_order(monkeypatch, num_pages, window, max_in_flight):
+    engine, preprocess, pages = run(monkeypatch, num_pages, window, max_in_flight,
+                                    steps_for=lambda page: 1 + (page * 7) % 5)
+    assert [image for image, _ in pages] == list(range(num_pages))
+    assert [output.outputs[0].text for _, output in pages] == [f'page {page}' for page in range(num_pages)]
+    assert engine.max_running == min(max_in_flight, num_pages)
+    assert engine.running == {}
+    assert sum(len(images) for images in preprocess.windows) == num_pages
+
+
+def test_engine_is_topped_up_across_windows(monkeypatch):
+    # one slow page per window: with per-window generate every window would wait for it
+    num_pages, window, max_in_flight = 40, 4, 4
+    engine, _, pages = run(monkeypatch, num_pages, window, max_in_flight,
+                           steps_for=lambda page: 20 if page % window == 0 else 1)
+    assert len(pages) == num_pages
+    per_window_steps = (num_pages // window) * 20
+    assert engine.num_steps < per_window_steps / 2
+
+
+def test_empty_document(monkeypatch):
+    engine, preprocess, pages = run(monkeypatch, 0, 4, 4, steps_for=lambda page: 1)
+    assert pages == [] and engine.num_steps == 0 and preprocess.windows == []
@@ -0,0 +1,65 @@
+"""StreamingImagePDFWriter: pages of mixed modes and sizes, read back with PyMuPDF"""
+import io
+
+import pytest
+
+fitz = pytest.importorskip('fitz')
+pytest.importorskip('PIL')
+
+from PIL import Image  # noqa: E402
+
+from process.pdf_writer import StreamingImagePDFWriter  # noqa: E402
+
+PAGES = [
+    ('RGB', (1191, 1684), (200, 30, 30)),
+    ('L', (640, 480), 90),
+    ('RGBA', (300, 900), (30, 200, 30, 128)),
+    ('P', (1000, 1000), 17),
+    ('CMYK', (257, 129), (0, 255, 255, 0)),
+    ('1', (123, 77), 1),
+]
+
+
+def make_pages():
+    return [Image.new(mode, size, color) for mode, size, color in PAGES]
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'layouts.pdf'
+    images = make_pages()
+    with StreamingImagePDFWriter(str(path), dpi=96) as writer:
+        for image in images:
+            writer.add_page(image)
+        assert writer.num_pages == len(images)
+
+    with fitz.open(str(path)) as doc:
+        assert not doc.is_repaired
+        assert doc.page_count == len(images)
+        for page, image in zip(doc, images):
+            width, height = image.size
+            assert page.mediabox == fitz.Rect(0, 0, width * 72 / 96, height * 72 / 96)
+            (xref, *_), = page.get_images(full=True)
+            embedded = doc.extract_image(xref)
+            assert embedded['ext'] == 'jpeg'
+            assert (embedded['width'], embedded['height']) == (width, height)
+            decoded = Image.open(io.BytesIO(embedded['image']))
+            assert decoded.mode == 'RGB' and decoded.size == image.size
+            expected = image.convert('RGB').getpixel((width // 2, height // 2))
+            actual = decoded.getpixel((width // 2, height // 2))
+            assert all(abs(a - b) <= 8 for a, b in zip(actual, expected))
+
+
+def test_dpi_sets_page_size(tmp_path):
+    path = tmp_path / 'page.pdf'
+    with StreamingImagePDFWriter(str(path), dpi=144) as writer:
+        writer.add_page(Image.new('RGB', (288, 144), 'white'))
+    with fitz.open(str(path)) as doc:
+        assert doc[0].mediabox == fitz.Rect(0, 0, 144, 72)
+
+
+def test_no_pages_writes_no_file(tmp_path):
+    path = tmp_path / 'empty.pdf'
+    with StreamingImagePDFWriter(str(path)) as writer:
+        pass
+    assert writer.num_pages == 0
+    assert not path.exists()
@@ -0,0 +1,89 @@
+"""
+PreprocessEngine: the process backend (results moved through torch shared memory) returns the
+same requests as the thread backend.
+
+Uses a tiny in-memory LlamaTokenizerFast, so no model files are needed.
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+for _dependency in ('torchvision', 'transformers', 'tokenizers', 'PIL', 'tqdm'):
+    pytest.importorskip(_dependency)
+
+from PIL import Image, ImageDraw  # noqa: E402
+from tokenizers import Tokenizer, models, pre_tokenizers  # noqa: E402
+from transformers import LlamaTokenizerFast  # noqa: E402
+
+from config import MODES  # noqa: E402
+from process.preprocess_pool import PreprocessEngine  # noqa: E402
+
+PROMPT = '<image>\n<|grounding|>Convert the document to markdown.'
+WORDS = ['<unk>', '<s>', '</s>', '<｜▁pad▁｜>', '<image>', '<|grounding|>', 'Convert', 'the', 'document', 'to',
+         'markdown', '.']
+
+
+def tiny_tokenizer():
+    backend = Tokenizer(models.WordLevel({word: idx for idx, word in enumerate(WORDS)}, unk_token='<unk>'))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    return LlamaTokenizerFast(tokenizer_object=backend, bos_token='<s>', eos_token='</s>', unk_token='<unk>',
+                              pad_token='<｜▁pad▁｜>')
+
+
+def pages():
+    result = []
+    for idx, size in enumerate([(1191, 1684), (1600, 900), (500, 620), (1191, 1684)]):
+        page = Image.new('RGB', size, 'white')
+        draw = ImageDraw.Draw(page)
+        for y in range(40, size[1] - 40, 30):
+            draw.text((40, y), f'page {idx} line {y} ' * 6, fill='black')
+        result.append(page)
+    return result
+
+
+def assert_same(a, b, path='request'):
+    if isinstance(a, torch.Tensor):
+        assert isinstance(b, torch.Tensor), path
+        assert a.dtype == b.dtype and a.shape == b.shape, path
+        assert torch.equal(a, b), path
+    elif isinstance(a, dict):
+        assert a.keys() == b.keys(), path
+        for key in a:
+            assert_same(a[key], b[key], f'{path}[{key!r}]')
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b), path
+        for idx, (x, y) in enumerate(zip(a, b)):
+            assert_same(x, y, f'{path}[{idx}]')
+    else:
+        assert a == b, path
+
+
+@pytest.mark.parametrize('mode', ['gundam', 'tiny'])
+@pytest.mark.parametrize('uint8_tiles', [False, True])
+def test_process_backend_matches_thread_backend(mode, uint8_tiles):
+    processor_kwargs = dict(MODES[mode], uint8_tiles=uint8_tiles, tokenizer=tiny_tokenizer())
+    images = pages()
+    with PreprocessEngine(backend='thread', num_workers=2, processor_kwargs=processor_kwargs, cache_mb=0) as engine:
+        expected = engine.map(images, PROMPT)
+    with PreprocessEngine(backend='process', num_workers=2, processor_kwargs=processor_kwargs, cache_mb=0) as engine:
+        actual = engine.map(images, PROMPT)
+
+    assert len(actual) == len(images)
+    assert_same(expected, actual)
+    # the pixel tensors came back through shared memory, not as pickled bytes
+    pixel_values = actual[0]['multi_modal_data']['image'][0][1]
+    assert pixel_values.is_shared()
+    assert pixel_values.dtype == (torch.uint8 if uint8_tiles else torch.float32)
+
+
+def test_repeated_page_is_processed_once_per_batch():
+    processor_kwargs = dict(MODES['tiny'], tokenizer=tiny_tokenizer())
+    images = pages()
+    images.append(images[0].copy())
+    with PreprocessEngine(backend='process', num_workers=2, processor_kwargs=processor_kwargs,
+                          cache_mb=64) as engine:
+        requests = engine.map(images, PROMPT)
+        assert engine.cache.stats()['entries'] == 4
+        again = engine.map(images[:1], PROMPT)
+        assert engine.cache.stats()['hits'] == 1
+    assert_same(requests[0], requests[4])
+    assert_same(requests[0], again[0])
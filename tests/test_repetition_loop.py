@@ -0,0 +1,182 @@
+"""
+RepetitionLoopDetector (process/repeat_stop.py and its copy in backend/repetition_guard.py):
+periodic tails, the min_loop_tokens / min_repeats thresholds, no false positive on long tables,
+a brute-force reference, and a differential check that both copies agree token by token.
+"""
+import random
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from process.repeat_stop import RepetitionLoopDetector, RepetitionStopLogitsProcessor  # noqa: E402
+
+
+def reference_loop(tokens, max_period, min_loop_tokens, min_repeats):
+    """first (period, span) reported by a brute-force scan of every prefix, or None"""
+    for end in range(1, len(tokens) + 1):
+        for period in range(1, min(max_period, end - 1) + 1):
+            run = 0
+            while end - 1 - run - period >= 0 and tokens[end - 1 - run] == tokens[end - 1 - run - period]:
+                run += 1
+            if run and run + period >= min_loop_tokens and run + period >= period * min_repeats:
+                return period, run + period
+    return None
+
+
+def cycle(period, count, start=1000):
+    return [start + idx % period for idx in range(period * count)]
+
+
+def table_row(cells, row_number=None):
+    row = [10] + ([11, 100 + row_number, 12] if row_number is not None else [])
+    return row + [11, 12] * cells + [13]
+
+
+def test_periodic_tail_is_reported_with_its_period():
+    prefix = list(range(50))
+    detector = RepetitionLoopDetector(max_period=16, min_loop_tokens=70, min_repeats=4)
+    assert detector.extend(prefix) is None
+    assert detector.extend(cycle(7, 20)) == (7, 70)
+    assert detector.loop == (7, 70)
+
+
+def test_loop_reported_at_the_exact_token():
+    detector = RepetitionLoopDetector(max_period=16, min_loop_tokens=70, min_repeats=4)
+    tokens = list(range(50)) + cycle(7, 20)
+    results = [detector.push(token) for token in tokens]
+    first = next(idx for idx, result in enumerate(results) if result is not None)
+    # the span counts the first cycle too: 70 tokens of the cycle
+    assert first == 50 + 70 - 1
+    assert all(result == (7, 70) for result in results[first:])
+
+
+def test_min_loop_tokens_threshold():
+    tokens = list(range(50)) + cycle(5, 30)
+    assert RepetitionLoopDetector(16, min_loop_tokens=150, min_repeats=2).find_loop(tokens) == (5, 150)
+    assert RepetitionLoopDetector(16, min_loop_tokens=151, min_repeats=2).find_loop(tokens) is None
+
+
+def test_min_repeats_threshold():
+    # period 40: min_loop_tokens is reached after 2.5 cycles, min_repeats needs 4 full cycles
+    tokens = list(range(2000, 2050)) + cycle(40, 4)
+    assert RepetitionLoopDetector(64, min_loop_tokens=100, min_repeats=4).find_loop(tokens) == (40, 160)
+    assert RepetitionLoopDetector(64, min_loop_tokens=100, min_repeats=5).find_loop(tokens) is None
+    assert RepetitionLoopDetector(64, min_loop_tokens=100, min_repeats=4).find_loop(tokens[:-1]) is None
+
+
+def test_period_longer_than_max_period_is_ignored():
+    tokens = cycle(40, 10)
+    assert RepetitionLoopDetector(max_period=39, min_loop_tokens=100, min_repeats=2).find_loop(tokens) is None
+    assert RepetitionLoopDetector(max_period=40, min_loop_tokens=100, min_repeats=2).find_loop(tokens) == (40, 100)
+
+
+def test_long_numbered_empty_table_is_not_a_loop():
+    # 500 rows of 10 empty cells, each row starting with its row number: ~12k tokens, never periodic for long
+    tokens = [1, 2, 3] + [token for row in range(500) for token in table_row(10, row_number=row)] + [4]
+    assert len(tokens) > 10 * 1024
+    assert RepetitionLoopDetector().find_loop(tokens) is None
+
+
+def test_empty_table_below_min_loop_tokens_is_not_a_loop():
+    rows = [token for _ in range(45) for token in table_row(10)]
+    assert len(rows) < 1024
+    assert RepetitionLoopDetector().find_loop([1, 2, 3] + rows + [4]) is None
+    # the same table, long enough, is a loop with the row as its period
+    long_rows = [token for _ in range(60) for token in table_row(10)]
+    assert RepetitionLoopDetector().find_loop([1, 2, 3] + long_rows) == (22, 1024)
+
+
+def test_find_loop_resets_state():
+    detector = RepetitionLoopDetector(16, min_loop_tokens=40, min_repeats=4)
+    assert detector.find_loop(cycle(3, 20)) is not None
+    assert detector.find_loop(list(range(100))) is None
+
+
+def test_invalid_max_period():
+    with pytest.raises(ValueError):
+        RepetitionLoopDetector(max_period=0)
+
+
+def random_sequence(rng, length):
+    """random tokens from a small vocabulary with planted cycles of random period and length"""
+    tokens = []
+    while len(tokens) < length:
+        if rng.random() < 0.3:
+            period = rng.randint(1, 12)
+            unit = [rng.randrange(6) for _ in range(period)]
+            tokens += (unit * (rng.randint(1, 80) // period + 1))[:rng.randint(period, 90)]
+        else:
+            tokens += [rng.randrange(6) for _ in range(rng.randint(1, 20))]
+    return tokens[:length]
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_matches_brute_force_reference(seed):
+    rng = random.Random(seed)
+    max_period, min_loop_tokens, min_repeats = rng.randint(1, 12), rng.randint(2, 60), rng.randint(1, 5)
+    tokens = random_sequence(rng, 300)
+    detector = RepetitionLoopDetector(max_period, min_loop_tokens, min_repeats)
+    assert detector.find_loop(tokens) == reference_loop(tokens, max_period, min_loop_tokens, min_repeats)
+
+
+def test_logits_processor_forces_eos_after_a_loop():
+    eos = 2
+    processor = RepetitionStopLogitsProcessor(eos, max_period=8, min_loop_tokens=20, min_repeats=4)
+    tokens = list(range(10, 30))
+    scores = processor(tokens, torch.zeros(50))
+    assert torch.equal(scores, torch.zeros(50))
+    tokens += cycle(3, 7)
+    scores = processor(tokens, torch.arange(50, dtype=torch.float32))
+    assert scores[eos] == eos and torch.isinf(scores).sum() == 49
+    # a shorter input is a new sequence
+    assert torch.isfinite(processor(list(range(10, 20)), torch.zeros(50))).all()
+    assert torch.isinf(processor.clone()(tokens, torch.zeros(50))).sum() == 49
+
+
+# ---------------------------------------------------------------------------
+# backend/repetition_guard.py keeps its own copy of the detector
+
+@pytest.fixture
+def repetition_guard():
+    pytest.importorskip('transformers')
+    import repetition_guard
+    return repetition_guard
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_backend_copy_agrees_token_by_token(repetition_guard, seed):
+    rng = random.Random(1000 + seed)
+    params = (rng.randint(1, 16), rng.randint(2, 80), rng.randint(1, 5))
+    tokens = random_sequence(rng, 400)
+    vllm_detector = RepetitionLoopDetector(*params)
+    backend_detector = repetition_guard.RepetitionLoopDetector(*params)
+    for token in tokens:
+        assert vllm_detector.push(token) == backend_detector.push(token)
+
+
+def test_backend_copy_on_tables_and_cycles(repetition_guard):
+    for tokens in ([token for row in range(500) for token in table_row(10, row_number=row)],
+                   [token for _ in range(60) for token in table_row(10)],
+                   list(range(50)) + cycle(7, 200)):
+        assert repetition_guard.RepetitionLoopDetector().extend(tokens) == RepetitionLoopDetector().find_loop(tokens)
+
+
+def test_stopping_criteria_checks_every_interval_and_skips_the_prompt(repetition_guard):
+    criteria = repetition_guard.RepetitionStoppingCriteria(max_period=8, min_loop_tokens=20, min_repeats=4,
+                                                            check_interval=4)
+    criteria.reset()
+    # a prompt full of identical image tokens is not part of the output
+    prompt = [7] * 100
+    generated = list(range(10, 20)) + cycle(3, 10)
+    stops = []
+    for length in range(1, len(generated) + 1):
+        input_ids = torch.tensor([prompt + generated[:length]])
+        stops.append(bool(criteria(input_ids, None)[0]))
+    first = stops.index(True)
+    assert not any(stops[:first]) and all(stops[first:])
+    # the loop is complete after 20 cycle tokens, and noticed at the next check
+    assert 10 + 20 <= first + 1 < 10 + 20 + 4
+    assert criteria.loop is not None and criteria.loop[0] == 3
+    criteria.reset()
+    assert criteria.loop is None
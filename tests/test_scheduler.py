@@ -0,0 +1,182 @@
+"""调度器与过载降级策略的单元测试（用桩服务代替 OCRService）"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+from scheduler import MODES_BY_COST, DegradationPolicy, OCRScheduler, RequestTimeouts  # noqa: E402
+
+
+class StubService:
+    """只实现 async process(**kwargs)，记录收到的参数"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = []
+
+    async def process(self, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.delay)
+        return {"success": True, "page_modes": [kwargs.get("mode")]}
+
+
+class PagedStubService(StubService):
+    """带阻塞 count_pages 的桩服务，记录统计页数所在的线程"""
+
+    def __init__(self, num_pages: int, count_delay: float):
+        super().__init__()
+        self.num_pages = num_pages
+        self.count_delay = count_delay
+        self.count_threads = []
+
+    def count_pages(self, file_path):
+        self.count_threads.append(threading.get_ident())
+        time.sleep(self.count_delay)
+        return self.num_pages
+
+
+def test_modes_by_cost_is_cheapest_first():
+    assert MODES_BY_COST[0] == "tiny"
+    assert MODES_BY_COST.index("small") < MODES_BY_COST.index("base") < MODES_BY_COST.index("large")
+
+
+def test_disabled_policy_never_degrades():
+    policy = DegradationPolicy(enabled=False)
+    assert policy.decide("large", queue_wait=1000.0, gpu_utilization=100.0) is None
+
+
+def test_no_degradation_below_thresholds():
+    policy = DegradationPolicy(enabled=True, queue_wait_seconds=30.0, gpu_utilization_percent=95.0)
+    assert policy.decide("large", queue_wait=1.0, gpu_utilization=50.0) is None
+
+
+def test_queue_wait_downgrades_one_step():
+    policy = DegradationPolicy(enabled=True, queue_wait_seconds=30.0)
+    decision = policy.decide("large", queue_wait=31.0)
+    assert decision["from"] == "large"
+    assert decision["to"] == MODES_BY_COST[MODES_BY_COST.index("large") - 1]
+    assert decision["max_crops"] == policy.max_crops
+    assert decision["reason"].startswith("queue_wait")
+
+
+def test_gpu_utilization_triggers_degradation():
+    policy = DegradationPolicy(enabled=True, queue_wait_seconds=30.0, gpu_utilization_percent=90.0)
+    decision = policy.decide("base", queue_wait=0.0, gpu_utilization=97.0)
+    assert decision is not None and decision["reason"].startswith("gpu_utilization")
+
+
+def test_min_mode_is_a_floor():
+    policy = DegradationPolicy(enabled=True, queue_wait_seconds=0.0, min_mode="small")
+    assert policy.decide("small", queue_wait=1.0) is None
+    assert policy.decide("tiny", queue_wait=1.0) is None
+
+
+def test_crop_and_auto_modes_only_cap_crops():
+    policy = DegradationPolicy(enabled=True, queue_wait_seconds=0.0, max_crops=4)
+    for mode in ("gundam", "auto"):
+        decision = policy.decide(mode, queue_wait=1.0)
+        assert decision["to"] == mode and decision["max_crops"] == 4
+    assert policy.decide("unknown", queue_wait=1.0) is None
+
+
+def test_unknown_min_mode_rejected():
+    with pytest.raises(ValueError):
+        DegradationPolicy(min_mode="huge")
+
+
+def test_scheduler_passes_through_without_load():
+    service = StubService()
+    scheduler = OCRScheduler(service, policy=DegradationPolicy(enabled=False))
+    result = asyncio.run(scheduler.submit(file_path=None, mode="large"))
+    assert result["degraded"] is None
+    assert service.calls[0]["mode"] == "large"
+    assert "deadline" in service.calls[0]
+
+
+def test_scheduler_degrades_and_flags_result():
+    service = StubService()
+    policy = DegradationPolicy(enabled=True, queue_wait_seconds=0.0, gpu_utilization_fn=lambda: None)
+    scheduler = OCRScheduler(service, policy=policy)
+    result = asyncio.run(scheduler.submit(file_path=None, mode="large"))
+    assert result["degraded"]["from"] == "large"
+    assert service.calls[0]["mode"] == result["degraded"]["to"]
+    assert service.calls[0]["max_crops"] == policy.max_crops
+    assert scheduler.stats()["degraded"] == 1
+
+
+def test_scheduler_limits_concurrency():
+    service = StubService(delay=0.01)
+    scheduler = OCRScheduler(service, max_concurrency=1)
+    running = []
+
+    async def run():
+        original = service.process
+
+        async def tracked(**kwargs):
+            running.append(scheduler.stats()["running"])
+            return await original(**kwargs)
+
+        service.process = tracked
+        await asyncio.gather(*(scheduler.submit(file_path=None, mode="base") for _ in range(3)))
+
+    asyncio.run(run())
+    assert running == [1, 1, 1]
+    assert scheduler.stats()["running"] == 0
+
+
+def test_scheduler_rejects_requests_past_their_deadline():
+    service = StubService(delay=0.05)
+    scheduler = OCRScheduler(service, max_concurrency=1,
+                             timeouts=RequestTimeouts(default_seconds=0.01, per_page_seconds=0.01))
+
+    async def run():
+        return await asyncio.gather(*(scheduler.submit(file_path=None, mode="base") for _ in range(2)),
+                                    return_exceptions=True)
+
+    first, second = asyncio.run(run())
+    assert first["success"]
+    assert isinstance(second, TimeoutError)
+    assert scheduler.stats()["expired"] == 1
+
+
+def test_page_count_does_not_block_the_event_loop():
+    service = PagedStubService(num_pages=3, count_delay=0.2)
+    scheduler = OCRScheduler(service)
+    ticks = []
+
+    async def ticker(stop):
+        while not stop.is_set():
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def run():
+        stop = asyncio.Event()
+        task = asyncio.create_task(ticker(stop))
+        await asyncio.sleep(0)
+        result = await scheduler.submit(file_path="doc.pdf", mode="base")
+        stop.set()
+        await task
+        return result
+
+    result = asyncio.run(run())
+    assert result["success"]
+    assert service.count_threads and threading.get_ident() not in service.count_threads
+    # 统计页数期间事件循环仍在调度其他协程
+    assert len(ticks) >= 5
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.15
+
+
+def test_page_count_scales_the_deadline():
+    service = PagedStubService(num_pages=4, count_delay=0.0)
+    timeouts = RequestTimeouts(default_seconds=10.0, per_page_seconds=5.0)
+    scheduler = OCRScheduler(service, timeouts=timeouts)
+    before = time.monotonic()
+    asyncio.run(scheduler.submit(file_path="doc.pdf", mode="base", tasks=["ocr", "figure"]))
+    assert service.calls[0]["deadline"] >= before + timeouts.request_budget(8)
+    # 没有文件路径时不统计页数
+    asyncio.run(scheduler.submit(file_path=None, mode="base"))
+    assert len(service.count_threads) == 1
@@ -0,0 +1,72 @@
+"""
+UINT8_TILES: raw uint8 tiles normalized on the device by DeepseekOCRForCausalLM._to_model_input must
+give the same bfloat16 model input as the float ToTensor + Normalize(0.5, 0.5) path, for the padded
+global view and for every local crop.
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+for _dependency in ('vllm', 'einops', 'addict', 'torchvision', 'tokenizers', 'transformers', 'PIL'):
+    pytest.importorskip(_dependency)
+
+from PIL import Image  # noqa: E402
+from tokenizers import Tokenizer, models, pre_tokenizers  # noqa: E402
+from transformers import LlamaTokenizerFast  # noqa: E402
+
+from config import MODES  # noqa: E402
+from deepseek_ocr import DeepseekOCRForCausalLM  # noqa: E402
+from process.image_process import DeepseekOCRProcessor, ImageTransform  # noqa: E402
+
+PROMPT = '<image>\nFree OCR.'
+WORDS = ['<unk>', '<s>', '</s>', '<｜▁pad▁｜>', '<image>', 'Free', 'OCR', '.']
+
+
+def tiny_tokenizer():
+    backend = Tokenizer(models.WordLevel({word: idx for idx, word in enumerate(WORDS)}, unk_token='<unk>'))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    return LlamaTokenizerFast(tokenizer_object=backend, bos_token='<s>', eos_token='</s>', unk_token='<unk>',
+                              pad_token='<｜▁pad▁｜>')
+
+
+def pattern(width, height):
+    """every byte value in every channel"""
+    data = bytes(value for y in range(height) for x in range(width)
+                 for value in ((x + y) % 256, (3 * x) % 256, (7 * y + x // 5) % 256))
+    return Image.frombytes('RGB', (width, height), data)
+
+
+def test_every_byte_value_normalizes_identically():
+    image = pattern(256, 16)
+    as_float = ImageTransform()(image)
+    as_uint8 = ImageTransform(as_uint8=True)(image)
+    assert as_uint8.dtype == torch.uint8 and as_float.dtype == torch.float32
+    assert torch.equal(DeepseekOCRForCausalLM._to_model_input(as_uint8), as_float.to(torch.bfloat16))
+    # already exact before the bfloat16 cast
+    assert torch.equal(as_uint8.to(torch.float32).div_(127.5).sub_(1.0), as_float)
+
+
+@pytest.mark.parametrize('mode,size', [('gundam', (1200, 900)), ('gundam', (700, 1500)), ('gundam', (500, 620)),
+                                       ('base', (1200, 900)), ('tiny', (900, 1200))])
+def test_processor_tiles_match_float_path(mode, size):
+    image = pattern(*size)
+    tokenizer = tiny_tokenizer()
+    (float_ids, float_pixels, float_crops, _, float_grid, *_), = DeepseekOCRProcessor(
+        tokenizer=tokenizer, uint8_tiles=False, **MODES[mode]).tokenize_with_images([image], prompt=PROMPT)
+    (uint8_ids, uint8_pixels, uint8_crops, _, uint8_grid, *_), = DeepseekOCRProcessor(
+        tokenizer=tokenizer, uint8_tiles=True, **MODES[mode]).tokenize_with_images([image], prompt=PROMPT)
+
+    assert torch.equal(float_ids, uint8_ids) and torch.equal(float_grid, uint8_grid)
+    assert uint8_pixels.dtype == torch.uint8 and uint8_pixels.shape == float_pixels.shape
+    assert torch.equal(DeepseekOCRForCausalLM._to_model_input(uint8_pixels), float_pixels.to(torch.bfloat16))
+
+    base_size = MODES[mode]['base_size']
+    if size[0] != size[1] and (MODES[mode]['crop_mode'] or MODES[mode]['image_size'] > 640):
+        # the global view is padded with the mean colour (127), compared above as part of the whole view
+        padded = uint8_pixels[0, :, -1, :] if size[0] > size[1] else uint8_pixels[0, :, :, -1]
+        assert torch.equal(padded, torch.full((3, base_size), 127, dtype=torch.uint8))
+
+    num_width_tiles, num_height_tiles = float_grid[0].tolist()
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        assert uint8_crops.shape == float_crops.shape
+        assert uint8_crops.shape[1] == num_width_tiles * num_height_tiles
+        assert torch.equal(DeepseekOCRForCausalLM._to_model_input(uint8_crops), float_crops.to(torch.bfloat16))
@@ -0,0 +1,91 @@
+"""VisionEmbeddingCache: byte accounting across dtypes, LRU eviction, counters; image_hash_tensor"""
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from process.vision_cache import VisionEmbeddingCache, image_hash_tensor  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def features(nbytes, dtype=torch.bfloat16, fill=0.0):
+    """[tokens, dim] features taking nbytes"""
+    element_size = torch.empty((), dtype=dtype).element_size()
+    return torch.full((nbytes // element_size // 64, 64), fill, dtype=dtype)
+
+
+def test_size_accounting_follows_element_size():
+    cache = VisionEmbeddingCache(max_mb=1)
+    cache.put('bf16', features(MB // 4, torch.bfloat16))
+    cache.put('fp32', features(MB // 4, torch.float32))
+    assert cache._bytes == MB // 2
+    assert cache.stats() == {'entries': 2, 'mb': 0.5, 'hits': 0, 'misses': 0}
+
+
+def test_lru_eviction_by_bytes():
+    cache = VisionEmbeddingCache(max_mb=1)
+    for key in 'abcd':
+        cache.put(key, features(MB // 4))
+    assert cache._bytes == MB
+    assert cache.get('a') is not None  # a is now the most recent
+    cache.put('e', features(MB // 4))
+    assert cache.get('b') is None
+    assert all(cache.get(key) is not None for key in 'acde')
+    assert cache._bytes == MB
+
+
+def test_large_entry_evicts_several():
+    cache = VisionEmbeddingCache(max_mb=1)
+    for key in 'abcd':
+        cache.put(key, features(MB // 4))
+    cache.put('big', features(MB // 2, torch.float32))
+    assert [key for key in 'abcd' if cache.get(key) is not None] == ['c', 'd']
+    assert cache._bytes == MB
+
+
+def test_entry_larger_than_cap_is_not_stored():
+    cache = VisionEmbeddingCache(max_mb=1)
+    cache.put('a', features(MB // 4))
+    cache.put('huge', features(2 * MB))
+    assert cache.get('huge') is None
+    assert cache.get('a') is not None
+    assert cache._bytes == MB // 4
+
+
+def test_put_of_existing_key_is_counted_once():
+    cache = VisionEmbeddingCache(max_mb=1)
+    first = features(MB // 4, fill=1.0)
+    cache.put('a', first)
+    cache.put('b', features(MB // 4))
+    cache.put('a', features(MB // 4, fill=2.0))
+    assert cache._bytes == MB // 2
+    assert cache.get('a') is first
+    # the repeated put refreshed a: b is evicted first
+    cache.put('c', features(MB // 2))
+    cache.put('d', features(MB // 4))
+    assert cache.get('b') is None and cache.get('a') is not None
+
+
+def test_counters_and_clear():
+    cache = VisionEmbeddingCache(max_mb=1)
+    cache.get((1, 2))
+    cache.put((1, 2), features(1024))
+    cache.get((1, 2))
+    cache.get((1, 2))
+    cache.clear()
+    assert cache.stats() == {'entries': 0, 'mb': 0.0, 'hits': 2, 'misses': 1}
+    assert cache.get((1, 2)) is None
+    assert cache._bytes == 0
+
+
+def test_zero_cap_stores_nothing():
+    cache = VisionEmbeddingCache(max_mb=0)
+    cache.put('a', features(1024))
+    assert cache.get('a') is None and cache._bytes == 0
+
+
+def test_image_hash_tensor():
+    assert torch.equal(image_hash_tensor(''), torch.zeros((1, 2), dtype=torch.long))
+    digest = 'ffffffffffffffff0000000000000001'
+    assert image_hash_tensor(digest).tolist() == [[-1, 1]]
+    assert image_hash_tensor('0123456789abcdef' * 2).tolist() == [[0x0123456789abcdef] * 2]
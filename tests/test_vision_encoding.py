@@ -0,0 +1,194 @@
+"""
+Batched _pixel_values_to_embedding against the previous per-image loop, on CPU.
+
+The SAM / CLIP / projector modules are replaced by tiny stand-ins with the same call signatures
+and output layouts, so the test checks the batching and scatter logic, not the encoders.
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+for _dependency in ('vllm', 'einops', 'addict', 'torchvision', 'transformers', 'PIL'):
+    pytest.importorskip(_dependency)
+
+from torch import nn  # noqa: E402
+
+import deepseek_ocr  # noqa: E402
+from deepseek_ocr import DeepseekOCRForCausalLM  # noqa: E402
+from process.vision_cache import VisionEmbeddingCache  # noqa: E402
+
+PATCH = 16
+SAM_DIM = 6
+CLIP_DIM = 10
+N_EMBED = 8
+CROP_SIZE = 32
+
+
+class StubSam(nn.Module):
+    """[B, 3, H, W] -> [B, SAM_DIM, H / PATCH, W / PATCH], like the SAM neck output"""
+
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Conv2d(3, SAM_DIM, kernel_size=PATCH, stride=PATCH)
+
+    def forward(self, x):
+        return self.proj(x)
+
+
+class StubClip(nn.Module):
+    """(pixels, SAM features) -> [B, 1 + h * w, CLIP_DIM], class token first"""
+
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Linear(SAM_DIM, CLIP_DIM)
+        self.class_embedding = nn.Parameter(torch.randn(1, 1, CLIP_DIM))
+
+    def forward(self, x, patch_embeds):
+        tokens = self.proj(patch_embeds.flatten(2).permute(0, 2, 1))
+        return torch.cat([self.class_embedding.expand(tokens.size(0), -1, -1), tokens], dim=1)
+
+
+def build_model():
+    torch.manual_seed(0)
+    model = DeepseekOCRForCausalLM.__new__(DeepseekOCRForCausalLM)
+    nn.Module.__init__(model)
+    model.sam_model = StubSam()
+    model.vision_model = StubClip()
+    model.projector = nn.Linear(SAM_DIM + CLIP_DIM, N_EMBED)
+    model.image_newline = nn.Parameter(torch.randn(N_EMBED))
+    model.view_seperator = nn.Parameter(torch.randn(N_EMBED))
+    return model.to(torch.bfloat16).eval()
+
+
+def reference_embedding(model, pixel_values, images_crop, images_spatial_crop):
+    """previous code: one image at a time, crops detected from the pixel values"""
+    def encode(views):
+        features_1 = model.sam_model(views)
+        features_2 = model.vision_model(views, features_1)
+        return model.projector(torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1))
+
+    images_in_this_batch = []
+    with torch.no_grad():
+        for jdx in range(images_spatial_crop.size(0)):
+            patches = images_crop[jdx][0].to(torch.bfloat16)
+            global_features = encode(pixel_values[jdx])
+            _, hw, n_dim = global_features.shape
+            h = w = int(hw ** 0.5)
+            global_features = global_features.view(h, w, n_dim)
+            global_features = torch.cat([global_features, model.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1)
+            global_features = global_features.view(-1, n_dim)
+            if torch.sum(patches).item() != 0:
+                local_features = encode(patches)
+                _2, hw2, n_dim2 = local_features.shape
+                h2 = w2 = int(hw2 ** 0.5)
+                width_crop_num, height_crop_num = images_spatial_crop[jdx][0].tolist()
+                local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(
+                    0, 2, 1, 3, 4).reshape(height_crop_num * h2, width_crop_num * w2, n_dim2)
+                local_features = torch.cat(
+                    [local_features, model.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], dim=1)
+                local_features = local_features.view(-1, n_dim2)
+                images_in_this_batch.append(torch.cat([local_features, global_features, model.view_seperator[None, :]], dim=0))
+            else:
+                images_in_this_batch.append(torch.cat([global_features, model.view_seperator[None, :]], dim=0))
+    return images_in_this_batch
+
+
+def make_inputs(images):
+    """images: [(base_size, num_width_tiles, num_height_tiles)], laid out per image as vLLM hands them over"""
+    pixel_values, images_crop, images_spatial_crop = [], [], []
+    for base_size, num_width_tiles, num_height_tiles in images:
+        pixel_values.append(torch.randn(1, 3, base_size, base_size).to(torch.bfloat16))
+        if num_width_tiles > 1 or num_height_tiles > 1:
+            images_crop.append(torch.randn(1, num_width_tiles * num_height_tiles, 3, CROP_SIZE, CROP_SIZE))
+            images_spatial_crop.append([[num_width_tiles, num_height_tiles]])
+        else:
+            # no-crop placeholder written by tokenize_with_images
+            images_crop.append(torch.zeros(1, 1, 3, CROP_SIZE, CROP_SIZE))
+            images_spatial_crop.append([[0, 0]])
+    return pixel_values, images_crop, torch.tensor(images_spatial_crop, dtype=torch.long)
+
+
+@pytest.mark.parametrize('vision_batch_size', [1, 3, 32])
+@pytest.mark.parametrize('images', [
+    [(64, 1, 1)],
+    [(64, 2, 1)],
+    [(64, 2, 1), (64, 1, 1), (48, 3, 2), (64, 1, 3), (48, 1, 1)],
+    [(48, 2, 2), (48, 2, 2), (64, 1, 1)],
+])
+def test_batched_embedding_matches_per_image_loop(monkeypatch, images, vision_batch_size):
+    monkeypatch.setattr(deepseek_ocr, 'VISION_BATCH_SIZE', vision_batch_size)
+    model = build_model()
+    pixel_values, images_crop, images_spatial_crop = make_inputs(images)
+
+    expected = reference_embedding(model, pixel_values, images_crop, images_spatial_crop)
+    batched = model._pixel_values_to_embedding(pixel_values, images_crop, images_spatial_crop)
+    with_shapes = model._pixel_values_to_embedding(pixel_values, images_crop, None,
+                                                   crop_shapes=images_spatial_crop[:, 0].tolist())
+
+    assert len(batched) == len(expected) == len(with_shapes)
+    for features, reference, shaped in zip(batched, expected, with_shapes):
+        assert features.shape == reference.shape
+        # bfloat16 stand-ins: a different batch split may round the last bit differently
+        torch.testing.assert_close(features, reference, rtol=1.6e-2, atol=1e-2)
+        torch.testing.assert_close(shaped, features, rtol=0, atol=0)
+
+
+def test_placeholder_image_is_dropped_from_metadata():
+    # tokenize_with_images writes a [0, 0] grid and an all-zero hash for a prompt without an image
+    model = build_model()
+    image_input = model._parse_and_validate_image_input(
+        pixel_values=torch.zeros(1, 1, 3, 64, 64), images_crop=torch.zeros(1, 1, 1, 3, CROP_SIZE, CROP_SIZE),
+        images_spatial_crop=torch.zeros(1, 1, 2, dtype=torch.long), image_hashes=torch.zeros(1, 1, 2, dtype=torch.long))
+    assert image_input is None
+
+
+def test_crop_shapes_and_cache_keys_come_from_metadata():
+    model = build_model()
+    images_spatial_crop = torch.tensor([[[2, 3]], [[0, 0]]])
+    image_hashes = torch.tensor([[[7, -9]], [[0, 0]]])
+    image_input = model._parse_and_validate_image_input(
+        pixel_values=torch.zeros(2, 1, 3, 64, 64), images_crop=torch.zeros(2, 1, 6, 3, CROP_SIZE, CROP_SIZE),
+        images_spatial_crop=images_spatial_crop, image_hashes=image_hashes)
+    assert image_input[3] == [[2, 3], [0, 0]]
+    assert image_input[4] == [(7, -9), None]
+
+
+def test_cache_hits_and_misses_in_one_batch(monkeypatch):
+    model = build_model()
+    model.vision_cache = VisionEmbeddingCache(max_mb=64)
+    images = [(64, 2, 1), (64, 1, 1), (48, 3, 2), (64, 1, 3), (48, 1, 1)]
+    pixel_values, images_crop, images_spatial_crop = make_inputs(images)
+    crop_shapes = images_spatial_crop[:, 0].tolist()
+    keys = [(idx + 1, -idx) for idx in range(len(images))]
+    expected = model._pixel_values_to_embedding(pixel_values, images_crop, images_spatial_crop)
+
+    encoded = []
+    encode = model._pixel_values_to_embedding
+
+    def counting_encode(pixel_values, images_crop, images_spatial_crop, crop_shapes=None):
+        encoded.append(len(pixel_values))
+        return encode(pixel_values, images_crop, images_spatial_crop, crop_shapes=crop_shapes)
+
+    monkeypatch.setattr(model, '_pixel_values_to_embedding', counting_encode)
+
+    def run(indices, keys_for):
+        return model._process_image_input([[pixel_values[idx] for idx in indices], [images_crop[idx] for idx in indices],
+                                           images_spatial_crop[indices], [crop_shapes[idx] for idx in indices],
+                                           [keys_for(idx) for idx in indices]])
+
+    with torch.no_grad():
+        # warm up images 0 and 2
+        first = run([0, 2], lambda idx: keys[idx])
+        assert encoded == [2]
+        # 0 and 2 hit; 1, 3 and 4 are encoded together, and 4 (no hash) is not cached
+        mixed = run([0, 1, 2, 3, 4], lambda idx: keys[idx] if idx != 4 else None)
+        assert encoded == [2, 3]
+        assert mixed[0] is first[0] and mixed[2] is first[1]
+        assert model.vision_cache.stats() == {'entries': 4, 'mb': 0.0, 'hits': 2, 'misses': 4}
+        # all cached: the encoder is not called, cached tensors come back in request order
+        hits = run([3, 0, 1, 2], lambda idx: keys[idx])
+        assert encoded == [2, 3]
+        assert hits[0] is mixed[3] and hits[1] is first[0] and hits[2] is mixed[1] and hits[3] is first[1]
+
+    for features, reference in zip(mixed, expected):
+        assert features.shape == reference.shape
+        torch.testing.assert_close(features, reference, rtol=1.6e-2, atol=1e-2)
@@ -0,0 +1,58 @@
+"""
+The vision input path of DeepseekOCRForCausalLM must not block on the device.
+
+"has image" / "has crops" come from images_spatial_crop and the cache keys from image_hashes,
+read back once per batch; nothing in the path may look at tensor contents with .item().
+Checked on the source, so it runs without torch or vllm.
+"""
+import ast
+import os
+
+import pytest
+
+from conftest import VLLM_DIR
+
+MODEL_CLASS = 'DeepseekOCRForCausalLM'
+# every method a prefill with images goes through before the language model
+VISION_INPUT_PATH = (
+    'get_multimodal_embeddings',
+    '_parse_and_validate_image_input',
+    '_image_metadata',
+    '_crop_shapes',
+    '_rows',
+    '_process_image_input',
+    '_to_model_input',
+    '_encode_views',
+    '_pixel_values_to_embedding',
+)
+# the only device -> host copies allowed: one metadata read per batch
+HOST_COPIES = {'_image_metadata': 1, '_crop_shapes': 1}
+
+
+@pytest.fixture(scope='module')
+def methods():
+    with open(os.path.join(VLLM_DIR, 'deepseek_ocr.py'), 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    model_class = next(node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == MODEL_CLASS)
+    return {node.name: node for node in model_class.body if isinstance(node, ast.FunctionDef)}
+
+
+def method_calls(node, name):
+    return [call for call in ast.walk(node)
+            if isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == name]
+
+
+def test_vision_input_path_exists(methods):
+    assert set(VISION_INPUT_PATH) <= set(methods)
+
+
+@pytest.mark.parametrize('name', VISION_INPUT_PATH)
+def test_no_item_calls(methods, name):
+    calls = method_calls(methods[name], 'item')
+    assert not calls, f'{name} calls .item() on line(s) {[call.lineno for call in calls]}'
+
+
+@pytest.mark.parametrize('name', VISION_INPUT_PATH)
+def test_host_copies_limited_to_metadata(methods, name):
+    calls = [call for attr in ('tolist', 'cpu', 'numpy') for call in method_calls(methods[name], attr)]
+    assert len(calls) == HOST_COPIES.get(name, 0), f'{name}: host copies on line(s) {[call.lineno for call in calls]}'